@@ -46,6 +46,15 @@ class TestWeb(unittest.TestCase):
     r = authenticated_request('verify_session', {}, session_id)
     self.assertEqual(r['user_id'], test_user)
 
+  def test_create_coroutine(self):
+    test_user = 'test'+uuid4().hex
+    r = request('account.create', {'user_id': test_user, 'password': 'test'})
+    session_id = r['session_id']
+    r = authenticated_request('verify_session_coroutine', {}, session_id)
+    self.assertEqual(r['user_id'], test_user)
+    r = request('verify_session_coroutine', {}, response_key='error')
+    self.assertEqual(r['code'], 1004)
+
   def test_login(self):
     test_user = 'test'+uuid4().hex
     r = request('account.create', {'user_id': test_user, 'password': 'test'})
@@ -60,3 +69,34 @@ class TestWeb(unittest.TestCase):
     test_user = 'test'+uuid4().hex
     r = request('account.login', {'user_id': test_user, 'password': 'test'}, response_key='error')
     self.assertEqual(r, {u'code': 1005, u'value': u'Invalid user ID or password'})
+
+  def test_cached_user_scope(self):
+    sessions = {}
+    for i in xrange(2):
+      test_user = 'test'+uuid4().hex
+      sessions[test_user] = request('account.create', {'user_id': test_user, 'password': 'test'})['session_id']
+    for method in ('cached.counter_user_unloaded', 'cached.counter_user'):
+      results = {}
+      for test_user, session_id in sessions.iteritems():
+        results[test_user] = authenticated_request(method, {}, session_id)
+        self.assertEqual(results[test_user]['user_id'], test_user)
+      self.assertNotEqual(*[r['count'] for r in results.values()])
+      anonymous = request(method, {})
+      self.assertEqual(anonymous['user_id'], None)
+      self.assertNotEqual(request(method, {})['count'], anonymous['count'])
+    #only the correctly ordered method caches each user's result
+    for test_user, session_id in sessions.iteritems():
+      self.assertEqual(authenticated_request('cached.counter_user', {}, session_id), results[test_user])
+      first = authenticated_request('cached.counter_user_unloaded', {}, session_id)
+      self.assertNotEqual(authenticated_request('cached.counter_user_unloaded', {}, session_id)['count'], first['count'])
+
+  def test_preload_account(self):
+    test_user = 'test'+uuid4().hex
+    r = request('account.create', {'user_id': test_user, 'password': 'test'})
+    session_id = r['session_id']
+    r = authenticated_request('account.update', {'user_id': test_user, 'password': 'test', 'name': 'Test', 'email': 'test@toto.li'}, session_id)
+    self.assertTrue('name' in r['updated_fields'] and 'email' in r['updated_fields'])
+    r = authenticated_request('preloaded_account', {}, session_id)
+    self.assertEqual(r['name'], 'Test')
+    self.assertEqual(r['email'], 'test@toto.li')
+    self.assertTrue('name' in r['loaded'] and 'email' in r['loaded'])
@@ -0,0 +1,33 @@
+import unittest
+from time import time
+from tornado.ioloop import IOLoop
+from toto.deadline import *
+from toto.workerconnection import WorkerConnection
+
+class TestDeadline(unittest.TestCase):
+
+  def test_context(self):
+    io_loop = IOLoop()
+    deadlines = []
+    def check():
+      deadlines.append(current_deadline())
+      io_loop.stop()
+    with deadline_context(42):
+      io_loop.add_callback(check)
+    self.assertEqual(current_deadline(), None)
+    io_loop.start()
+    io_loop.close()
+    self.assertEqual(deadlines, [42])
+
+  def test_expired(self):
+    self.assertFalse(deadline_expired(None))
+    self.assertFalse(deadline_expired(time() + 10))
+    self.assertTrue(deadline_expired(time() - 1))
+
+  def test_worker_message(self):
+    connection = WorkerConnection()
+    self.assertEqual(connection._message('a', {}), {'method': 'a', 'parameters': {}})
+    self.assertEqual(connection._message('a', {}, 10), {'method': 'a', 'parameters': {}, 'deadline': 10})
+    with deadline_context(42):
+      self.assertEqual(connection._message('a', {})['deadline'], 42)
+      self.assertEqual(connection._message('a', {}, 10)['deadline'], 10)
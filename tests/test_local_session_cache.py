@@ -0,0 +1,94 @@
+import unittest
+from toto.jsondbconnection import JSONConnection
+from toto.localsessioncache import LocalSessionCache
+from toto.cache import LRUCache
+from time import sleep
+
+class CountingConnection(JSONConnection):
+
+  loads = 0
+
+  def _load_uncached_data(self, session_id):
+    self.loads += 1
+    return super(CountingConnection, self)._load_uncached_data(session_id)
+
+class CaseSensitiveConnection(CountingConnection):
+
+  def _normalize_user_id(self, user_id):
+    return user_id
+
+class TestLocalSessionCache(unittest.TestCase):
+
+  def setUp(self):
+    self.db = CountingConnection()
+    self.db.set_local_session_cache(LocalSessionCache(max_size=2, ttl=10))
+    self.db.create_account('test@toto.li', 'password')
+
+  def test_lru_cache(self):
+    cache = LRUCache(2, 0.1)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    self.assertEqual(cache.get('a'), 1)
+    cache.set('c', 3)
+    self.assertTrue('a' in cache)
+    self.assertFalse('b' in cache)
+    self.assertEqual(len(cache), 2)
+    sleep(0.15)
+    self.assertEqual(cache.get('a'), None)
+    self.assertEqual(cache.get('c', 'expired'), 'expired')
+
+  def test_retrieve_cached(self):
+    session_id = self.db.create_session('test@toto.li', 'password').session_id
+    for i in xrange(5):
+      self.assertEqual(self.db.retrieve_session(session_id).user_id, 'test@toto.li')
+    self.assertEqual(self.db.loads, 0)
+
+  def test_save(self):
+    session_id = self.db.create_session('test@toto.li', 'password').session_id
+    session = self.db.retrieve_session(session_id)
+    session['value'] = 'saved'
+    session.save()
+    self.assertEqual(self.db.retrieve_session(session_id)['value'], 'saved')
+    self.assertEqual(self.db.loads, 0)
+
+  def test_eviction(self):
+    session_ids = [self.db.create_session('test@toto.li', 'password').session_id for i in xrange(3)]
+    for session_id in reversed(session_ids):
+      self.assertEqual(self.db.retrieve_session(session_id).session_id, session_id)
+    self.assertEqual(self.db.loads, 1)
+
+  def test_remove_session(self):
+    session_id = self.db.create_session('test@toto.li', 'password').session_id
+    self.db.remove_session(session_id)
+    self.assertEqual(self.db.retrieve_session(session_id), None)
+    self.assertEqual(self.db.loads, 1)
+
+  def test_clear_sessions(self):
+    session_id = self.db.create_session('test@toto.li', 'password').session_id
+    anon_session_id = self.db.create_session().session_id
+    self.db.clear_sessions('Test@toto.li')
+    self.db.retrieve_session(session_id)
+    self.assertEqual(self.db.loads, 1)
+    self.assertEqual(self.db.retrieve_session(anon_session_id).session_id, anon_session_id)
+    self.assertEqual(self.db.loads, 1)
+
+  def test_ttl_not_extended_by_hits(self):
+    self.db.set_local_session_cache(LocalSessionCache(max_size=2, ttl=0.3))
+    session_id = self.db.create_session('test@toto.li', 'password').session_id
+    self.db._remove_session(session_id)
+    for i in xrange(10):
+      if not self.db.retrieve_session(session_id):
+        break
+      sleep(0.1)
+    self.assertEqual(self.db.retrieve_session(session_id), None)
+    self.assertTrue(i <= 4)
+
+  def test_case_sensitive_user_ids(self):
+    db = CaseSensitiveConnection()
+    db.set_local_session_cache(LocalSessionCache(max_size=2, ttl=10))
+    db.create_account('Test@toto.li', 'password')
+    session_id = db.create_session('Test@toto.li', 'password').session_id
+    self.assertRaises(Exception, db.create_session, 'test@toto.li', 'password')
+    db.clear_sessions('Test@toto.li')
+    db.retrieve_session(session_id)
+    self.assertEqual(db.loads, 1)
@@ -0,0 +1,48 @@
+import unittest
+import json
+from toto.metrics import *
+
+class TestMetrics(unittest.TestCase):
+
+  def test_histogram(self):
+    histogram = Histogram()
+    for i in xrange(1, 10001):
+      histogram.record(i)
+    self.assertEqual(histogram.count, 10000)
+    self.assertEqual(histogram.total, 50005000)
+    for quantile in (0.5, 0.95, 0.99):
+      self.assertAlmostEqual(histogram.percentile(quantile), quantile * 10000, delta=quantile * 10000 * 0.07)
+    self.assertEqual(histogram.percentile(1), 10239)
+    self.assertEqual(Histogram().percentile(0.5), 0)
+    small = Histogram()
+    for i in xrange(32):
+      small.record(i)
+    self.assertEqual(small.percentile(0.5), 15)
+    data = small.to_dict()
+    small.record(1000000)
+    self.assertEqual(Histogram.from_dict(data).percentile(1), 31)
+
+  def test_merge(self):
+    first = MethodMetrics()
+    second = MethodMetrics()
+    for i in xrange(100):
+      first.record('a', 0.001)
+      second.record('a', 0.1, i % 10 == 0)
+    second.record('b', 0.5)
+    merged = merge_snapshots([json.loads(json.dumps(first.snapshot())), json.loads(json.dumps(second.snapshot()))])
+    self.assertEqual(merged['a']['calls'], 200)
+    self.assertEqual(merged['a']['errors'], 10)
+    self.assertAlmostEqual(merged['a']['latency'].percentile(0.25), 1000, delta=70)
+    self.assertAlmostEqual(merged['a']['latency'].percentile(0.99), 100000, delta=7000)
+    self.assertEqual(merged['b']['calls'], 1)
+
+  def test_prometheus_text(self):
+    metrics = MethodMetrics()
+    metrics.record('account.login', 0.01)
+    metrics.record('account.login', 0.03, True)
+    text = prometheus_text(merge_snapshots([metrics.snapshot()]))
+    self.assertIn('toto_method_calls_total{method="account.login"} 2\n', text)
+    self.assertIn('toto_method_errors_total{method="account.login"} 1\n', text)
+    self.assertIn('toto_method_duration_seconds{method="account.login",quantile="0.5"} 0.01', text)
+    self.assertIn('toto_method_duration_seconds_sum{method="account.login"} 0.040000\n', text)
+    self.assertIn('toto_method_duration_seconds_count{method="account.login"} 2\n', text)
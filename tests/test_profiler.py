@@ -0,0 +1,36 @@
+import unittest
+from time import time
+from toto.profiler import *
+
+def spin(duration):
+  end = time() + duration
+  while time() < end:
+    pass
+
+class TestProfiler(unittest.TestCase):
+
+  def test_profile_header(self):
+    self.assertTrue(verify_profile_header('secret', profile_header('secret')))
+    self.assertFalse(verify_profile_header('other', profile_header('secret')))
+    self.assertFalse(verify_profile_header('secret', profile_header('secret', -1)))
+    self.assertFalse(verify_profile_header('secret', 'invalid'))
+    self.assertFalse(verify_profile_header(None, profile_header('secret')))
+
+  def test_merge_collapsed(self):
+    merged = merge_collapsed(['a;b 2\na;c 1\n', 'a;b 3\n'])
+    self.assertEqual(merged, {'a;b': 5, 'a;c': 1})
+    self.assertEqual(collapsed_text(merged), 'a;b 5\na;c 1\n')
+
+  def test_sampling(self):
+    profiler = SamplingProfiler()
+    profiler.start(0.001)
+    try:
+      spin(0.05)
+      with profiler.context('test.method'):
+        spin(0.1)
+    finally:
+      profiler.stop()
+    self.assertTrue(profiler.stacks)
+    for stack in profiler.stacks:
+      self.assertTrue(stack.startswith('test.method;'))
+    self.assertTrue(any(stack.endswith('test_profiler.spin') for stack in profiler.stacks))
@@ -0,0 +1,38 @@
+import unittest
+import os
+from time import time, sleep
+from toto.ratelimit import SharedTokenBuckets
+
+class TestRateLimit(unittest.TestCase):
+
+  def test_consume(self):
+    buckets = SharedTokenBuckets(16)
+    for i in xrange(3):
+      self.assertEqual(buckets.consume('a', 1, 3), (True, 0))
+    allowed, retry_after = buckets.consume('a', 1, 3)
+    self.assertFalse(allowed)
+    self.assertTrue(0 < retry_after <= 1)
+    self.assertEqual(buckets.consume('b', 1, 3), (True, 0))
+
+  def test_refill(self):
+    buckets = SharedTokenBuckets(16)
+    self.assertTrue(buckets.consume('a', 20, 1)[0])
+    self.assertFalse(buckets.consume('a', 20, 1)[0])
+    sleep(0.1)
+    self.assertTrue(buckets.consume('a', 20, 1)[0])
+
+  def test_full_table(self):
+    buckets = SharedTokenBuckets(4)
+    for i in xrange(100):
+      self.assertTrue(buckets.consume(str(i), 0.01, 1)[0])
+    self.assertFalse(buckets.consume('99', 0.01, 1)[0])
+
+  def test_shared_between_processes(self):
+    buckets = SharedTokenBuckets(16)
+    pid = os.fork()
+    if not pid:
+      buckets.consume('a', 0.01, 2)
+      os._exit(0)
+    os.waitpid(pid, 0)
+    self.assertTrue(buckets.consume('a', 0.01, 2)[0])
+    self.assertFalse(buckets.consume('a', 0.01, 2)[0])
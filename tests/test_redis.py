@@ -0,0 +1,121 @@
+import unittest
+import cPickle as pickle
+from time import time
+from toto.jsondbconnection import JSONConnection
+
+try:
+  import redis
+  redis.StrictRedis(db=15).ping()
+  from toto.redisconnection import RedisConnection, RedisSessionCache
+  REDIS_AVAILABLE = True
+except Exception:
+  REDIS_AVAILABLE = False
+
+@unittest.skipUnless(REDIS_AVAILABLE, 'requires redis and a local redis-server')
+class TestRedis(unittest.TestCase):
+
+  def setUp(self):
+    self.redis = redis.StrictRedis(db=15)
+    self.redis.flushdb()
+    RedisConnection(database=15).create_account('test@toto.li', 'password')
+
+  def connection(self, state_layout='blob'):
+    return RedisConnection(database=15, state_layout=state_layout)
+
+  def test_retrieve_renews_in_one_round_trip(self):
+    db = self.connection()
+    session = db.create_session('test@toto.li', 'password')
+    self.redis.hset('session:' + session.session_id, 'expires', time() + 10)
+    updates = []
+    db._update_expiry = lambda *args: updates.append(args)
+    session = db.retrieve_session(session.session_id)
+    self.assertTrue(session.expires > time() + db.session_renew - 10)
+    self.assertTrue(self.redis.ttl('session:' + session.session_id) > 10)
+    self.assertEqual(updates, [])
+
+  def test_save_state(self):
+    for state_layout in ('blob', 'keys'):
+      db = self.connection(state_layout)
+      session_id = db.create_session('test@toto.li', 'password').session_id
+      session = db.retrieve_session(session_id)
+      session['a'] = 1
+      session['b'] = 'b'
+      session.save()
+      session = db.retrieve_session(session_id)
+      self.assertEqual(session.state, {'a': 1, 'b': 'b'})
+      del session['a']
+      session.save()
+      self.assertEqual(db.retrieve_session(session_id).state, {'b': 'b'})
+      self.assertEqual(state_layout == 'keys', self.redis.hexists('session:' + session_id, 'state:b'))
+
+  def test_save_modified_in_place(self):
+    db = self.connection()
+    session_id = db.create_session('test@toto.li', 'password').session_id
+    session = db.retrieve_session(session_id)
+    session['cart'] = ['a']
+    session.save()
+    session = db.retrieve_session(session_id)
+    session.state['cart'].append('b')
+    session.save()
+    self.assertEqual(db.retrieve_session(session_id)['cart'], ['a', 'b'])
+
+  def test_switch_layout(self):
+    session_id = self.connection('blob').create_session('test@toto.li', 'password').session_id
+    db = self.connection('blob')
+    session = db.retrieve_session(session_id)
+    session['a'] = 1
+    session.save()
+    db = self.connection('keys')
+    session = db.retrieve_session(session_id)
+    session['b'] = 2
+    session.save()
+    self.assertEqual(db.retrieve_session(session_id).state, {'a': 1, 'b': 2})
+    self.assertFalse(self.redis.hexists('session:' + session_id, 'state'))
+
+  def test_legacy_session(self):
+    db = self.connection()
+    session_data = {'user_id': 'test@toto.li', 'expires': time() + 1000, 'session_id': 'legacy', 'state': pickle.dumps({'a': 1})}
+    self.redis.setex('session:legacy', 1000, pickle.dumps(session_data))
+    self.assertEqual(db.retrieve_session('legacy').state, {'a': 1})
+    self.assertEqual(self.redis.type('session:legacy'), 'hash')
+    db.clear_sessions('test@toto.li')
+    self.assertEqual(db.retrieve_session('legacy'), None)
+
+  def test_clear_sessions(self):
+    db = self.connection()
+    session_ids = [db.create_session('test@toto.li', 'password').session_id for i in xrange(3)]
+    anon_session_id = db.create_session().session_id
+    db.remove_session(session_ids[0])
+    self.assertEqual(db.retrieve_session(session_ids[0]), None)
+    session_ids.append(db.create_session('test@toto.li', 'password').session_id)
+    self.assertEqual(self.redis.smembers('user_sessions:test@toto.li'), set(session_ids[1:]))
+    db.clear_sessions('Test@Toto.li')
+    for session_id in session_ids:
+      self.assertEqual(db.retrieve_session(session_id), None)
+    self.assertEqual(db.retrieve_session(anon_session_id).session_id, anon_session_id)
+    self.assertFalse(self.redis.exists('user_sessions:test@toto.li'))
+
+  def test_prune_batch(self):
+    db = self.connection()
+    db.store.prune_batch_size = 2
+    for session_id in [db.create_session('test@toto.li', 'password').session_id for i in xrange(5)]:
+      db.remove_session(session_id)
+    session_id = db.create_session('test@toto.li', 'password').session_id
+    session_ids = self.redis.smembers('user_sessions:test@toto.li')
+    self.assertTrue(session_id in session_ids)
+    self.assertTrue(len(session_ids) >= 4)
+    for i in xrange(50):
+      db.store.prune('test@toto.li')
+    self.assertEqual(self.redis.smembers('user_sessions:test@toto.li'), set([session_id]))
+
+  def test_session_cache(self):
+    self.redis.flushdb()
+    db = JSONConnection()
+    db.set_session_cache(RedisSessionCache(self.redis))
+    db.create_account('test@toto.li', 'password')
+    session = db.create_session('test@toto.li', 'password')
+    session['a'] = 1
+    session.save()
+    self.assertEqual(db.retrieve_session(session.session_id)['a'], 1)
+    db.clear_sessions('TEST@toto.li')
+    self.assertEqual(db.retrieve_session(session.session_id), None)
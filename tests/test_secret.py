@@ -2,6 +2,8 @@ import unittest
 
 from uuid import uuid4
 from toto.secret import *
+from tornado.ioloop import IOLoop
+from tornado.options import options
 
 class TestSecret(unittest.TestCase):
 
@@ -19,3 +21,15 @@ class TestSecret(unittest.TestCase):
     self.assertTrue(not verify_password(pw + uuid4().hex, pw_hash))
     self.assertTrue(not verify_password(uuid4().hex, pw_hash))
     self.assertTrue(verify_password(pw, pw_hash))
+
+  def test_async_password_hash(self):
+    pw = uuid4().hex
+    pw_hash = IOLoop.current().run_sync(lambda: password_hash_async(pw))
+    self.assertTrue(verify_password(pw, pw_hash))
+    self.assertTrue(IOLoop.current().run_sync(lambda: verify_password_async(pw, pw_hash)))
+    self.assertFalse(IOLoop.current().run_sync(lambda: verify_password_async(uuid4().hex, pw_hash)))
+    self.assertRaises(ValueError, IOLoop.current().run_sync, lambda: verify_password_async(pw, '$p5k2$$!$'))
+    stats = password_queue_stats()
+    self.assertEqual(stats['pending'], 0)
+    self.assertEqual(stats['completed'], 4)
+    self.assertEqual(stats['threads'], 1)
@@ -0,0 +1,43 @@
+import unittest
+import json
+from toto.serialization import *
+
+class TestSerialization(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    register_codec('application/x-test', repr, eval)
+
+  def test_get_codec(self):
+    self.assertEqual(get_codec('application/json').mime_type, 'application/json')
+    self.assertEqual(get_codec('Application/JSON; charset=utf-8').mime_type, 'application/json')
+    self.assertEqual(get_codec('application/x-test').decode("{'a': 1}"), {'a': 1})
+    self.assertEqual(get_codec('text/html'), None)
+
+  def test_negotiate(self):
+    json_codec = get_codec('application/json')
+    test_codec = get_codec('application/x-test')
+    self.assertEqual(negotiate_codec(None, json_codec), json_codec)
+    self.assertEqual(negotiate_codec('text/html,*/*;q=0.8', json_codec), json_codec)
+    self.assertEqual(negotiate_codec('application/x-test', json_codec), test_codec)
+    self.assertEqual(negotiate_codec('application/json;q=0.5, application/x-test', json_codec), test_codec)
+    self.assertEqual(negotiate_codec('application/x-test;q=0.5, application/json', test_codec), json_codec)
+    self.assertEqual(negotiate_codec('application/json, application/x-test', test_codec), test_codec)
+    self.assertEqual(negotiate_codec('application/x-test;q=0', test_codec), test_codec)
+    self.assertEqual(negotiate_codec('application/json;q=0, application/x-test;q=0', json_codec), json_codec)
+
+  def test_json_module(self):
+    class CountingJSON(object):
+      calls = 0
+      @classmethod
+      def dumps(cls, obj):
+        cls.calls += 1
+        return json.dumps(obj)
+      loads = staticmethod(json.loads)
+    try:
+      set_json_module(CountingJSON)
+      self.assertEqual(get_codec('application/json').encode({'a': 1}), '{"a": 1}')
+      self.assertEqual(CountingJSON.calls, 1)
+      self.assertTrue(get_codec('application/json').streaming)
+    finally:
+      set_json_module(json)
@@ -9,8 +9,13 @@ from multiprocessing import Process, active_children
 from toto.server import TotoServer
 from time import sleep, time
 from toto.handler import TotoHandler
+from toto.profiler import profile_header
 from util import *
 import logging
+import zlib
+import tempfile
+from glob import glob
+from threading import Thread
 
 def before_handler(handler, transaction, method):
   logging.info('Begin %s %s' % (method, transaction))
@@ -20,14 +25,23 @@ def after_handler(handler, transaction):
 TotoHandler.set_before_handler(before_handler)
 TotoHandler.set_after_handler(after_handler)
 
+SLOW_REQUEST_LOG = os.path.join(tempfile.gettempdir(), 'toto-test-slow-requests.log')
+TRACE_FILE = os.path.join(tempfile.gettempdir(), 'toto-test-traces.log')
+CONCURRENT_URL = 'http://127.0.0.1:9001/'
+
+def run_concurrent_server(processes=1, daemon='start'):
+  TotoServer(method_module='web_methods', port=9001, debug=True, processes=processes, daemon=daemon, pidfile='concurrent_server.pid', batch_concurrency=0, metrics_path='/metrics').run()
+
 def run_server(processes=1, daemon='start'):
-  TotoServer(method_module='web_methods', port=9000, debug=True, processes=processes, daemon=daemon, pidfile='server.pid').run()
+  TotoServer(method_module='web_methods', port=9000, debug=True, processes=processes, daemon=daemon, pidfile='server.pid', compress_responses=True, compression_cache_size=16, metrics_path='/metrics', method_warmup=True, profile_secret='profile-secret', profile_path='/profile', profile_interval=0.001, slow_request_threshold=0.15, slow_request_log=SLOW_REQUEST_LOG, tracing=True, trace_file=TRACE_FILE, trace_export_interval=0.2).run()
 
 class TestWeb(unittest.TestCase):
 
   @classmethod
   def setUpClass(cls):
     print 'Starting server'
+    for path in glob(SLOW_REQUEST_LOG.replace('.log', '.*.log')) + glob(TRACE_FILE.replace('.log', '.*.log')):
+      os.remove(path)
     Process(target=run_server, args=[int(os.environ.get('NUM_PROCS', -1))]).start()
     sleep(0.5)
 
@@ -79,6 +93,259 @@ class TestWeb(unittest.TestCase):
     self.assertEqual(response['parameters']['arg1'][0], '1')
     self.assertEqual(response['parameters']['arg2'][0], 'hello')
 
+  def test_accept_negotiation(self):
+    request = {'method': 'return_value', 'parameters': {'arg1': 1}}
+    headers = {'content-type': 'application/json', 'accept': 'text/html,*/*;q=0.8'}
+    req = urllib2.Request('http://127.0.0.1:9000/', json.dumps(request), headers)
+    f = urllib2.urlopen(req)
+    self.assertEqual(f.info()['content-type'], 'application/json')
+    self.assertEqual(f.info()['vary'].lower(), 'accept')
+    self.assertEqual(json.loads(f.read())['result']['parameters'], request['parameters'])
+
+  def test_compression(self):
+    request = {'method': 'return_value', 'parameters': {'value': 'x' * 2000}}
+    for encoding, wbits in (('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS)):
+      for i in xrange(2):
+        headers = {'content-type': 'application/json', 'accept-encoding': encoding}
+        req = urllib2.Request('http://127.0.0.1:9000/', json.dumps(request), headers)
+        f = urllib2.urlopen(req)
+        self.assertEqual(f.info()['content-encoding'], encoding)
+        body = f.read()
+        self.assertTrue(len(body) < 1000)
+        self.assertEqual(json.loads(zlib.decompress(body, wbits))['result']['parameters'], request['parameters'])
+    headers = {'content-type': 'application/json', 'accept-encoding': 'gzip;q=0, identity'}
+    f = urllib2.urlopen(urllib2.Request('http://127.0.0.1:9000/', json.dumps(request), headers))
+    self.assertTrue('content-encoding' not in f.info())
+    self.assertEqual(json.loads(f.read())['result']['parameters'], request['parameters'])
+    headers = {'content-type': 'application/json', 'accept-encoding': 'gzip'}
+    f = urllib2.urlopen(urllib2.Request('http://127.0.0.1:9000/', json.dumps({'method': 'return_value'}), headers))
+    self.assertTrue('content-encoding' not in f.info())
+
+  def test_cached(self):
+    for method in ('cached.counter', 'cached.counter_async', 'cached.counter_coroutine', 'cached.counter_serialized'):
+      first = request(method, {'key': 1})
+      self.assertEqual(first['parameters'], {'key': 1})
+      self.assertEqual(request(method, {'key': 1}), first)
+      second = request(method, {'key': 2})
+      self.assertNotEqual(second['count'], first['count'])
+      self.assertEqual(request(method, {'key': 2}), second)
+    first = request('cached.counter', {'key': 1})
+    request('cached.invalidate', {'parameters': {'key': 1}})
+    self.assertNotEqual(request('cached.counter', {'key': 1})['count'], first['count'])
+
+  def test_coalesce_no_response(self):
+    def leader(key, timeout):
+      body = json.dumps({'method': 'coalesced.no_response', 'parameters': {'key': key}})
+      try:
+        urllib2.urlopen(urllib2.Request('http://127.0.0.1:9000/', body, {'content-type': 'application/json'}), timeout=timeout).read()
+      except Exception:
+        pass
+    #the first leader disconnects after 0.2s, the second is abandoned after the 0.5s coalesce timeout
+    for key, client_timeout, min_wait, max_wait in ((1, 0.2, 0, 0.4), (2, 1.0, 0.4, 0.9)):
+      thread = Thread(target=leader, args=[key, client_timeout])
+      thread.start()
+      sleep(0.05)
+      start = time()
+      self.assertEqual(request('coalesced.no_response', {'key': key}, response_key='error')['code'], 1011)
+      self.assertTrue(min_wait <= time() - start < max_wait)
+      thread.join()
+      self.assertEqual(request('coalesced.no_response', {'key': key, 'respond': True})['parameters'], {'key': key, 'respond': True})
+
+  def test_metrics(self):
+    request('return_value', {})
+    request('return_value_async', {})
+    try:
+      request('throw_exception', {})
+    except Exception:
+      pass
+    f = urllib2.urlopen('http://127.0.0.1:9000/metrics')
+    self.assertTrue(f.headers['content-type'].startswith('text/plain'))
+    metrics = f.read()
+    self.assertIn('toto_method_calls_total{method="return_value"}', metrics)
+    self.assertIn('toto_method_calls_total{method="return_value_async"}', metrics)
+    self.assertIn('toto_method_errors_total{method="throw_exception"} ', metrics)
+    self.assertIn('toto_method_duration_seconds{method="return_value",quantile="0.99"}', metrics)
+
+  def test_limit_respond_raw(self):
+    #each call releases its slot when the request finishes, even without calling respond()
+    for i in xrange(3):
+      self.assertEqual(urllib2.urlopen('http://127.0.0.1:9000/limited/raw_async').read(), 'done')
+
+  def test_deadline(self):
+    self.assertEqual(request('timeouts.default', {'sleep': 0}), {'parameters': {'sleep': 0}})
+    self.assertEqual(request('timeouts.default', {'sleep': 0.5}, response_key='error')['code'], 1012)
+    response = request('timeouts.sleep', {'sleep': 0})
+    self.assertEqual(response['remaining'], None)
+    response = request('timeouts.sleep', {'sleep': 0.1}, headers={'x-toto-timeout': '1000'})
+    self.assertTrue(0.5 < response['remaining'] < 0.9)
+    self.assertTrue(response['current'])
+    self.assertEqual(request('timeouts.sleep', {'sleep': 0.3}, headers={'x-toto-timeout': '100'}, response_key='error')['code'], 1012)
+    self.assertEqual(request('timeouts.default', {'sleep': 0.1}, headers={'x-toto-timeout': '50'}, response_key='error')['code'], 1012)
+    #the requests in a batch share the client's deadline
+    batch = {'a': {'method': 'timeouts.sleep', 'parameters': {'sleep': 0.3}}, 'b': {'method': 'timeouts.sleep', 'parameters': {'sleep': 0.3}}}
+    req = urllib2.Request('http://127.0.0.1:9000/', json.dumps({'batch': batch}), {'content-type': 'application/json', 'x-toto-timeout': '500'})
+    batch_response = json.loads(urllib2.urlopen(req).read())['batch']
+    self.assertTrue(0 < batch_response['a']['result']['remaining'] < 0.2)
+    self.assertEqual(batch_response['b']['error']['code'], 1012)
+
+  def test_warmup(self):
+    self.assertEqual(request('warm', {}), {'warmed_up': [True]})
+    self.assertEqual(request('account.create', {}, response_key='error')['code'], 1003)
+    self.assertEqual(request('os', {}, response_key='error')['code'], 1001)
+    self.assertEqual(request('account', {}, response_key='error')['code'], 1001)
+
+  def test_stream(self):
+    result = request('stream.items', {'count': 5})
+    self.assertEqual([i['i'] for i in result], range(5))
+    self.assertTrue(result[1]['delayed'])
+    response, headers = request('stream.items', {'count': 100, 'padding': 2000}, response_key=None, return_headers=True)
+    self.assertEqual(len(response['result']), 100)
+    self.assertEqual(headers['transfer-encoding'], 'chunked')
+    response = request('stream.error', {}, response_key=None)
+    self.assertEqual(response['result'], [{'i': 0}])
+    self.assertEqual(response['error']['code'], 4242)
+    req = urllib2.Request('http://127.0.0.1:9000/', json.dumps({'method': 'stream.items', 'parameters': {'count': 3}}), {'content-type': 'application/json', 'accept': 'application/x-ndjson'})
+    f = urllib2.urlopen(req)
+    self.assertEqual(f.headers['content-type'], 'application/x-ndjson')
+    self.assertEqual([json.loads(line)['i'] for line in f.read().splitlines()], range(3))
+    batch = {'a': {'method': 'stream.items', 'parameters': {'count': 3}}, 'b': {'method': 'stream.error', 'parameters': {}}}
+    req = urllib2.Request('http://127.0.0.1:9000/', json.dumps({'batch': batch}), {'content-type': 'application/json'})
+    batch_response = json.loads(urllib2.urlopen(req).read())['batch']
+    self.assertEqual([i['i'] for i in batch_response['a']['result']], range(3))
+    self.assertEqual(batch_response['b']['error']['code'], 4242)
+    self.assertEqual([i['i'] for i in request('stream.values', {'count': 3})], range(3))
+    req = urllib2.Request('http://127.0.0.1:9000/stream/values?count=3')
+    req.get_method = lambda: 'HEAD'
+    f = urllib2.urlopen(req)
+    self.assertEqual(f.getcode(), 200)
+    self.assertEqual(f.read(), '')
+
+  def test_respond_file(self):
+    import tempfile
+    import urllib
+    data = ''.join(chr(i % 256) for i in xrange(200000))
+    with tempfile.NamedTemporaryFile(suffix='.txt') as f:
+      f.write(data)
+      f.flush()
+      url = 'http://127.0.0.1:9000/send_file?' + urllib.urlencode({'path': f.name})
+      response = urllib2.urlopen(url)
+      self.assertEqual(response.read(), data)
+      self.assertEqual(response.headers['content-type'], 'text/plain')
+      self.assertEqual(response.headers['accept-ranges'], 'bytes')
+      self.assertEqual(response.headers.get('content-encoding'), None)
+      etag = response.headers['etag']
+      response = urllib2.urlopen(urllib2.Request(url + '&content_type=application%2Fx-test', headers={'range': 'bytes=100-199'}))
+      self.assertEqual(response.code, 206)
+      self.assertEqual(response.headers['content-type'], 'application/x-test')
+      self.assertEqual(response.headers['content-range'], 'bytes 100-199/200000')
+      self.assertEqual(response.read(), data[100:200])
+      response = urllib2.urlopen(urllib2.Request(url, headers={'range': 'bytes=-10'}))
+      self.assertEqual(response.read(), data[-10:])
+      response = urllib2.urlopen(urllib2.Request(url, headers={'range': 'bytes=10-', 'if-range': '"other"'}))
+      self.assertEqual(response.code, 200)
+      self.assertEqual(len(response.read()), len(data))
+      with self.assertRaises(urllib2.HTTPError) as context:
+        urllib2.urlopen(urllib2.Request(url, headers={'range': 'bytes=300000-'}))
+      self.assertEqual(context.exception.code, 416)
+      with self.assertRaises(urllib2.HTTPError) as context:
+        urllib2.urlopen(urllib2.Request(url, headers={'if-none-match': etag}))
+      self.assertEqual(context.exception.code, 304)
+      with self.assertRaises(urllib2.HTTPError) as context:
+        urllib2.urlopen(urllib2.Request(url, headers={'if-modified-since': response.headers['last-modified']}))
+      self.assertEqual(context.exception.code, 304)
+    self.assertEqual(request('send_file', {'path': f.name}, response_key='error')['code'], 1000)
+
+  def test_etag(self):
+    response = urllib2.urlopen('http://127.0.0.1:9000/etags/body?a=1')
+    etag = response.headers['etag']
+    self.assertEqual(json.loads(response.read())['result']['parameters'], {'a': '1'})
+    with self.assertRaises(urllib2.HTTPError) as context:
+      urllib2.urlopen(urllib2.Request('http://127.0.0.1:9000/etags/body?a=1', headers={'if-none-match': etag}))
+    self.assertEqual(context.exception.code, 304)
+    response = urllib2.urlopen(urllib2.Request('http://127.0.0.1:9000/etags/body?a=2', headers={'if-none-match': etag}))
+    self.assertNotEqual(response.headers['etag'], etag)
+    for method in ('version', 'version_coroutine'):
+      url = 'http://127.0.0.1:9000/etags/%s?version=1' % method
+      response = urllib2.urlopen(url)
+      etag = response.headers['etag']
+      count = json.loads(response.read())['result']['count']
+      with self.assertRaises(urllib2.HTTPError) as context:
+        urllib2.urlopen(urllib2.Request(url, headers={'if-none-match': etag}))
+      self.assertEqual(context.exception.code, 304)
+      response = urllib2.urlopen(urllib2.Request(url.replace('version=1', 'version=2'), headers={'if-none-match': etag}))
+      self.assertEqual(json.loads(response.read())['result']['count'], count + 1)
+      self.assertEqual(request('etags.%s' % method, {'version': '1'})['count'], count + 2)
+
+  def test_rate_limit(self):
+    for i in xrange(2):
+      self.assertEqual(request('rate_limited', {'client': 'a'})['client'], 'a')
+    response, headers = request('rate_limited', {'client': 'a'}, response_key=None, return_headers=True)
+    self.assertEqual(response['error']['code'], 1013)
+    self.assertTrue(int(headers['retry-after']) > 0)
+    self.assertEqual(request('rate_limited', {'client': 'b'})['client'], 'b')
+
+  def test_profile(self):
+    header = {'x-toto-profile': profile_header('profile-secret')}
+    self.assertTrue(request('profiled', {'duration': 0.2}, header)['spun'])
+    with self.assertRaises(urllib2.HTTPError) as context:
+      urllib2.urlopen('http://127.0.0.1:9000/profile')
+    self.assertEqual(context.exception.code, 403)
+    stacks = urllib2.urlopen(urllib2.Request('http://127.0.0.1:9000/profile', headers=header)).read().splitlines()
+    self.assertTrue(stacks)
+    self.assertTrue(all(stack.startswith('profiled;') for stack in stacks))
+    self.assertTrue(any('web_methods.profiled.spin' in stack for stack in stacks))
+
+  def test_slow_request_log(self):
+    urllib2.urlopen('http://127.0.0.1:9000/profiled?duration=0.2&slow=1').read()
+    urllib2.urlopen('http://127.0.0.1:9000/profiled?duration=0&slow=1').read()
+    entries = []
+    for i in xrange(20):
+      entries = []
+      for path in glob(SLOW_REQUEST_LOG.replace('.log', '.*.log')):
+        with open(path) as f:
+          entries.extend(e for e in (json.loads(line) for line in f) if 'slow=1' in e['uri'])
+      if entries:
+        break
+      sleep(0.05)
+    self.assertEqual(len(entries), 1)
+    entry = entries[0]
+    self.assertEqual(entry['method'], 'profiled')
+    self.assertTrue(entry['duration_ms'] >= 200)
+    phases = dict((phase['phase'], phase) for phase in entry['phases'])
+    self.assertEqual(set(phases), {'method', 'serialize', 'write'})
+    self.assertEqual(phases['method']['detail'], 'profiled')
+    self.assertTrue(phases['method']['duration_ms'] >= 200)
+    self.assertTrue(phases['serialize']['offset_ms'] >= phases['method']['offset_ms'] + phases['method']['duration_ms'])
+
+  def test_tracing(self):
+    trace_id = uuid4().hex
+    headers = {'content-type': 'application/json', 'x-toto-trace-id': trace_id, 'x-toto-span-id': 'parent'}
+    body = json.dumps({'batch': {'a': {'method': 'return_value', 'parameters': {}}, 'b': {'method': 'throw_exception', 'parameters': {}}}})
+    response = urllib2.urlopen(urllib2.Request('http://127.0.0.1:9000/', body, headers))
+    self.assertEqual(response.headers['x-toto-trace-id'], trace_id)
+    spans = []
+    for i in xrange(20):
+      spans = []
+      for path in glob(TRACE_FILE.replace('.log', '.*.log')):
+        with open(path) as f:
+          spans.extend(s for s in (json.loads(line) for line in f) if s['trace_id'] == trace_id)
+      if len(spans) == 3:
+        break
+      sleep(0.05)
+    spans = dict((span['name'], span) for span in spans)
+    self.assertEqual(set(spans), {'<batch>', 'return_value', 'throw_exception'})
+    self.assertEqual(spans['<batch>']['parent_id'], 'parent')
+    self.assertEqual(spans['return_value']['parent_id'], spans['<batch>']['span_id'])
+    self.assertEqual(spans['throw_exception']['parent_id'], spans['<batch>']['span_id'])
+    self.assertFalse('error' in spans['return_value'])
+    self.assertTrue(spans['throw_exception']['error'])
+
+  def test_raw_response(self):
+    headers = {'content-type': 'application/json'}
+    req = urllib2.Request('http://127.0.0.1:9000/', json.dumps({'method': 'return_raw', 'parameters': {'value': 'test'}}), headers)
+    f = urllib2.urlopen(req)
+    self.assertEqual(f.read(), 'raw:test')
+
   def test_method_no_params(self):
     request = {}
     request['method'] = 'return_value'
@@ -153,6 +420,26 @@ class TestWeb(unittest.TestCase):
       request['parameters']['arg2'] = rid
       self.assertEqual(request['parameters'], response['result']['parameters'])
 
+  def test_batch_method_coroutine(self):
+    batch = {}
+    headers = {'content-type': 'application/json'}
+    for i in xrange(5):
+      rid = uuid4().hex
+      request = {}
+      request['method'] = 'return_value_coroutine'
+      request['parameters'] = {'arg1': 1, 'arg2': rid}
+      batch[rid] = request
+    req = urllib2.Request('http://127.0.0.1:9000/', json.dumps({'batch': batch}), headers)
+    start = time()
+    f = urllib2.urlopen(req)
+    batch_response = json.loads(f.read())['batch']
+    #each request takes 0.1s and requests in a batch run one at a time by default
+    self.assertGreaterEqual(time() - start, 0.5)
+    self.assertEqual(set(batch), set(batch_response))
+    for rid, response in batch_response.iteritems():
+      request['parameters']['arg2'] = rid
+      self.assertEqual(request['parameters'], response['result']['parameters'])
+
   def test_exception(self):
     response = request('throw_exception', {'arg1': 1, 'arg2': 'hello'}, response_key='error')
     self.assertEqual({'code': 1000, 'value': "Test Exception"}, response)
@@ -176,3 +463,67 @@ class TestWeb(unittest.TestCase):
   def test_exception_task_coroutine(self):
     response = request('throw_exception_task_coroutine', {'arg1': 1, 'arg2': 'hello'}, response_key='error')
     self.assertEqual({'code': 1000, 'value': "Test Exception"}, response)
+
+class TestConcurrentBatch(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    print 'Starting concurrent batch server'
+    Process(target=run_concurrent_server, args=[int(os.environ.get('NUM_PROCS', -1))]).start()
+    sleep(0.5)
+
+  @classmethod
+  def tearDownClass(cls):
+    print 'Stopping concurrent batch server'
+    Process(target=run_concurrent_server, args=[int(os.environ.get('NUM_PROCS', -1)), 'stop']).start()
+    sleep(0.5)
+
+  def test_batch_method_coroutine(self):
+    batch = {}
+    headers = {'content-type': 'application/json'}
+    for i in xrange(5):
+      rid = uuid4().hex
+      request = {}
+      request['method'] = 'return_value_coroutine'
+      request['parameters'] = {'arg1': 1, 'arg2': rid}
+      batch[rid] = request
+    req = urllib2.Request('http://127.0.0.1:9001/', json.dumps({'batch': batch}), headers)
+    start = time()
+    f = urllib2.urlopen(req)
+    batch_response = json.loads(f.read())['batch']
+    #each request takes 0.1s, so the batch should complete in less than the sum
+    self.assertLess(time() - start, 0.4)
+    self.assertEqual(set(batch), set(batch_response))
+    for rid, response in batch_response.iteritems():
+      request['parameters']['arg2'] = rid
+      self.assertEqual(request['parameters'], response['result']['parameters'])
+
+  def test_coalesce(self):
+    headers = {'content-type': 'application/json'}
+    for method in ('coalesced.counter_async', 'coalesced.counter_coroutine'):
+      batch = {'a': {'method': method, 'parameters': {'key': 1}}, 'b': {'method': method, 'parameters': {'key': 1}}, 'c': {'method': method, 'parameters': {'key': 2}}}
+      req = urllib2.Request('http://127.0.0.1:9001/', json.dumps({'batch': batch}), headers)
+      batch_response = json.loads(urllib2.urlopen(req).read())['batch']
+      self.assertEqual(batch_response['a'], batch_response['b'])
+      self.assertNotEqual(batch_response['a']['result']['count'], batch_response['c']['result']['count'])
+      self.assertNotEqual(request(method, {'key': 1}, url=CONCURRENT_URL)['count'], batch_response['a']['result']['count'])
+
+  def test_limit(self):
+    headers = {'content-type': 'application/json'}
+    for method in ('limited.sleep_async', 'limited.sleep_coroutine'):
+      batch = {'a': {'method': method, 'parameters': {'key': 'a'}}, 'b': {'method': method, 'parameters': {'key': 'b'}}, 'c': {'method': method, 'parameters': {'key': 'c'}}}
+      req = urllib2.Request('http://127.0.0.1:9001/', json.dumps({'batch': batch}), headers)
+      batch_response = json.loads(urllib2.urlopen(req).read())['batch']
+      self.assertEqual(batch_response['a']['result']['parameters'], {'key': 'a'})
+      self.assertEqual(batch_response['b']['result']['parameters'], {'key': 'b'})
+      self.assertEqual(batch_response['c']['error']['code'], 1011)
+      batch = {'a': {'method': method, 'parameters': {'sleep': 0.8}}, 'b': {'method': method, 'parameters': {}}}
+      req = urllib2.Request('http://127.0.0.1:9001/', json.dumps({'batch': batch}), headers)
+      batch_response = json.loads(urllib2.urlopen(req).read())['batch']
+      self.assertEqual(batch_response['a']['result']['parameters'], {'sleep': 0.8})
+      self.assertEqual(batch_response['b']['error']['code'], 1011)
+      self.assertEqual(request(method, {'key': 'd'}, url=CONCURRENT_URL)['parameters'], {'key': 'd'})
+    metrics = urllib2.urlopen('http://127.0.0.1:9001/metrics').read()
+    self.assertIn('toto_method_rejected_total{method="limited.sleep_coroutine"} 1\n', metrics)
+    self.assertIn('toto_method_timeouts_total{method="limited.sleep_async"} 1\n', metrics)
+    self.assertIn('toto_method_queued{method="limited.sleep_async"} 0\n', metrics)
@@ -9,9 +9,30 @@ import cPickle as pickle
 from uuid import uuid4
 from toto.secret import *
 from multiprocessing import Process, active_children
-from toto.session import TotoSession, SESSION_ID_LENGTH
+from toto.session import TotoSession, TotoAccount, SESSION_ID_LENGTH
+from toto.jsondbconnection import JSONConnection
 from time import sleep, time
 
+class CountingConnection(JSONConnection):
+
+  session_writes = 0
+
+  def set(self, *args, **kwargs):
+    if args[0] == 'session':
+      self.session_writes += 1
+    return super(CountingConnection, self).set(*args, **kwargs)
+
+class CountingAccount(TotoAccount):
+
+  loads = 0
+
+  def _load_property(self, *args):
+    CountingAccount.loads += 1
+    return {k: 'value of %s' % k for k in args if k != 'missing'}
+
+  def _save_property(self, *args):
+    pass
+
 class TestSession(unittest.TestCase):
 
   def test_generate_id(self):
@@ -84,3 +105,86 @@ class TestSession(unittest.TestCase):
     self.assertEqual(TotoSession.loads(pickle_serialized), session)
     TotoSession.set_serializer(json)
     self.assertEqual(TotoSession.loads(json_serialized), session)
+
+  def test_hmac_chunks(self):
+    session = TotoSession(None, {'session_id': TotoSession.generate_id(), 'expires': time() + 1000.0, 'user_id': 'test@toto.li', 'key': 'secret'})
+    mac = session.hmac('POST/upload' + 'abcdef')
+    self.assertEqual(session.hmac('POST/upload', iter(['abc', 'def'])), mac)
+    self.assertEqual(session.verify(mac, 'POST/upload', ['ab', 'cd', 'ef']), session)
+
+  def test_modified_keys(self):
+    session = TotoSession(None, {'session_id': TotoSession.generate_id(), 'expires': time() + 1000.0, 'user_id': 'test@toto.li', 'state': {'a': 1, 'b': 'b', 'c': [1], 'd': 4}})
+    self.assertEqual(session.modified_keys(), set())
+    self.assertEqual(session['a'], 1)
+    self.assertEqual(session.modified_keys(), set())
+    session['b'] = 'changed'
+    del session['missing']
+    self.assertEqual(session.modified_keys(), set(['b']))
+    session['c'].append(2)
+    session.state['d'] = 5
+    session.state['e'] = 6
+    del session.state['a']
+    self.assertEqual(session.modified_keys(), set(['a', 'b', 'c', 'd', 'e']))
+    session._mark_saved()
+    self.assertEqual(session.modified_keys(), set())
+    session.mark_modified('b')
+    self.assertEqual(session.modified_keys(), set(['b']))
+
+  def test_save_unmodified(self):
+    db = CountingConnection()
+    db.create_account('test@toto.li', 'password')
+    session_id = db.create_session('test@toto.li', 'password').session_id
+    session = db.retrieve_session(session_id)
+    writes = db.session_writes
+    session.save()
+    self.assertEqual(db.session_writes, writes)
+    session['value'] = 'saved'
+    session.save()
+    self.assertEqual(db.session_writes, writes + 1)
+    session.save()
+    self.assertEqual(db.session_writes, writes + 1)
+    self.assertEqual(db.retrieve_session(session_id)['value'], 'saved')
+
+  def test_save_modified_in_place(self):
+    db = CountingConnection()
+    db.create_account('test@toto.li', 'password')
+    session = db.create_session('test@toto.li', 'password')
+    session['cart'] = ['a']
+    session.save()
+    session = db.retrieve_session(session.session_id)
+    writes = db.session_writes
+    session.state['cart'].append('b')
+    session.save()
+    self.assertEqual(db.session_writes, writes + 1)
+    session.save()
+    self.assertEqual(db.session_writes, writes + 1)
+    self.assertEqual(db.retrieve_session(session.session_id)['cart'], ['a', 'b'])
+
+  def test_account_preload(self):
+    session = TotoSession(None, {'session_id': TotoSession.generate_id(), 'expires': time() + 1000.0, 'user_id': 'preload-%s' % uuid4().hex})
+    CountingAccount.loads = 0
+    account = CountingAccount(session).preload(('a', 'b', 'missing'))
+    self.assertEqual(CountingAccount.loads, 1)
+    self.assertEqual(account['a'], 'value of a')
+    self.assertEqual(account['b'], 'value of b')
+    self.assertEqual(account['missing'], None)
+    self.assertEqual(CountingAccount.loads, 1)
+    CountingAccount(session).preload(('a', 'b'))
+    self.assertEqual(CountingAccount.loads, 2)
+
+  def test_account_preload_ttl(self):
+    session = TotoSession(None, {'session_id': TotoSession.generate_id(), 'expires': time() + 1000.0, 'user_id': 'preload-%s' % uuid4().hex})
+    CountingAccount.loads = 0
+    CountingAccount(session).preload(('a', 'b'), ttl=60)
+    account = CountingAccount(session).preload(('a', 'b'), ttl=60)
+    self.assertEqual(CountingAccount.loads, 1)
+    self.assertEqual(account['a'], 'value of a')
+    account['a'] = 'changed'
+    account.save()
+    account = CountingAccount(session).preload(('a', 'c'), ttl=60)
+    self.assertEqual(CountingAccount.loads, 2)
+    self.assertEqual(account['a'], 'changed')
+    self.assertEqual(account['c'], 'value of c')
+    sleep(0.1)
+    CountingAccount(session).preload(('a',), ttl=0.05)
+    self.assertEqual(CountingAccount.loads, 3)
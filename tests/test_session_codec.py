@@ -0,0 +1,66 @@
+import unittest
+import zlib
+import cPickle as pickle
+from datetime import datetime
+from time import time
+from toto.session import TotoSession
+from toto.sessioncodec import SessionCodec, MAGIC, FORMAT_MARSHAL, FORMAT_PICKLE
+
+class TestSessionCodec(unittest.TestCase):
+
+  def test_round_trip(self):
+    codec = SessionCodec()
+    state = {'int': 1268935, 'long': 2 ** 70, 'float': 92385.03, 'str': 'some test', 'unicode': u'\xe9t\xe9', 'tuple': (1, 2), 'list': [None, True, False], 'nested': {'a': {'b': 'c'}}}
+    data = codec.dumps(state)
+    self.assertEqual(data[0], MAGIC)
+    self.assertEqual(ord(data[1]) & 0x07, FORMAT_MARSHAL)
+    loaded = codec.loads(data)
+    self.assertEqual(loaded, state)
+    self.assertTrue(isinstance(loaded['tuple'], tuple))
+    self.assertTrue(isinstance(loaded['unicode'], unicode))
+    self.assertEqual(codec.loads(buffer(data)), state)
+
+  def test_smaller_than_pickle(self):
+    state = {'user_name': 'test', 'visits': 12, 'preferences': {'theme': 'dark', 'notifications': True}}
+    self.assertTrue(len(SessionCodec().dumps(state)) < len(pickle.dumps(state)))
+
+  def test_pickle_fallback(self):
+    codec = SessionCodec()
+    state = {'created': datetime(2014, 6, 1, 12, 30)}
+    data = codec.dumps(state)
+    self.assertEqual(ord(data[1]) & 0x07, FORMAT_PICKLE)
+    self.assertEqual(codec.loads(data), state)
+
+  def test_compression(self):
+    codec = SessionCodec(compress_threshold=100)
+    small = {'a': 'x' * 10}
+    large = {'a': 'x' * 1000}
+    self.assertFalse(ord(codec.dumps(small)[1]) & 0x08)
+    data = codec.dumps(large)
+    self.assertTrue(ord(data[1]) & 0x08)
+    self.assertTrue(len(data) < 100)
+    self.assertEqual(codec.loads(data), large)
+    self.assertFalse(ord(SessionCodec(compress_threshold=None).dumps(large)[1]) & 0x08)
+
+  def test_legacy_pickle(self):
+    codec = SessionCodec()
+    state = {'int': 1, 'str': 'legacy'}
+    self.assertEqual(codec.loads(pickle.dumps(state)), state)
+    self.assertEqual(codec.loads(pickle.dumps(state, pickle.HIGHEST_PROTOCOL)), state)
+    self.assertEqual(codec.loads(buffer(pickle.dumps(state))), state)
+
+  def test_unknown_version(self):
+    with self.assertRaises(ValueError):
+      SessionCodec().loads(MAGIC + chr(0xf1) + 'data')
+
+  def test_session_state_not_double_encoded(self):
+    session_data = {'session_id': TotoSession.generate_id(), 'expires': time() + 1000.0, 'user_id': 'test@toto.li'}
+    session = TotoSession(None, session_data)
+    session['str'] = 'some test'
+    raw = session.session_data(False)
+    self.assertEqual(raw['state'], {'str': 'some test'})
+    new_session = TotoSession(None, TotoSession.loads(TotoSession.dumps(raw)))
+    self.assertEqual(new_session['str'], 'some test')
+    legacy = session.session_data()
+    legacy['state'] = pickle.dumps(session.state)
+    self.assertEqual(TotoSession(None, TotoSession.loads(pickle.dumps(legacy)))['str'], 'some test')
@@ -0,0 +1,58 @@
+import unittest
+from toto.jsondbconnection import JSONConnection
+from time import sleep, time
+
+class CountingConnection(JSONConnection):
+
+  def __init__(self, *args, **kwargs):
+    super(CountingConnection, self).__init__(*args, **kwargs)
+    self.updates = []
+
+  def _update_expiries(self, sessions):
+    self.updates.append(len(sessions))
+    super(CountingConnection, self)._update_expiries(sessions)
+
+  def _update_expiry(self, session_id, session_data):
+    self.updates.append(session_id)
+    super(CountingConnection, self)._update_expiry(session_id, session_data)
+
+class TestSessionExpiry(unittest.TestCase):
+
+  def setUp(self):
+    self.db = CountingConnection(session_ttl=100, session_flush_interval=0.2)
+    self.db.create_account('test@toto.li', 'password')
+
+  def test_deferred_renewal(self):
+    session_ids = [self.db.create_session('test@toto.li', 'password').session_id for i in xrange(3)]
+    for i in xrange(5):
+      for session_id in session_ids:
+        self.db.retrieve_session(session_id)
+    self.assertEqual(self.db.updates, [])
+    sleep(0.3)
+    self.assertEqual(self.db.updates[0], 3)
+    self.assertEqual(sorted(self.db.updates[1:]), sorted(session_ids))
+    self.assertTrue(self.db.get('session', session_ids[0])['expires'] > time() + 99)
+
+  def test_flush(self):
+    session_id = self.db.create_session('test@toto.li', 'password').session_id
+    expires = self.db.retrieve_session(session_id).expires
+    self.db.flush_session_expiries()
+    self.assertEqual(self.db.updates, [1, session_id])
+    self.assertEqual(self.db.get('session', session_id)['expires'], expires)
+    self.db.flush_session_expiries()
+    self.assertEqual(self.db.updates, [1, session_id])
+
+  def test_bounded_staleness(self):
+    db = CountingConnection(session_ttl=0.3, session_flush_interval=0.2)
+    db.create_account('test@toto.li', 'password')
+    session_id = db.create_session('test@toto.li', 'password').session_id
+    db.retrieve_session(session_id)
+    self.assertEqual(db.updates, [session_id])
+
+  def test_remove_pending(self):
+    session_id = self.db.create_session('test@toto.li', 'password').session_id
+    self.db.retrieve_session(session_id)
+    self.db.remove_session(session_id)
+    self.db.flush_session_expiries()
+    self.assertEqual(self.db.updates, [])
+    self.assertFalse(self.db.get('session', session_id))
@@ -0,0 +1,62 @@
+import unittest
+import os
+import json
+import tempfile
+from time import time, sleep
+from tornado.options import options
+from tornado.httputil import HTTPServerRequest
+from toto.slowlog import *
+
+class TestSlowLog(unittest.TestCase):
+
+  def test_phases(self):
+    phases = RequestPhases(time() - 0.01)
+    phases.record('session', time() - 0.005)
+    phases.record('worker', time(), 'mail.send')
+    entries = phases.to_list()
+    self.assertEqual([e['phase'] for e in entries], ['session', 'worker'])
+    self.assertTrue(entries[0]['duration_ms'] >= 5)
+    self.assertTrue(entries[1]['offset_ms'] >= 10)
+    self.assertEqual(entries[1]['detail'], 'mail.send')
+    self.assertFalse('detail' in entries[0])
+
+  def test_context(self):
+    self.assertEqual(phase_recorder('db'), None)
+    callback = lambda: 'called'
+    self.assertTrue(timed_callback('worker', 'test', callback) is callback)
+    phases = RequestPhases(time())
+    with phases_context(phases):
+      record = phase_recorder('db', 'retrieve_session')
+      timed = timed_callback('worker', 'test', callback)
+    self.assertEqual(current_phases(), None)
+    record(None)
+    self.assertEqual(timed(), 'called')
+    self.assertEqual([(p[0], p[3]) for p in phases.phases], [('db', 'retrieve_session'), ('worker', 'test')])
+
+  def test_log(self):
+    path = os.path.join(tempfile.gettempdir(), 'toto-test-slowlog.log')
+    if os.path.exists(path):
+      os.remove(path)
+    options.slow_request_log = path
+    options.slow_request_threshold = 0.01
+    log = SlowRequestLog()
+    log.open()
+    fast = RequestPhases(time())
+    log.log(HTTPServerRequest(uri='/fast'), 200, fast)
+    slow = RequestPhases(time() - 1)
+    slow.method = 'test.slow'
+    slow.record('method', slow.start, 'test.slow')
+    log.log(HTTPServerRequest(uri='/slow'), 200, slow)
+    for i in xrange(20):
+      if os.path.exists(path) and os.path.getsize(path):
+        break
+      sleep(0.05)
+    sleep(0.05)
+    with open(path) as f:
+      entries = [json.loads(line) for line in f]
+    self.assertEqual(len(entries), 1)
+    self.assertEqual(entries[0]['uri'], '/slow')
+    self.assertEqual(entries[0]['method'], 'test.slow')
+    self.assertTrue(entries[0]['duration_ms'] >= 1000)
+    self.assertEqual(entries[0]['phases'][0]['phase'], 'method')
+    os.remove(path)
@@ -0,0 +1,109 @@
+import unittest
+import os
+import json
+import tempfile
+from time import sleep
+from toto.tracing import *
+from toto.workerconnection import WorkerConnection
+from tornado.ioloop import IOLoop
+
+class ListExporter(object):
+
+  def __init__(self):
+    self.spans = []
+
+  def export(self, spans):
+    self.spans.extend(spans)
+
+class TestTracing(unittest.TestCase):
+
+  def test_spans(self):
+    tracer = Tracer(buffer_size=2)
+    root = tracer.start_span('root')
+    self.assertEqual(start_child_span('orphan'), None)
+    with span_context(root):
+      self.assertTrue(current_span() is root)
+      child = start_child_span('child', key='value')
+      self.assertEqual(trace_context(), {'trace_id': root.trace_id, 'parent_id': root.span_id})
+    self.assertEqual(current_span(), None)
+    self.assertEqual(child.trace_id, root.trace_id)
+    self.assertEqual(child.parent_id, root.span_id)
+    self.assertEqual(child.tags, {'key': 'value'})
+    child.finish(Exception('failed'))
+    child.finish()
+    root.finish()
+    self.assertEqual(tracer.spans(), [child, root])
+    self.assertEqual(child.to_dict()['error'], repr(Exception('failed')))
+    tracer.start_span('other').finish()
+    self.assertEqual(len(tracer.spans()), 2)
+    self.assertEqual(tracer.spans(root.trace_id), [root])
+
+  def test_continue_trace(self):
+    tracer = Tracer()
+    span = tracer.start_span('worker.test')
+    message = WorkerConnection()._message('test', {}, span=span)
+    task = tracer.continue_trace('task.test', message['trace'])
+    self.assertEqual(task.trace_id, span.trace_id)
+    self.assertEqual(task.parent_id, span.span_id)
+    self.assertEqual(tracer.continue_trace('task.test', None).parent_id, None)
+    self.assertFalse('trace' in WorkerConnection()._message('test', {}))
+
+  def test_finish_callback(self):
+    tracer = Tracer()
+    span = tracer.start_span('call')
+    callback = finish_callback(span, lambda response: response)
+    self.assertFalse(span.finished)
+    self.assertEqual(callback('response'), 'response')
+    self.assertTrue(span.finished)
+    span = tracer.start_span('send')
+    self.assertEqual(finish_callback(span, None), None)
+    self.assertTrue(span.finished)
+
+  def test_json_exporter(self):
+    path = os.path.join(tempfile.gettempdir(), 'toto-test-tracing.log')
+    if os.path.exists(path):
+      os.remove(path)
+    tracer = Tracer(export_interval=0)
+    tracer.set_exporter(JSONFileExporter(path))
+    span = tracer.start_span('test')
+    span.finish()
+    for i in xrange(20):
+      if os.path.exists(path):
+        break
+      sleep(0.05)
+    sleep(0.05)
+    with open(path) as f:
+      spans = [json.loads(line) for line in f]
+    self.assertEqual(spans, [span.to_dict()])
+    os.remove(path)
+
+  def test_periodic_export(self):
+    tracer = Tracer(export_interval=0.05)
+    exporter = ListExporter()
+    tracer.set_exporter(exporter)
+    span = tracer.start_span('test')
+    span.finish()
+    self.assertEqual(exporter.spans, [])
+    io_loop = IOLoop()
+    io_loop.make_current()
+    tracer.start_exporting()
+    io_loop.call_later(0.2, io_loop.stop)
+    io_loop.start()
+    tracer.close()
+    io_loop.close()
+    for i in xrange(20):
+      if exporter.spans:
+        break
+      sleep(0.05)
+    self.assertEqual(exporter.spans, [span])
+
+  def test_close(self):
+    tracer = Tracer(export_interval=60)
+    exporter = ListExporter()
+    tracer.set_exporter(exporter)
+    spans = [tracer.start_span('test') for i in xrange(3)]
+    for span in spans:
+      span.finish()
+    self.assertEqual(exporter.spans, [])
+    tracer.close()
+    self.assertEqual(exporter.spans, spans)
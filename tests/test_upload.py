@@ -0,0 +1,75 @@
+import unittest
+import urllib2
+import json
+from hashlib import md5
+from multiprocessing import Process
+from toto.server import TotoServer
+from toto.upload import MultipartParser
+from time import sleep
+from util import *
+
+def run_server(processes=1, daemon='start'):
+  TotoServer(method_module='web_methods', port=9000, debug=True, processes=processes, daemon=daemon, pidfile='server.pid', stream_uploads=True, upload_spool_size=1024).run()
+
+def multipart(boundary, fields, files):
+  parts = []
+  for name, value in fields:
+    parts.append('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' % (boundary, name, value))
+  for name, filename, content_type, body in files:
+    parts.append('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: %s\r\n\r\n%s\r\n' % (boundary, name, filename, content_type, body))
+  return ''.join(parts) + '--%s--\r\n' % boundary
+
+class TestUpload(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    Process(target=run_server, args=[1]).start()
+    sleep(0.5)
+
+  @classmethod
+  def tearDownClass(cls):
+    Process(target=run_server, args=[1, 'stop']).start()
+    sleep(0.5)
+
+  def test_parser(self):
+    body = multipart('xyz', [('a', '1'), ('a', '2')], [('f', 'f.txt', 'text/plain', 'hello\r\n--xy world')])
+    parser = MultipartParser('xyz', 1024)
+    for c in body:
+      parser.write(c)
+    parser.close()
+    self.assertEqual(parser.arguments, {'a': ['1', '2']})
+    upload = parser.files['f'][0]
+    self.assertEqual((upload.filename, upload.content_type, upload.size), ('f.txt', 'text/plain', 17))
+    self.assertEqual(upload.file.read(), 'hello\r\n--xy world')
+
+  def test_multipart(self):
+    large = 'x' * 5000
+    body = multipart('boundary42', [('name', 'value')], [('image', 'small.png', 'image/png', 'small'), ('image', 'large.bin', 'application/octet-stream', large)])
+    req = urllib2.Request('http://127.0.0.1:9000/upload/files?q=1', body, {'content-type': 'multipart/form-data; boundary=boundary42'})
+    result = json.loads(urllib2.urlopen(req).read())['result']
+    self.assertEqual(result['arguments'], {'name': ['value'], 'q': ['1']})
+    small, large_file = result['files']['image']
+    self.assertEqual((small['filename'], small['content_type'], small['size'], small['body']), ('small.png', 'image/png', 5, 'small'))
+    self.assertEqual((large_file['filename'], large_file['size'], large_file['body']), ('large.bin', 5000, large))
+
+  def test_body(self):
+    body = ''.join(chr(i % 256) for i in xrange(3000))
+    req = urllib2.Request('http://127.0.0.1:9000/upload/body?q=1', body, {'content-type': 'image/jpeg'})
+    result = json.loads(urllib2.urlopen(req).read())['result']
+    self.assertEqual(result, {'content_type': 'image/jpeg', 'size': 3000, 'md5': md5(body).hexdigest(), 'arguments': {'q': ['1']}})
+
+  def test_max_body_size(self):
+    req = urllib2.Request('http://127.0.0.1:9000/upload/body', 'x' * 5000, {'content-type': 'image/jpeg'})
+    with self.assertRaises(urllib2.HTTPError) as context:
+      urllib2.urlopen(req)
+    self.assertEqual(context.exception.code, 413)
+
+  def test_get_with_body(self):
+    req = urllib2.Request('http://127.0.0.1:9000/return_value?a=1', 'ignored', {'content-type': 'application/json'})
+    req.get_method = lambda: 'GET'
+    self.assertEqual(json.loads(urllib2.urlopen(req).read())['result']['parameters'], {'a': '1'})
+
+  def test_codec_body(self):
+    self.assertEqual(request('return_value', {'a': 1})['parameters'], {'a': 1})
+    req = urllib2.Request('http://127.0.0.1:9000/return_value', 'a=1&b=2', {'content-type': 'application/x-www-form-urlencoded'})
+    self.assertEqual(json.loads(urllib2.urlopen(req).read())['result']['parameters'], {'a': ['1'], 'b': ['2']})
@@ -7,7 +7,7 @@ from copy import copy
 
 SERVICE_URL = 'http://127.0.0.1:9000/'
 
-def request(method, parameters, headers={}, preprocessor=None, response_key='result', return_headers=None):
+def request(method, parameters, headers={}, preprocessor=None, response_key='result', return_headers=None, url=SERVICE_URL):
   request = {}
   request['method'] = method
   request['parameters'] = parameters
@@ -16,7 +16,7 @@ def request(method, parameters, headers={}, preprocessor=None, response_key='res
     preprocessor(body)
   headers = copy(headers)
   headers['content-type'] = 'application/json'
-  req = urllib2.Request(SERVICE_URL, body, headers)
+  req = urllib2.Request(url, body, headers)
   f = urllib2.urlopen(req)
   r = json.loads(f.read())
   if response_key:
@@ -12,3 +12,17 @@ import throw_exception_task_coroutine
 import test
 import account
 import verify_session
+import verify_session_coroutine
+import cached
+import return_raw
+import coalesced
+import limited
+import timeouts
+import warm
+import stream
+import upload
+import send_file
+import etags
+import rate_limited
+import profiled
+import preloaded_account
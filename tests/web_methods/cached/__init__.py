@@ -0,0 +1,7 @@
+import counter
+import counter_async
+import counter_coroutine
+import counter_serialized
+import invalidate
+import counter_user
+import counter_user_unloaded
@@ -0,0 +1,8 @@
+from toto.invocation import *
+from itertools import count
+
+calls = count()
+
+@cached(ttl=10)
+def invoke(handler, parameters):
+  return {'parameters': parameters, 'count': calls.next()}
@@ -0,0 +1,11 @@
+from toto.invocation import *
+from tornado.ioloop import IOLoop
+from itertools import count
+
+calls = count()
+
+@cached(ttl=10)
+@asynchronous
+def invoke(handler, parameters):
+  result = {'parameters': parameters, 'count': calls.next()}
+  IOLoop.instance().add_callback(lambda: handler.respond(result))
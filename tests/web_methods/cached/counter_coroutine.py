@@ -0,0 +1,11 @@
+from toto.invocation import *
+from tornado.gen import coroutine, Return, moment
+from itertools import count
+
+calls = count()
+
+@cached(ttl=10, key=lambda parameters: parameters.get('key'))
+@coroutine
+def invoke(handler, parameters):
+  yield moment
+  raise Return({'parameters': parameters, 'count': calls.next()})
@@ -0,0 +1,9 @@
+from toto.invocation import *
+from itertools import count
+
+calls = count()
+
+@optionally_authenticated
+@cached(ttl=10, scope='user')
+def invoke(handler, parameters):
+  return {'user_id': handler.session and handler.session.user_id, 'count': calls.next()}
@@ -0,0 +1,9 @@
+from toto.invocation import *
+from itertools import count
+
+calls = count()
+
+@cached(ttl=10, scope='user')
+@optionally_authenticated
+def invoke(handler, parameters):
+  return {'user_id': handler.session and handler.session.user_id, 'count': calls.next()}
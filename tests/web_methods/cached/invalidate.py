@@ -0,0 +1,6 @@
+from toto.invocation import *
+import counter
+
+def invoke(handler, parameters):
+  counter.invoke.invalidate(parameters.get('parameters'))
+  return {'invalidated': True}
@@ -0,0 +1,3 @@
+import counter_async
+import counter_coroutine
+import no_response
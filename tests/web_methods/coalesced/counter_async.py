@@ -0,0 +1,11 @@
+from toto.invocation import *
+from tornado.ioloop import IOLoop
+from itertools import count
+
+calls = count()
+
+@coalesce()
+@asynchronous
+def invoke(handler, parameters):
+  result = {'parameters': parameters, 'count': calls.next()}
+  IOLoop.instance().call_later(0.1, lambda: handler.respond(result))
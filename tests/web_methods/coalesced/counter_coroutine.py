@@ -0,0 +1,11 @@
+from toto.invocation import *
+from tornado.gen import coroutine, Return, sleep
+from itertools import count
+
+calls = count()
+
+@coalesce(key=lambda parameters: parameters.get('key'))
+@coroutine
+def invoke(handler, parameters):
+  yield sleep(0.1)
+  raise Return({'parameters': parameters, 'count': calls.next()})
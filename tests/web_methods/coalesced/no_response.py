@@ -0,0 +1,8 @@
+from toto.invocation import *
+from tornado.ioloop import IOLoop
+
+@coalesce(key=lambda parameters: parameters.get('key'), timeout=0.5)
+@asynchronous
+def invoke(handler, parameters):
+  if parameters.get('respond'):
+    IOLoop.instance().call_later(0.1, lambda: handler.respond({'parameters': parameters}))
@@ -0,0 +1,3 @@
+import body
+import version
+import version_coroutine
@@ -0,0 +1,5 @@
+from toto.invocation import *
+
+@etag()
+def invoke(handler, parameters):
+  return {'parameters': parameters}
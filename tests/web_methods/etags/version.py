@@ -0,0 +1,8 @@
+from toto.invocation import *
+from itertools import count
+
+calls = count()
+
+@etag(lambda handler, parameters: parameters.get('version'))
+def invoke(handler, parameters):
+  return {'parameters': parameters, 'count': calls.next()}
@@ -0,0 +1,16 @@
+from toto.invocation import *
+from tornado.gen import coroutine, Return, moment
+from itertools import count
+
+calls = count()
+
+@coroutine
+def get_version(handler, parameters):
+  yield moment
+  raise Return(parameters.get('version'))
+
+@etag(get_version)
+@coroutine
+def invoke(handler, parameters):
+  yield moment
+  raise Return({'parameters': parameters, 'count': calls.next()})
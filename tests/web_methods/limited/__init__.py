@@ -0,0 +1,3 @@
+import sleep_async
+import sleep_coroutine
+import raw_async
@@ -0,0 +1,7 @@
+from toto.invocation import *
+from tornado.ioloop import IOLoop
+
+@limit(concurrency=1)
+@asynchronous
+def invoke(handler, parameters):
+  IOLoop.instance().add_callback(lambda: handler.respond_raw('done', 'text/plain'))
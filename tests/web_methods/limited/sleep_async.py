@@ -0,0 +1,7 @@
+from toto.invocation import *
+from tornado.ioloop import IOLoop
+
+@limit(concurrency=1, queue=1, timeout=0.5)
+@asynchronous
+def invoke(handler, parameters):
+  IOLoop.instance().call_later(parameters.get('sleep', 0.2), lambda: handler.respond({'parameters': parameters}))
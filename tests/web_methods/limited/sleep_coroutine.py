@@ -0,0 +1,8 @@
+from toto.invocation import *
+from tornado.gen import coroutine, Return, sleep
+
+@limit(concurrency=1, queue=1, timeout=0.5)
+@coroutine
+def invoke(handler, parameters):
+  yield sleep(parameters.get('sleep', 0.2))
+  raise Return({'parameters': parameters})
@@ -0,0 +1,9 @@
+from toto.invocation import *
+from tornado.gen import coroutine, Return
+
+@authenticated
+@preload_account('name', 'email')
+@coroutine
+def invoke(handler, parameters):
+  account = handler.session.get_account()
+  raise Return({'loaded': sorted(account), 'name': account['name'], 'email': account['email']})
@@ -0,0 +1,11 @@
+from toto.invocation import *
+from time import time
+
+def spin(duration):
+  end = time() + duration
+  while time() < end:
+    pass
+
+def invoke(handler, parameters):
+  spin(float(parameters['duration']))
+  return {'spun': True}
@@ -0,0 +1,5 @@
+from toto.invocation import *
+
+@rate_limit(rate=0.01, burst=2, key=lambda handler, parameters: parameters['client'])
+def invoke(handler, parameters):
+  return {'client': parameters['client']}
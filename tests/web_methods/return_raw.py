@@ -0,0 +1,6 @@
+from toto.invocation import *
+
+@raw_response
+def invoke(handler, parameters):
+  handler.response_type = 'text/plain'
+  return 'raw:%s' % parameters['value']
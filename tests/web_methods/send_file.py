@@ -0,0 +1,10 @@
+from toto.invocation import *
+from tornado.gen import coroutine, Return, moment
+
+@file_response
+@coroutine
+def invoke(handler, parameters):
+  yield moment
+  if 'content_type' in parameters:
+    handler.response_type = parameters['content_type']
+  raise Return(parameters['path'])
@@ -0,0 +1,3 @@
+import items
+import error
+import values
@@ -0,0 +1,6 @@
+from toto.invocation import *
+from toto.exceptions import *
+
+def invoke(handler, parameters):
+  yield {'i': 0}
+  raise TotoException(4242, 'Stream error')
@@ -0,0 +1,15 @@
+from toto.invocation import *
+from tornado.gen import sleep, coroutine, Return
+
+@coroutine
+def delayed(i):
+  yield sleep(0)
+  raise Return({'i': i, 'delayed': True})
+
+def invoke(handler, parameters):
+  padding = 'x' * int(parameters.get('padding', 0))
+  for i in xrange(int(parameters['count'])):
+    if i % 2:
+      yield delayed(i)
+    else:
+      yield {'i': i, 'padding': padding}
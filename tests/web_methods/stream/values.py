@@ -0,0 +1,5 @@
+from toto.invocation import *
+
+@asynchronous
+def invoke(handler, parameters):
+  handler.respond_stream([{'i': i} for i in xrange(int(parameters['count']))])
@@ -0,0 +1,2 @@
+import default
+import sleep
@@ -0,0 +1,8 @@
+from toto.invocation import *
+from tornado.gen import coroutine, Return, sleep
+
+@deadline(0.2)
+@coroutine
+def invoke(handler, parameters):
+  yield sleep(parameters['sleep'])
+  raise Return({'parameters': parameters})
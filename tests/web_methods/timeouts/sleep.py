@@ -0,0 +1,9 @@
+from toto.invocation import *
+from toto.deadline import current_deadline
+from tornado.gen import coroutine, Return, sleep
+from time import time
+
+@coroutine
+def invoke(handler, parameters):
+  yield sleep(parameters['sleep'])
+  raise Return({'remaining': handler.deadline and handler.deadline - time(), 'current': current_deadline() == handler.deadline})
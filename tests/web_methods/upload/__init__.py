@@ -0,0 +1,2 @@
+import files
+import body
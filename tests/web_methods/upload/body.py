@@ -0,0 +1,7 @@
+from toto.invocation import *
+from hashlib import md5
+
+@max_body_size(4096)
+def invoke(handler, parameters):
+  upload = parameters['file']
+  return {'content_type': upload.content_type, 'size': upload.size, 'md5': md5(upload.file.read()).hexdigest(), 'arguments': parameters['arguments']}
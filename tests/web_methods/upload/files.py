@@ -0,0 +1,7 @@
+from toto.invocation import *
+
+def invoke(handler, parameters):
+  files = {}
+  for name, uploads in parameters['files'].iteritems():
+    files[name] = [{'filename': f.filename, 'content_type': f.content_type, 'size': f.size, 'body': f.file.read()} for f in uploads]
+  return {'arguments': parameters['arguments'], 'files': files}
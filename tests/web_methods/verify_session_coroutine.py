@@ -0,0 +1,7 @@
+from toto.invocation import *
+from tornado.gen import coroutine, Return
+
+@authenticated
+@coroutine
+def invoke(handler, parameters):
+  raise Return({'parameters': parameters, 'user_id': handler.session.user_id})
@@ -0,0 +1,9 @@
+from toto.invocation import *
+
+warmed_up = []
+
+def warmup(db_connection):
+  warmed_up.append(db_connection is not None)
+
+def invoke(handler, parameters):
+  return {'warmed_up': warmed_up}
@@ -0,0 +1,70 @@
+'''Simple in-process caches used by Toto to avoid repeated work within a single server process.
+'''
+
+from collections import OrderedDict
+from threading import RLock
+from time import time
+
+class LRUCache(object):
+  '''A thread safe, size bounded ``dict``-like cache. Once ``max_size`` items have been stored the least
+  recently used items will be evicted to make room for new ones. If ``ttl`` is set, items will expire
+  ``ttl`` seconds after they were stored. ``ttl`` may also be set per item by passing it to ``set()``.
+
+  Set ``max_size`` to ``0`` to allow the cache to grow without bound.
+  '''
+
+  def __init__(self, max_size=1000, ttl=None):
+    self.max_size = max_size
+    self.ttl = ttl
+    self._items = OrderedDict()
+    self._lock = RLock()
+
+  def get(self, key, default=None):
+    '''Return the value stored at ``key`` or ``default`` if the key is missing or has expired.
+    '''
+    with self._lock:
+      item = self._items.pop(key, None)
+      if not item:
+        return default
+      if item[0] and item[0] < time():
+        return default
+      self._items[key] = item
+      return item[1]
+
+  def set(self, key, value, ttl=None):
+    '''Store ``value`` at ``key``, optionally overriding the cache's ``ttl``.
+    '''
+    ttl = ttl or self.ttl
+    with self._lock:
+      self._items.pop(key, None)
+      self._items[key] = (ttl and time() + ttl or 0, value)
+      while self.max_size and len(self._items) > self.max_size:
+        self._items.popitem(last=False)
+
+  def remove(self, key):
+    '''Remove ``key`` from the cache. Returns the removed value or ``None``.
+    '''
+    with self._lock:
+      item = self._items.pop(key, None)
+      return item and item[1]
+
+  def remove_where(self, predicate):
+    '''Remove every item for which ``predicate(key, value)`` returns ``True``. Returns the list of removed keys.
+    '''
+    with self._lock:
+      keys = [k for k, v in self._items.iteritems() if predicate(k, v[1])]
+      for k in keys:
+        del self._items[k]
+      return keys
+
+  def clear(self):
+    '''Remove all items from the cache.
+    '''
+    with self._lock:
+      self._items.clear()
+
+  def __contains__(self, key):
+    return self.get(key, self) is not self
+
+  def __len__(self):
+    return len(self._items)
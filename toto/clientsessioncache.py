@@ -48,6 +48,8 @@ class ClientCache(TotoSessionCache):
      the reverse ``decrypt(data)`` both accepting and returning ``str`` objects.
   '''
 
+  encode_state = False
+
   def __init__(self, cipher, hmac_key):
     self.cipher = cipher
     self.hmac_key = hmac_key
@@ -67,7 +69,7 @@ class ClientCache(TotoSessionCache):
     if self.hmac(encrypted) != raw[-HMAC_SIZE:]:
       raise TotoException(-1, 'Invalid session HMAC')
     data = self.cipher.decrypt(encrypted)
-    session_data = TotoSession.loads(data[PREFIX_PADDING_SIZE:])
+    session_data = TotoSession.loads(buffer(data, PREFIX_PADDING_SIZE))
     session_data['session_id'] = session_id
     return session_data
 
@@ -0,0 +1,38 @@
+'''Response compression helpers used by ``TotoHandler`` when the ``compress_responses`` option is enabled.
+'''
+
+import zlib
+
+_encodings = ('gzip', 'deflate')
+
+def negotiate_encoding(accept_encoding):
+  '''Returns "gzip" or "deflate" according to the given "accept-encoding" header value and its quality values, or
+  ``None`` if neither is acceptable. "gzip" is preferred if both are equally acceptable.
+  '''
+  if not accept_encoding:
+    return None
+  best_q = 0
+  encoding = None
+  for accepted in accept_encoding.split(','):
+    params = accepted.split(';')
+    candidate = params[0].strip().lower()
+    if candidate not in _encodings:
+      continue
+    q = 1.0
+    for param in params[1:]:
+      name, _, value = param.partition('=')
+      if name.strip() == 'q':
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0
+    if q > best_q or (q and q == best_q and candidate == 'gzip'):
+      best_q = q
+      encoding = candidate
+  return encoding
+
+def compress(data, encoding, level=6):
+  '''Compress ``data`` with the given ``encoding`` ("gzip" or "deflate") at the given compression ``level`` (1-9).
+  '''
+  compressor = zlib.compressobj(level, zlib.DEFLATED, encoding == 'gzip' and 16 + zlib.MAX_WBITS or zlib.MAX_WBITS)
+  return compressor.compress(data) + compressor.flush()
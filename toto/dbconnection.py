@@ -4,7 +4,14 @@ import toto.secret as secret
 from time import time
 import random
 import string
-from toto.tasks import InstancePool
+from toto.tasks import TaskQueue, InstancePool
+from toto.slowlog import phase_recorder
+from tornado.gen import coroutine, Return
+from threading import Thread, Lock
+from time import sleep
+import atexit
+import logging
+import traceback
 
 class DBConnection(object):
   '''Toto uses subclasses of DBConnection to support session and account storage as well as general
@@ -18,15 +25,28 @@ class DBConnection(object):
     * ``toto.postgresconnection.PostgresConnection``
     * ``toto.redisconnection.RedisConnection``
     * ``toto.jsondbconnection.JSONConnection`` (For debugging only)
+
+    If ``session_flush_interval`` is set, session expiry renewals will be held in memory and written to the
+    database (or session cache) in bulk every ``session_flush_interval`` seconds instead of on every request.
+    A renewal is only deferred if the previously stored expiry is more than two intervals away, so a
+    session will never expire in storage while its renewal is pending. Call ``flush_session_expiries()``
+    to write pending renewals immediately, e.g. before shutting down.
   '''
 
   _session_cache = None
+  _local_session_cache = None
+
+  expiry_batch_size = 1000
 
-  def __init__(self, session_ttl=24*60*60*365, anon_session_ttl=24*60*60, session_renew=0, anon_session_renew=0, *args, **kwargs):
+  def __init__(self, session_ttl=24*60*60*365, anon_session_ttl=24*60*60, session_renew=0, anon_session_renew=0, session_flush_interval=0, *args, **kwargs):
     self.session_ttl = session_ttl
     self.anon_session_ttl = anon_session_ttl or self.session_ttl
     self.session_renew = session_renew or self.session_ttl
     self.anon_session_renew = anon_session_renew or self.anon_session_ttl
+    self.session_flush_interval = session_flush_interval
+    self._pending_expiries = {}
+    self._pending_expiry_lock = Lock()
+    self._flush_thread = None
 
   def create_account(self, user_id, password, additional_values={}, **values):
     '''Create an account for the given ``user_id`` and ``password``. Optionally set additional account
@@ -35,15 +55,39 @@ class DBConnection(object):
       Note: if your database uses a predefined schema, make sure to create the appropriate columns
       before passing additional arguments to ``create_account``.
     '''
+    user_id = self._verify_new_user_id(user_id)
+    values.update(additional_values)
+    self._store_new_account(user_id, secret.password_hash(password), values)
+
+  @coroutine
+  def create_account_async(self, user_id, password, additional_values={}, **values):
+    '''Like ``create_account`` but database access happens in a ``TaskQueue`` and the password is hashed with
+    ``toto.secret.password_hash_async()`` so the calling ``IOLoop`` is not blocked. Returns a ``Future``. Must be called
+    from a Tornado ``IOLoop``.
+    '''
+    user_id = yield self._run_session_task(self._verify_new_user_id, user_id)
+    values.update(additional_values)
+    hashed_password = yield secret.password_hash_async(password)
+    yield self._run_session_task(self._store_new_account, user_id, hashed_password, values)
+
+  def _normalize_user_id(self, user_id):
+    '''Returns ``user_id`` as it is stored in the database. User IDs are case insensitive by default, so they are
+    lowercased before being stored or looked up.
+    '''
+    return user_id.lower()
+
+  def _verify_new_user_id(self, user_id):
     if not user_id:
       raise TotoException(ERROR_INVALID_USER_ID, "Invalid user ID.")
-    user_id = user_id.lower()
+    user_id = self._normalize_user_id(user_id)
     account = self._get_account(user_id)
     if account:
       raise TotoException(ERROR_USER_ID_EXISTS, "User ID already in use.")
-    values.update(additional_values)
+    return user_id
+
+  def _store_new_account(self, user_id, hashed_password, values):
     values['user_id'] = user_id
-    values['password'] = secret.password_hash(password)
+    values['password'] = hashed_password
     self._store_account(user_id, values)
 
   def create_session(self, user_id=None, password=None, verify_password=True, key=None):
@@ -53,12 +97,13 @@ class DBConnection(object):
       without checking the password. This feature can be used to implement alternative authentication
       methods like Facebook, Twitter or Google+.
     '''
-    if not user_id:
-      user_id = ''
-    user_id = user_id.lower()
+    user_id = self._normalize_user_id(user_id or '')
     account = user_id and self._get_account(user_id)
     if user_id and (not account or (verify_password and not secret.verify_password(password, account['password']))):
       raise TotoException(ERROR_USER_NOT_FOUND, "Invalid user ID or password")
+    return self._new_session(user_id, account, key)
+
+  def _new_session(self, user_id, account, key):
     session_id = TotoSession.generate_id()
     expires = time() + (user_id and self.session_ttl or self.anon_session_ttl)
     session_data = {'user_id': user_id, 'expires': expires, 'session_id': session_id}
@@ -67,8 +112,7 @@ class DBConnection(object):
     self._prepare_session(account, session_data)
     if not self._cache_session_data(session_data):
       self._store_session(session_id, session_data)
-    session = self._instantiate_session(session_data, self._session_cache)
-    return session
+    return self._create_session_instance(session_data)
 
   def retrieve_session(self, session_id):
     '''Retrieve an existing session with the given ``session_id``. This method returns a
@@ -76,34 +120,68 @@ class DBConnection(object):
 
     The use of HTTPS is strongly recommended for any communication involving sensitive information.
     '''
-    session_data = self._load_session_data(session_id)
+    now = time()
+    local_data = self._local_session_cache and self._local_session_cache.load_session(session_id)
+    session_data = local_data or self._load_session_data(session_id)
     if not session_data:
       return None
     user_id = session_data['user_id']
-    expires = time() + (user_id and self.session_renew or self.anon_session_renew)
+    expires = now + (user_id and self.session_renew or self.anon_session_renew)
     if session_data['expires'] < expires:
+      previous_expires = session_data['expires']
       session_data['expires'] = expires
-      if not self._cache_session_data(session_data):
-        self._update_expiry(session_id, session_data)
-    session = self._instantiate_session(session_data, self._session_cache)
-    return session
+      if not self._defer_expiry(session_data, previous_expires):
+        if not self._cache_session_data(session_data):
+          self._update_expiry(session_id, session_data)
+    return self._create_session_instance(session_data, not local_data)
+
+  @coroutine
+  def create_session_async(self, user_id=None, password=None, verify_password=True, key=None):
+    '''Like ``create_session`` but the session is created in a ``TaskQueue`` and the password is verified with
+      ``toto.secret.verify_password_async()`` so the calling ``IOLoop`` is not blocked. Returns a ``Future`` that will
+      resolve to the new session. Must be called from a Tornado ``IOLoop``.
+    '''
+    user_id = self._normalize_user_id(user_id or '')
+    account = user_id and (yield self._run_session_task(self._get_account, user_id))
+    if user_id and (not account or (verify_password and not (yield secret.verify_password_async(password, account['password'])))):
+      raise TotoException(ERROR_USER_NOT_FOUND, "Invalid user ID or password")
+    raise Return((yield self._run_session_task(self._new_session, user_id, account, key)))
+
+  def retrieve_session_async(self, session_id):
+    '''Like ``retrieve_session`` but the session is loaded in a ``TaskQueue`` so the calling ``IOLoop`` is not blocked while
+    waiting for the database. Returns a ``Future`` that will resolve to the session, or ``None`` if no matching session exists.
+    Must be called from a Tornado ``IOLoop``.
+    '''
+    return self._run_session_task(self.retrieve_session, session_id)
 
   def change_password(self, user_id, password, new_password):
     '''Updates the password for the account with the given ``user_id`` and ``password`` to match
     ``new_password`` for all future requests.
     '''
-    user_id = user_id.lower()
+    user_id = self._normalize_user_id(user_id)
     account = self._get_account(user_id)
     if not account or not secret.verify_password(password, account['password']):
       raise TotoException(ERROR_USER_NOT_FOUND, "Invalid user ID or password")
     self._update_password(user_id, account, secret.password_hash(new_password))
 
+  @coroutine
+  def change_password_async(self, user_id, password, new_password):
+    '''Like ``change_password`` but database access happens in a ``TaskQueue`` and passwords are hashed and verified with
+    ``toto.secret`` so the calling ``IOLoop`` is not blocked. Returns a ``Future``. Must be called from a Tornado ``IOLoop``.
+    '''
+    user_id = self._normalize_user_id(user_id)
+    account = yield self._run_session_task(self._get_account, user_id)
+    if not account or not (yield secret.verify_password_async(password, account['password'])):
+      raise TotoException(ERROR_USER_NOT_FOUND, "Invalid user ID or password")
+    hashed_password = yield secret.password_hash_async(new_password)
+    yield self._run_session_task(self._update_password, user_id, account, hashed_password)
+
   def generate_password(self, user_id):
     '''Generates a new password for the account with the given ``user_id`` and makes it active
     for all future requests. The new password will be returned. This method is designed to
     support "forgot password" functionality.
     '''
-    user_id = user_id.lower()
+    user_id = self._normalize_user_id(user_id)
     account = self._get_account(user_id)
     if not account:
       raise TotoException(ERROR_USER_NOT_FOUND, "Invalid user ID")
@@ -115,11 +193,67 @@ class DBConnection(object):
   def remove_session(self, session_id):
     '''Invalidate the session with the given ``session_id``.
     '''
+    if self._local_session_cache:
+      self._local_session_cache.remove_session(session_id)
+    if self._pending_expiries:
+      with self._pending_expiry_lock:
+        self._pending_expiries.pop(session_id, None)
     if self._session_cache:
       self._session_cache.remove_session(session_id)
     else:
       self._remove_session(session_id)
 
+  def flush_session_expiries(self):
+    '''Write all pending session expiry renewals to the database or session cache. Only needed if ``session_flush_interval``
+    is set, in which case this method is called periodically on a background thread and before the server shuts down.
+    '''
+    with self._pending_expiry_lock:
+      if not self._pending_expiries:
+        return
+      sessions, self._pending_expiries = self._pending_expiries.values(), {}
+    session_cache = self._session_cache
+    for i in xrange(0, len(sessions), self.expiry_batch_size):
+      try:
+        if session_cache:
+          session_cache.update_expiries(sessions[i:i + self.expiry_batch_size])
+        else:
+          self._update_expiries(sessions[i:i + self.expiry_batch_size])
+      except Exception as e:
+        logging.error(traceback.format_exc())
+
+  def _defer_expiry(self, session_data, previous_expires):
+    '''Called by ``DBConnection.retrieve_session`` to queue the renewal of ``session_data['expires']`` for the next flush.
+    Returns ``False`` if the renewal must be written immediately.
+    '''
+    if not self.session_flush_interval or previous_expires - time() <= 2 * self.session_flush_interval:
+      return False
+    if self._session_cache and not hasattr(self._session_cache, 'update_expiries'):
+      return False
+    with self._pending_expiry_lock:
+      self._pending_expiries[session_data['session_id']] = session_data
+      if not self._flush_thread:
+        self._flush_thread = Thread(target=self._flush_expiries_periodically)
+        self._flush_thread.daemon = True
+        self._flush_thread.start()
+        atexit.register(self.flush_session_expiries)
+    return True
+
+  def _flush_expiries_periodically(self):
+    while True:
+      sleep(self.session_flush_interval)
+      self.flush_session_expiries()
+
+  def _run_session_task(self, fn, *args, **kwargs):
+    '''Called by ``DBConnection.create_session_async`` and ``DBConnection.retrieve_session_async`` to run ``fn`` off of the
+    ``IOLoop``. By default, ``fn`` is run in the "toto.session" ``TaskQueue`` which will use up to ``session_threads`` threads.
+    Subclasses with asynchronous drivers may override this method or the ``*_async`` methods directly. Must return a ``Future``.
+    '''
+    future = TaskQueue.instance('toto.session', options.session_threads).yield_task(fn, *args, **kwargs)
+    record_phase = phase_recorder('db', fn.__name__)
+    if record_phase:
+      future.add_done_callback(record_phase)
+    return future
+
   def _remove_session(self, session_id):
     '''Called by ``DBConnection.remove_session`` to invalidate the specified session when no session cache is in use.
     '''
@@ -128,23 +262,62 @@ class DBConnection(object):
   def clear_sessions(self, user_id):
     '''If implemented, invalidates all sessions tied to the account with the given ``user_id``.
     '''
+    user_id = self._normalize_user_id(user_id)
+    if self._local_session_cache:
+      self._local_session_cache.clear_sessions(user_id)
+    if self._pending_expiries:
+      with self._pending_expiry_lock:
+        for session_data in self._pending_expiries.values():
+          if session_data['user_id'] == user_id:
+            del self._pending_expiries[session_data['session_id']]
+    if hasattr(self._session_cache, 'clear_sessions'):
+      self._session_cache.clear_sessions(user_id)
+    self._clear_sessions(user_id)
+
+  def _clear_sessions(self, user_id):
+    '''Called by ``DBConnection.clear_sessions`` to invalidate all sessions tied to the account with the given ``user_id``.
+    '''
     pass
 
   def set_session_cache(self, session_cache):
     '''Optionally set an instance of ``TotoSessionCache`` that will be used to store sessions separately from
-    this database.
+    this database. If the cache implements ``set_renewal(session_renew, anon_session_renew)`` (e.g.
+    ``RedisSessionCache``), it will be called so the cache can renew sessions as they are loaded.
     '''
     self._session_cache = session_cache
+    if hasattr(session_cache, 'set_renewal'):
+      session_cache.set_renewal(self.session_renew, self.anon_session_renew)
+
+  def set_local_session_cache(self, local_session_cache):
+    '''Optionally set an in-process cache (usually a ``toto.localsessioncache.LocalSessionCache``) that will be checked
+    before the session cache or database whenever a session is loaded. The local cache is kept up to date as sessions are
+    created, renewed, saved and removed, and can be combined with ``set_session_cache()`` to form a two level cache.
+    '''
+    self._local_session_cache = local_session_cache
 
   def _load_session_data(self, session_id):
-    '''Called by ``DBConnection.retrieve_session``. Will attempt to load data from an associated ``TotoSessionCache``.
-    If no ``TotoSessionCache`` is associated with the current instance, the result of ``self._load_uncached_data(session_id)``
-    is returned.
+    '''Called by ``DBConnection.retrieve_session`` if the session is not in the local cache. Will attempt to load data
+    from an associated ``TotoSessionCache``. If no ``TotoSessionCache`` is associated with the current instance, the result of
+    ``self._load_uncached_data(session_id)`` is used.
     '''
     if self._session_cache:
       return self._session_cache.load_session(session_id)
     return self._load_uncached_data(session_id)
 
+  def _create_session_instance(self, session_data, store_local=True):
+    '''Called by ``DBConnection.create_session`` and ``DBConnection.retrieve_session`` to instantiate a session and
+    keep the local session cache (if any) in sync with ``session_data``. ``store_local`` is ``False`` when the session
+    was served from the local cache, so hits don't extend how long a copy can be kept there.
+    '''
+    session = self._instantiate_session(session_data, self._session_cache)
+    if self._local_session_cache:
+      if store_local:
+        if isinstance(session_data.get('state'), dict):
+          session_data = session.session_data()
+        self._local_session_cache.store_session(session_data)
+      session._local_session_cache = self._local_session_cache
+    return session
+
   def _load_uncached_data(self, session_id):
     '''Load a session data ``dict`` from the local database. Called by default and if no ``TotoSessionCache`` has been
     associated with the current instance of ``DBConnection``.
@@ -174,7 +347,15 @@ class DBConnection(object):
     '''
     return self._store_session(session_id, session_data)
 
-  def _update_password(self, user_id, hashed_password):
+  def _update_expiries(self, sessions):
+    '''Called by ``DBConnection.flush_session_expiries`` with a list of session data ``dict``s whose ``expires`` values should
+    be written to the database. Override to write all expiries at once, by default ``self._update_expiry`` is called for each session.
+    Implementations must only update ``expires`` as the other values in each ``dict`` may be out of date.
+    '''
+    for session_data in sessions:
+      self._update_expiry(session_data['session_id'], session_data)
+
+  def _update_password(self, user_id, account, hashed_password):
     '''Called by ``DBConnection.change_password`` and ``DBConnection.generate_password``.
     '''
     raise NotImplementedError()
@@ -220,30 +401,36 @@ define("postgres_min_connections", type=int, default=1, help="The minimum number
 define("postgres_max_connections", type=int, default=100, help="The maximum number of connections to keep in the Postgres connection pool")
 define("mongodb_database", default="toto_server", help="MongoDB database")
 define("redis_database", default=0, help="Redis DB")
+define("session_state_layout", default="blob", help="How mongodb and redis store session state: 'blob' serializes the whole state as one value, 'keys' stores each key separately (in a Redis hash or MongoDB subdocument) so saves only write the keys that changed.")
 define("session_ttl", default=24*60*60*365, help="The number of seconds after creation a session should expire")
 define("anon_session_ttl", default=24*60*60, help="The number of seconds after creation an anonymous session should expire")
 define("session_renew", default=0, help="The number of seconds before a session expires that it should be renewed, or zero to renew on every request")
 define("anon_session_renew", default=0, help="The number of seconds before an anonymous session expires that it should be renewed, or zero to renew on every request")
+define("local_session_cache_size", default=0, help="The maximum number of sessions to keep in each process's local session cache. Set to a positive value to enable the local cache.")
+define("local_session_cache_ttl", default=30, help="The number of seconds a session may be served from the local session cache before it is reloaded.")
+define("local_session_cache_event", type=str, help="If set (and the event system is enabled), session removals and saves will be broadcast with this event name so local session caches in other processes are invalidated.")
+define("session_flush_interval", default=0, help="If set, session expiry renewals will be batched and written to the database every session_flush_interval seconds instead of on every request.")
+define("session_threads", default=4, help="The number of threads used to create and retrieve sessions without blocking the IOLoop. Used when session decorators are applied to coroutine methods.")
 
 def configured_connection():
     '''Returns a new database connection based on the configuration options
     '''
     if options.database == "mongodb":
       from mongodbconnection import MongoDBConnection
-      return MongoDBConnection(options.db_host, options.db_port or 27017, options.mongodb_database, session_ttl=options.session_ttl, anon_session_ttl=options.anon_session_ttl, session_renew=options.session_renew, anon_session_renew=options.anon_session_renew)
+      return MongoDBConnection(options.db_host, options.db_port or 27017, options.mongodb_database, state_layout=options.session_state_layout, session_ttl=options.session_ttl, anon_session_ttl=options.anon_session_ttl, session_renew=options.session_renew, anon_session_renew=options.anon_session_renew, session_flush_interval=options.session_flush_interval)
     elif options.database == "redis":
       from redisconnection import RedisConnection
-      return RedisConnection(options.db_host, options.db_port or 6379, options.redis_database, session_ttl=options.session_ttl, anon_session_ttl=options.anon_session_ttl, session_renew=options.session_renew, anon_session_renew=options.anon_session_renew)
+      return RedisConnection(options.db_host, options.db_port or 6379, options.redis_database, state_layout=options.session_state_layout, session_ttl=options.session_ttl, anon_session_ttl=options.anon_session_ttl, session_renew=options.session_renew, anon_session_renew=options.anon_session_renew, session_flush_interval=options.session_flush_interval)
     elif options.database == "mysql":
       from mysqldbconnection import MySQLdbConnection
-      return MySQLdbConnection('%s:%s' % (options.db_host, options.db_port or 3306), options.mysql_database, options.mysql_user, options.mysql_password, session_ttl=options.session_ttl, anon_session_ttl=options.anon_session_ttl, session_renew=options.session_renew, anon_session_renew=options.anon_session_renew, uuid_account_id=options.mysql_uuid_account_id)
+      return MySQLdbConnection('%s:%s' % (options.db_host, options.db_port or 3306), options.mysql_database, options.mysql_user, options.mysql_password, session_ttl=options.session_ttl, anon_session_ttl=options.anon_session_ttl, session_renew=options.session_renew, anon_session_renew=options.anon_session_renew, session_flush_interval=options.session_flush_interval, uuid_account_id=options.mysql_uuid_account_id)
     elif options.database == 'postgres':
       from postgresconnection import PostgresConnection
-      return PostgresConnection(options.db_host, options.db_port or 5432, options.postgres_database, options.postgres_user, options.postgres_password, session_ttl=options.session_ttl, anon_session_ttl=options.anon_session_ttl, session_renew=options.session_renew, anon_session_renew=options.anon_session_renew, min_connections=options.postgres_min_connections, max_connections=options.postgres_max_connections)
+      return PostgresConnection(options.db_host, options.db_port or 5432, options.postgres_database, options.postgres_user, options.postgres_password, session_ttl=options.session_ttl, anon_session_ttl=options.anon_session_ttl, session_renew=options.session_renew, anon_session_renew=options.anon_session_renew, session_flush_interval=options.session_flush_interval, min_connections=options.postgres_min_connections, max_connections=options.postgres_max_connections)
     elif options.database == 'json':
       from jsondbconnection import JSONConnection
-      # return JSONConnection(options.db_host, options.db_port, session_ttl=options.session_ttl, anon_session_ttl=options.anon_session_ttl, session_renew=options.session_renew, anon_session_renew=options.anon_session_renew)
-      return InstancePool(JSONConnection(options.db_host, options.db_port, session_ttl=options.session_ttl, anon_session_ttl=options.anon_session_ttl, session_renew=options.session_renew, anon_session_renew=options.anon_session_renew))
+      # return JSONConnection(options.db_host, options.db_port, session_ttl=options.session_ttl, anon_session_ttl=options.anon_session_ttl, session_renew=options.session_renew, anon_session_renew=options.anon_session_renew, session_flush_interval=options.session_flush_interval)
+      return InstancePool(JSONConnection(options.db_host, options.db_port, session_ttl=options.session_ttl, anon_session_ttl=options.anon_session_ttl, session_renew=options.session_renew, anon_session_renew=options.anon_session_renew, session_flush_interval=options.session_flush_interval))
     else:
       from fakeconnection import FakeConnection
       return FakeConnection()
@@ -0,0 +1,47 @@
+'''Request deadlines. Clients may send an "x-toto-timeout" header with the number of milliseconds they are willing to
+wait for a response, and methods may set a default with the ``@toto.invocation.deadline`` decorator or the
+``request_timeout`` option. Both are measured from the time the request was received, and the requests in a batch
+share the same deadline. ``TotoHandler`` exposes the resulting absolute deadline (a ``time.time()`` value) as
+``handler.deadline`` and answers coroutine methods that are still running once it passes with ``ERROR_DEADLINE_EXCEEDED``.
+
+While a method runs, the deadline is also available from ``current_deadline()``, including in callbacks and after
+``yield`` in coroutines. Worker connections use it to forward the deadline to workers, which drop tasks that have
+already expired instead of running them. Deadlines are absolute, so worker and server clocks should be synchronized.
+'''
+
+import threading
+from time import time
+from tornado.stack_context import StackContext
+from toto.exceptions import *
+
+_state = threading.local()
+
+def current_deadline():
+  '''Returns the deadline of the request currently being processed on this thread, or ``None``.'''
+  return getattr(_state, 'deadline', None)
+
+def deadline_expired(deadline):
+  '''Returns ``True`` if ``deadline`` is set and has passed.'''
+  return deadline is not None and deadline <= time()
+
+def deadline_exceeded():
+  '''Returns the exception used to answer requests that have passed their deadline.'''
+  return TotoException(ERROR_DEADLINE_EXCEEDED, 'Deadline exceeded.')
+
+class _DeadlineContext(object):
+
+  def __init__(self, deadline):
+    self.deadline = deadline
+
+  def __enter__(self):
+    self.previous = current_deadline()
+    _state.deadline = self.deadline
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    _state.deadline = self.previous
+
+def deadline_context(deadline):
+  '''Returns a ``StackContext`` that makes ``deadline`` available from ``current_deadline()`` to everything run
+  within it, including callbacks scheduled on the ``IOLoop``.
+  '''
+  return StackContext(lambda: _DeadlineContext(deadline))
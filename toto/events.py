@@ -14,6 +14,7 @@ import zmq
 import logging
 import zlib
 from random import choice, shuffle
+from toto.tracing import Tracer, span_context, trace_context
 
 class EventManager():
   '''Instances will listen on ``address`` for incoming events.
@@ -90,6 +91,8 @@ class EventManager():
         event = pickle.loads(zlib.decompress(socket.recv()))
         event_name = event['name']
         event_args = event['args']
+        span = options.tracing and 'trace' in event and Tracer.instance().continue_trace('event.%s' % event_name, event['trace']) or None
+        main_loop_handlers = []
         if event_name in self.__handlers:
           handlers = self.__handlers[event_name]
           for handler in list(handlers):
@@ -99,15 +102,35 @@ class EventManager():
               if handler[2] and handler[2]._finished:
                 continue
               if handler[1]:
-                (lambda h: IOLoop.instance().add_callback(lambda: h[0](event_args)))(handler)
+                main_loop_handlers.append(handler[0])
               else:
-                handler[0](event_args)
+                self.__run_handler(handler[0], event_args, span)
             except Exception as e:
               logging.error(format_exc())
+        if main_loop_handlers:
+          #the span is finished once the handlers have run on the main loop
+          IOLoop.instance().add_callback(self.__run_main_loop_handlers, main_loop_handlers, event_args, span)
+        elif span:
+          span.finish()
     self.__thread = Thread(target=receive)
     self.__thread.daemon = True
     self.__thread.start()
   
+  def __run_main_loop_handlers(self, event_handlers, event_args, span):
+    for event_handler in event_handlers:
+      try:
+        self.__run_handler(event_handler, event_args, span)
+      except Exception as e:
+        logging.error(format_exc())
+    if span:
+      span.finish()
+
+  def __run_handler(self, event_handler, event_args, span):
+    if not span:
+      return event_handler(event_args)
+    with span_context(span):
+      event_handler(event_args)
+
   def send_to_server(self, address, event_name, event_args):
     '''Send a message with ``event_name`` and ``event_args`` only
     to the server listening at ``address``. ``address`` must have
@@ -115,7 +138,7 @@ class EventManager():
     efficient than ``send`` if you only intent to send the event
     to a single server and know the address in advance.
     '''
-    event = {'name': event_name, 'args': event_args}
+    event = self.__event(event_name, event_args)
     event_data = zlib.compress(pickle.dumps(event))
     self.__remote_servers[address].send(event_data)
   
@@ -124,11 +147,13 @@ class EventManager():
     all servers previously registered with ``register_server()``.
     If ``broadcast`` is false, the event will be sent to only
     a single server. Non-broadcast events are round-robin load
-    balanced between registered servers.
+    balanced between registered servers. If the current request
+    is being traced, the trace is continued by the receiving
+    servers' event handlers (see ``toto.tracing``).
     '''
     if not self.__remote_servers:
       return
-    event = {'name': event_name, 'args': event_args}
+    event = self.__event(event_name, event_args)
     event_data = zlib.compress(pickle.dumps(event))
     if not broadcast:
       self.__queued_servers[0].send(event_data)
@@ -137,6 +162,13 @@ class EventManager():
     for socket in self.__queued_servers:
       socket.send(event_data)
 
+  def __event(self, event_name, event_args):
+    event = {'name': event_name, 'args': event_args}
+    trace = trace_context()
+    if trace:
+      event['trace'] = trace
+    return event
+
   @classmethod
   def instance(cls):
     '''Returns the shared instance of ``EventManager``, instantiating on the first call.
@@ -10,6 +10,9 @@
   * ``ERROR_INVALID_HMAC = 1008``
   * ``ERROR_INVALID_RESPONSE_HMAC = 1009``
   * ``ERROR_INVALID_USER_ID 1010``
+  * ``ERROR_SERVICE_UNAVAILABLE = 1011``
+  * ``ERROR_DEADLINE_EXCEEDED = 1012``
+  * ``ERROR_RATE_LIMITED = 1013``
 '''
 
 ERROR_SERVER = 1000
@@ -23,6 +26,9 @@ ERROR_INVALID_SESSION_ID = 1007
 ERROR_INVALID_HMAC = 1008
 ERROR_INVALID_RESPONSE_HMAC = 1009
 ERROR_INVALID_USER_ID = 1010
+ERROR_SERVICE_UNAVAILABLE = 1011
+ERROR_DEADLINE_EXCEEDED = 1012
+ERROR_RATE_LIMITED = 1013
 
 class TotoException(Exception):
   '''This class is used to return errors from Toto methods. ``TotoException.value``
@@ -6,19 +6,81 @@ from invocation import *
 from exceptions import *
 from tornado.options import define, options
 import base64
-from tornado.httputil import parse_multipart_form_data
+from tornado.httputil import parse_multipart_form_data, parse_body_arguments
 from tornado.ioloop import IOLoop
 from tornado.gen import coroutine, Return, engine
 from tornado.concurrent import return_future, Future
 from toto.session import TotoSession
+from toto.serialization import register_codec, get_codec, negotiate_codec, set_json_module
+from toto.compression import negotiate_encoding, compress
+from toto.cache import LRUCache
+from toto.metrics import MethodMetrics
+from toto.profiler import SamplingProfiler
+from toto.slowlog import SlowRequestLog, RequestPhases, phases_context
+from toto.tracing import Tracer, span_context
+from toto.upload import StreamingBody
+from toto.deadline import deadline_context, deadline_expired, deadline_exceeded
+from tornado.gen import with_timeout, TimeoutError
 from uuid import uuid4
+from datetime import datetime
+from email.utils import parsedate_tz, mktime_tz
+import mimetypes
+import os
+from collections import namedtuple
+from types import ModuleType, GeneratorType
+from tornado.iostream import StreamClosedError
+import pkgutil
+import sys
 import logging
+from traceback import format_exc
 
 define("allow_origin", default="*", help="This is the value for the Access-Control-Allow-Origin header (default *)")
 define("method_select", default="both", metavar="both|url|parameter", help="Selects whether methods can be specified via URL, parameter in the message body or both (default both)")
 define("bson_enabled", default=False, help="Allows requests to use BSON with content-type application/bson")
 define("msgpack_enabled", default=False, help="Allows requests to use MessagePack with content-type application/msgpack")
+define("json_module", default="json", help="The module used to encode and decode JSON. Any module implementing loads() and dumps() compatible with the standard json module may be used, e.g. ujson or simplejson")
 define("hmac_enabled", default=False, help="Uses the x-toto-hmac header to verify authenticated requests.")
+define("compress_responses", default=False, help="Compress response bodies with gzip or deflate when supported by the client.")
+define("compression_threshold", default=1024, help="The minimum size in bytes of a response body that will be compressed.")
+define("compression_level", default=6, help="The zlib compression level (1-9) used to compress responses.")
+define("compression_cache_size", default=0, help="The number of compressed response bodies to keep so that identical responses don't need to be compressed again. Set to 0 to disable.")
+define("request_timeout", default=0.0, help="The default number of seconds a request may take before it is answered with ERROR_DEADLINE_EXCEEDED. Clients may request a shorter deadline with the x-toto-timeout header (in milliseconds). Set to 0 to disable.")
+define("preload_methods", default=False, help="Import every module in method_module when the server starts and build the method table up front. Unknown methods are rejected without any lookup.")
+define("method_warmup", default=False, help="Call the warmup(db_connection) function of each method module that defines one before the server starts listening. Implies preload_methods.")
+define("stream_chunk_size", default=65536, help="The number of bytes of a streamed response to buffer before writing them to the client.")
+define("stream_uploads", default=False, help="Receive request bodies as they arrive, writing file uploads and other non-codec bodies to temporary files instead of buffering them in memory. See toto.upload.")
+define("upload_spool_size", default=1048576, help="With stream_uploads, uploaded files larger than this many bytes are written to temporary files on disk.")
+define("max_body_size", default=0, help="The maximum size in bytes of a request body. Methods may override this with @max_body_size. Set to 0 to use the Tornado default (100MB).")
+define("file_chunk_size", default=65536, help="The number of bytes read from disk and written to the client at a time by respond_file().")
+define("batch_concurrency", default=1, help="The maximum number of requests in a batch that will be run concurrently. The default of 1 runs each request in order, set to 0 to start every request in the batch at once.")
+
+_Method = namedtuple('_Method', ['path', 'module', 'invoke', 'asynchronous'])
+
+def _parse_byte_range(byte_range, size):
+  '''Returns ``(start, end)`` for a single "range" header value, ``None`` if the range can't be satisfied or ``False``
+  if the header should be ignored (e.g. multiple ranges).
+  '''
+  unit, _, ranges = byte_range.partition('=')
+  if unit.strip() != 'bytes' or ',' in ranges:
+    return False
+  first, _, last = ranges.strip().partition('-')
+  try:
+    if not first:
+      length = int(last)
+      return length and size and (max(size - length, 0), size) or None
+    start = int(first)
+    end = last and min(int(last) + 1, size) or size
+  except ValueError:
+    return False
+  if start >= size or end <= start:
+    return None
+  return start, end
+
+def _invoke_in_contexts(contexts, invoke, handler, parameters):
+  if not contexts:
+    return invoke(handler, parameters)
+  with contexts[0]:
+    return _invoke_in_contexts(contexts[1:], invoke, handler, parameters)
 
 class BatchHandlerProxy(object):
   '''A proxy to a handler, this class intercepts calls to ``handler.respond()`` in order to match the
@@ -26,14 +88,21 @@ class BatchHandlerProxy(object):
   an instance of ``BatchHandlerProxy`` will be passed instead of a ``TotoHandler``. Though this
   replacement should be transparent to the method invocation, you may access the underlying handler
   with ``proxy.handler``.
+
+  By default, the requests in a batch are invoked one after another. Use the ``batch_concurrency`` option
+  to start multiple requests at once, allowing coroutine and asynchronous methods in the same batch to
+  run concurrently.
   '''
 
-  _non_proxy_keys = {'handler', 'request_key', 'async', 'transaction_id'}
+  _non_proxy_keys = {'handler', 'request_key', 'async', 'transaction_id', 'deadline', '_metrics_pending', 'span'}
 
   def __init__(self, handler, request_key):
     self.handler = handler
     self.request_key = request_key
     self.transaction_id = uuid4()
+    self.deadline = None
+    self._metrics_pending = None
+    self.span = None
 
   def __getattr__(self, attr):
     return getattr(self.handler, attr)
@@ -54,6 +123,12 @@ class BatchHandlerProxy(object):
     if self.async and allow_async:
       IOLoop.instance().add_callback(lambda: self.respond(result, error, False))
       return
+    if self._metrics_pending:
+      method_path, start = self._metrics_pending
+      self._metrics_pending = None
+      self.handler._record_method(method_path, start, error is not None)
+    if self.span:
+      self.span.finish(error)
     self._after_invoke(self.transaction_id)
     self.handler.batch_results[self.request_key] = error is not None and {'error': isinstance(error, dict) and error or self.handler.error_info(error)} or {'result': result}
     if len(self.handler.batch_results) == len(self.handler.request_keys):
@@ -100,25 +175,48 @@ class TotoHandler(RequestHandler):
   '''
 
   SUPPORTED_METHODS = {"POST", "OPTIONS", "GET", "HEAD"}
+  _compression_cache = None
+  _metrics = None
+  _profiler = None
+  _slow_log = None
+  _tracer = None
+  _stream_request_body = False
   ACCESS_CONTROL_ALLOW_ORIGIN = options.allow_origin
 
   def initialize(self, db_connection):
     self.db_connection = db_connection
     self.db = self.db_connection.db
-    self.bson = options.bson_enabled and __import__('bson').BSON
-    self.msgpack = options.msgpack_enabled and __import__('msgpack')
     self.response_type = 'application/json'
     self.body = None
     self.registered_event_handlers = []
     self.__active_methods = []
     self.headers_only = False
+    self._partial_body = False
+    self._response_complete = False
+    self._metrics_pending = None
+    self.deadline = None
     self.async = False
     self.transaction_id = uuid4()
+    self._body_stream = None
+    self._etag_response = False
+    self._finish_callbacks = []
+    self.phases = self._slow_log and RequestPhases(self.request._start_time) or None
+    self.span = None
 
   @classmethod
   def configure(cls):
     """Runtime method configuration.
     """
+    #Serialization configuration
+    if options.json_module != 'json':
+      set_json_module(__import__(options.json_module))
+    if options.bson_enabled:
+      from bson import BSON
+      register_codec('application/bson', lambda obj: str(BSON.encode(obj)), lambda data: BSON(data).decode())
+    if options.msgpack_enabled:
+      import msgpack
+      register_codec('application/msgpack', msgpack.dumps, msgpack.loads, True)
+
     #Method configuration
     if options.event_mode != 'off':
       from toto.events import EventManager
@@ -154,13 +252,39 @@ class TotoHandler(RequestHandler):
           if not session_id:
             session_id = 'x-toto-session-id' in headers and headers['x-toto-session-id'] or get_cookie(self, 'toto-session-id')
           if session_id:
+            start = time.time()
             self.session = self.db_connection.retrieve_session(session_id)
+            self._record_phase('session', start)
           if options.hmac_enabled and self.session:
             self._verify_hmac(self.session, self.request, headers)
         if self.session:
           set_cookie(self, name='toto-session-id', value=self.session.session_id, expires_days=math.ceil(self.session.expires / (24.0 * 60.0 * 60.0)), domain=options.cookie_domain)
         return self.session
       cls.retrieve_session = retrieve_session
+
+      @coroutine
+      def create_session_async(self, user_id=None, password=None, verify_password=True):
+        self.session = yield self.db_connection.create_session_async(user_id, password, verify_password)
+        set_cookie(self, name='toto-session-id', value=self.session.session_id, expires_days=math.ceil(self.session.expires / (24.0 * 60.0 * 60.0)), domain=options.cookie_domain)
+        raise Return(self.session)
+      cls.create_session_async = create_session_async
+
+      @coroutine
+      def retrieve_session_async(self, session_id=None):
+        if not self.session or (session_id and self.session.session_id != session_id):
+          headers = self.request.headers
+          if not session_id:
+            session_id = 'x-toto-session-id' in headers and headers['x-toto-session-id'] or get_cookie(self, 'toto-session-id')
+          if session_id:
+            start = time.time()
+            self.session = yield self.db_connection.retrieve_session_async(session_id)
+            self._record_phase('session', start)
+          if options.hmac_enabled and self.session:
+            self._verify_hmac(self.session, self.request, headers)
+        if self.session:
+          set_cookie(self, name='toto-session-id', value=self.session.session_id, expires_days=math.ceil(self.session.expires / (24.0 * 60.0 * 60.0)), domain=options.cookie_domain)
+        raise Return(self.session)
+      cls.retrieve_session_async = retrieve_session_async
     if options.debug:
       import traceback
       def error_info(self, e):
@@ -169,8 +293,72 @@ class TotoHandler(RequestHandler):
         logging.error('%s\n%s\nHeaders: %s\n' % (e, traceback.format_exc(), repr(self.request.headers)))
         return e.__dict__
       cls.error_info = error_info
+    if options.compress_responses:
+      cls._compression_cache = options.compression_cache_size and LRUCache(options.compression_cache_size) or None
+      def write_body(self, body):
+        if len(body) >= options.compression_threshold and not self._headers_written:
+          headers = self.request.headers
+          encoding = negotiate_encoding('accept-encoding' in headers and headers['accept-encoding'])
+          self.add_header('vary', 'accept-encoding')
+          if encoding:
+            body = self._compress_body(body, encoding)
+            self.set_header('content-encoding', encoding)
+        self.write(body)
+      cls._write_body = write_body
+    if options.metrics_path:
+      cls._metrics = MethodMetrics.instance()
+    if options.profile_rate or options.profile_secret:
+      cls._profiler = SamplingProfiler.instance()
+    if options.slow_request_threshold:
+      cls._slow_log = SlowRequestLog.instance()
+    if options.tracing:
+      cls._tracer = Tracer.instance()
+    if options.stream_uploads:
+      stream_request_body(cls)
     cls.__method_root = __import__(options.method_module)
     cls.__method_cache = {}
+    if options.preload_methods or options.method_warmup:
+      cls.__method_cache = cls.__load_methods(sys.modules[options.method_module])
+      def get_method(self, path):
+        try:
+          return self.__method_cache[path]
+        except KeyError:
+          raise TotoException(ERROR_INVALID_METHOD, "Cannot call '" + path + "'.")
+      cls.__get_method = get_method
+
+  @classmethod
+  def __load_methods(cls, root):
+    '''Import every module in the ``root`` package and return a table mapping each method path to the module that
+    defines its ``invoke()`` function. Modules imported into a package under another name are included using the
+    name they are imported as, matching the lazy lookup. Import errors are raised so broken methods are found at startup.
+    '''
+    if hasattr(root, '__path__'):
+      for importer, name, is_package in pkgutil.walk_packages(root.__path__, root.__name__ + '.'):
+        __import__(name)
+    methods = {}
+    visited = set()
+    def add_methods(package, prefix):
+      visited.add(package)
+      for name, value in vars(package).items():
+        if not isinstance(value, ModuleType):
+          continue
+        path = prefix + name
+        if hasattr(value, 'invoke'):
+          methods[path] = _Method(path, value, value.invoke, hasattr(value.invoke, 'asynchronous'))
+        if hasattr(value, '__path__') and value not in visited:
+          add_methods(value, path + '.')
+    add_methods(root, '')
+    return methods
+
+  @classmethod
+  def warmup(cls, db_connection):
+    '''Call ``warmup(db_connection=db_connection)`` on each method module that defines it. Used by ``TotoServer``
+    when the ``method_warmup`` option is set so that caches, connections and lazy imports are ready before the
+    first request.
+    '''
+    for method in cls.__method_cache.itervalues():
+      if hasattr(method.module, 'warmup'):
+        method.module.warmup(db_connection=db_connection)
 
   def __get_method_path(self, path, body):
     """The default method_select "both" (or any unsupported value) will
@@ -192,7 +380,7 @@ class TotoHandler(RequestHandler):
         method = self.__method_root
         for component in path.split('.'):
           method = getattr(method, component)
-        self.__method_cache[path] = method
+        self.__method_cache[path] = _Method(path, method, method.invoke, hasattr(method.invoke, 'asynchronous'))
       except AttributeError:
         raise TotoException(ERROR_INVALID_METHOD, "Cannot call '" + path + "'.")
     return self.__method_cache[path]
@@ -208,30 +396,90 @@ class TotoHandler(RequestHandler):
     result = None
     error = None
     method = None
+    span = None
     async = False
     try:
       start = time.time()
       method_path = self.__get_method_path(path, request_body)
       method = self.__get_method(method_path)
-      async = hasattr(method.invoke, 'asynchronous')
+      async = method.asynchronous
       if handler:
         self._before_invoke(handler.transaction_id, method_path)
       else:
         self._before_invoke(self.transaction_id, method_path)
+        if self.phases is not None:
+          self.phases.method = method_path
       self.__active_methods.append(method)
-      output = method.invoke(handler or self, parameters)
+      deadline = (handler or self).deadline = self._request_deadline(method.invoke)
+      if deadline_expired(deadline):
+        raise deadline_exceeded()
+      if self._tracer:
+        span = (handler or self).span = self._start_span(method_path, handler)
+      contexts = []
+      if deadline is not None:
+        contexts.append(deadline_context(deadline))
+      if self._profiler and self._profiler.should_profile(self.request):
+        contexts.append(self._profiler.context(method_path))
+      if self.phases is not None:
+        contexts.append(phases_context(self.phases))
+      if span:
+        contexts.append(span_context(span))
+      output = _invoke_in_contexts(contexts, method.invoke, handler or self, parameters)
       if isinstance(output, Future):
         #result is a future, so yield the real response
-        result = yield output
+        if deadline is None:
+          result = yield output
+        else:
+          try:
+            result = yield with_timeout(deadline, output)
+          except TimeoutError:
+            raise deadline_exceeded()
       else:
         result = output
       logging.info('call %s %0.4fms' % (method_path, (time.time()-start) * 1000.0))
     except Exception as e:
       error = self.error_info(e)
+    if method and (self._metrics or self.phases is not None):
+      if async and not error:
+        #asynchronous methods are recorded when they respond
+        (handler or self)._metrics_pending = (method_path, start)
+      else:
+        self._record_method(method_path, start, error is not None)
+    if span and (error or not async):
+      span.finish(error)
     raise Return((result, error, (async)))
 
+  def _start_span(self, method_path, handler=None):
+    '''Start the span for a method invoked by this request. Methods invoked as part of a batch are children of the
+    batch's span, otherwise the trace in the "x-toto-trace-id" and "x-toto-span-id" headers is continued, if any.
+    '''
+    if handler:
+      return self._tracer.start_span(method_path, self.span.trace_id, self.span.span_id, handler.transaction_id.hex)
+    headers = self.request.headers
+    span = self._tracer.start_span(method_path, headers.get('x-toto-trace-id'), headers.get('x-toto-span-id'), self.transaction_id.hex)
+    self.set_header('x-toto-trace-id', span.trace_id)
+    return span
+
+  def _request_deadline(self, invoke):
+    '''Returns the deadline for a call to ``invoke`` from the "x-toto-timeout" header (milliseconds), the method's
+    ``@deadline`` or the ``request_timeout`` option, whichever is soonest. Returns ``None`` if there is no deadline.
+    Deadlines are measured from the time the request was received, so every method in a batch shares the client's
+    budget and time spent reading the body and loading the session counts against it.
+    '''
+    start = self.request._start_time
+    timeout = getattr(invoke, 'timeout', None) or options.request_timeout
+    deadline = timeout and start + timeout or None
+    client_timeout = self.request.headers.get('x-toto-timeout')
+    if client_timeout:
+      try:
+        client_deadline = start + float(client_timeout) / 1000.0
+      except ValueError:
+        raise TotoException(ERROR_MISSING_PARAMS, "Invalid x-toto-timeout header.")
+      deadline = deadline and min(deadline, client_deadline) or client_deadline
+    return deadline
+
   def options(self, path=None):
-    allowed_headers = set(['x-toto-hmac','x-toto-session-id','origin','content-type'])
+    allowed_headers = set(['x-toto-hmac','x-toto-session-id','x-toto-timeout','x-toto-profile','origin','content-type'])
     if 'access-control-request-headers' in self.request.headers:
       allowed_headers = allowed_headers.union(self.request.headers['access-control-request-headers'].lower().replace(' ','').split(','))
     self.add_header('access-control-allow-headers', ','.join(allowed_headers))
@@ -241,6 +489,35 @@ class TotoHandler(RequestHandler):
     self.add_header('access-control-allow-methods', ','.join(self.SUPPORTED_METHODS))
     self.add_header('access-control-expose-headers', 'x-toto-hmac')
 
+  def prepare(self):
+    '''Enforces the request body size limit and, with the ``stream_uploads`` option, prepares to receive the body.'''
+    limit = self._max_body_size()
+    headers = self.request.headers
+    if limit:
+      if int(headers.get('content-length', 0)) > limit or (not self._stream_request_body and len(self.request.body) > limit):
+        raise HTTPError(413)
+      if self._stream_request_body:
+        self.request.connection.set_max_body_size(limit)
+    if self._stream_request_body and self.request.method == 'POST':
+      self._body_stream = StreamingBody(headers.get('content-type', 'application/json'), options.upload_spool_size, options.hmac_enabled)
+
+  def data_received(self, chunk):
+    #only POST bodies are read, any other body is discarded
+    if self._body_stream:
+      self._body_stream.write(chunk)
+
+  def _max_body_size(self):
+    '''Returns the body size limit for the method named in the request URL, if any, or the ``max_body_size`` option.'''
+    path = self.path_args and self.path_args[0]
+    if path:
+      try:
+        limit = getattr(self.__get_method('.'.join(path.split('/'))).invoke, 'max_body_size', None)
+        if limit:
+          return limit
+      except TotoException:
+        pass
+    return options.max_body_size
+
   @coroutine
   def head(self, path=None):
     self.headers_only = True
@@ -255,31 +532,50 @@ class TotoHandler(RequestHandler):
         parameters[k] = v[0]
       else:
         parameters[k] = v
+    self._negotiate_response_type()
     yield self.process_request(path, self.body, parameters)
     self._after_invoke(self.transaction_id)
 
   @coroutine
   def post(self, path=None):
+    start = time.time()
     content_type = 'content-type' in self.request.headers and self.request.headers['content-type'] or 'application/json'
-    if not content_type.startswith('application/json'):
-      if content_type.startswith('application/x-www-form-urlencoded'):
-        self.body = {'parameters': self.request.arguments}
-      elif content_type.startswith('multipart/form-data'):
-        self.body = {'parameters': {'arguments': self.request.arguments, 'files': self.request.files}}
-      elif self.bson and content_type.startswith('application/bson'):
-        self.response_type = 'application/bson'
-        self.body = self.bson(self.request.body).decode()
-      elif self.msgpack and content_type.startswith('application/msgpack'):
-        self.response_type = 'application/msgpack'
-        self.body = self.msgpack.loads(self.request.body)
-    else:
-      self.body = json.loads(self.request.body)
+    codec = get_codec(content_type)
+    stream = self._body_stream
+    if stream and (codec or content_type.startswith('application/x-www-form-urlencoded')):
+      self.request.body = stream.read()
+      if not codec:
+        parse_body_arguments(content_type, self.request.body, self.request.body_arguments, self.request.files, self.request.headers)
+        for k, v in self.request.body_arguments.iteritems():
+          self.request.arguments.setdefault(k, []).extend(v)
+      stream = None
+    if stream:
+      self.body = {'parameters': stream.parameters(self.request.query_arguments)}
+    elif codec:
+      self.body = codec.decode(self.request.body)
+    elif content_type.startswith('application/x-www-form-urlencoded'):
+      self.body = {'parameters': self.request.arguments}
+    elif content_type.startswith('multipart/form-data'):
+      self.body = {'parameters': {'arguments': self.request.arguments, 'files': self.request.files}}
+    self._record_phase('parse', start)
+    self._negotiate_response_type(codec)
     if self.body and 'batch' in self.body:
       yield self.batch_process_request(self.body['batch'])
     else:
       yield self.process_request(path, self.body, self.body and 'parameters' in self.body and self.body['parameters'] or self.body or {})
     self._after_invoke(self.transaction_id)
 
+  def _negotiate_response_type(self, request_codec=None):
+    '''Sets ``self.response_type`` to the mime type of the registered codec that best matches the request's "accept" header,
+    preferring the codec used to decode the request.
+    '''
+    headers = self.request.headers
+    accept = 'accept' in headers and headers['accept']
+    codec = negotiate_codec(accept, request_codec or get_codec('application/json'))
+    self.response_type = codec.mime_type
+    if accept:
+      self.add_header('vary', 'accept')
+
   @return_future
   @engine
   def batch_process_request(self, requests, callback):
@@ -290,13 +586,31 @@ class TotoHandler(RequestHandler):
     self.request_keys = sorted(requests.keys())
     self.batch_results = {}
     self._before_invoke(self.transaction_id, '<batch>')
-    for k, v in ((i, requests[i]) for i in self.request_keys):
-      proxy = BatchHandlerProxy(self, k)
-      result, error, async = yield self.invoke_method(None, v, v.get('parameters', {}), handler=proxy)
-      if async:
-        proxy.async = True
-      if result or error or not async:
-        proxy.respond(result, error, allow_async=False)
+    if self._tracer:
+      self.span = self._start_span('<batch>')
+    if self.phases is not None:
+      self.phases.method = '<batch>'
+    pending_keys = iter(self.request_keys)
+    @coroutine
+    def process_batch():
+      for k in pending_keys:
+        yield self.__invoke_batch_request(k, requests[k])
+    concurrency = options.batch_concurrency or len(self.request_keys)
+    yield [process_batch() for i in xrange(min(concurrency, len(self.request_keys)))]
+
+  @coroutine
+  def __invoke_batch_request(self, request_key, request):
+    proxy = BatchHandlerProxy(self, request_key)
+    result, error, async = yield self.invoke_method(None, request, request.get('parameters', {}), handler=proxy)
+    if isinstance(result, GeneratorType) and not error:
+      try:
+        result = yield self._collect_stream(result)
+      except Exception as e:
+        result, error = None, self.error_info(e)
+    if async:
+      proxy.async = True
+    if result or error or not async:
+      proxy.respond(result, error, allow_async=False)
 
   @return_future
   @engine
@@ -308,19 +622,24 @@ class TotoHandler(RequestHandler):
     result, error, async = yield self.invoke_method(path, request_body, parameters)
     if async:
       self.async = True
-    if result is not None or error:
+    if isinstance(result, GeneratorType) and not error:
+      yield self.respond_stream(result)
+    elif result is not None or error:
       self.respond(result, error, allow_async=False)
-    elif not async and not self._finished:
+    elif not async and not self._finished and not self._response_complete:
       self._request_callback()
 
   def respond(self, result=None, error=None, batch_results=None, allow_async=True):
     '''Respond to the request with the given result or error object (the ``batch_results`` and
     ``allow_async`` parameters are for internal use only and not intended to be supplied manually).
-    Responses will be serialized according to the ``response_type`` propery. The default
-    serialization is "application/json". Other supported protocols are:
+    Responses will be serialized with the codec registered for the ``response_type`` property, which is negotiated
+    from the request's "accept" and "content-type" headers. The default serialization is "application/json". Other
+    supported protocols are:
 
-    * application/bson - requires pymongo
-    * application/msgpack - requires msgpack-python
+    * application/bson - requires pymongo and the ``bson_enabled`` option
+    * application/msgpack - requires msgpack-python and the ``msgpack_enabled`` option
+
+    Additional codecs can be registered with ``toto.serialization.register_codec()``.
 
     The response will also contain any available session information.
 
@@ -339,6 +658,191 @@ class TotoHandler(RequestHandler):
     if self.async and allow_async:
       IOLoop.instance().add_callback(lambda: self.respond(result, error, batch_results, False))
       return
+    if self._metrics_pending:
+      self._record_pending_metrics(error is not None)
+    if self.span:
+      self.span.finish(error)
+    start = time.time()
+    response_body = self.encode_response(result, error, batch_results)
+    self._record_phase('serialize', start)
+    if self._etag_response and not error:
+      etag = '"%s"' % hashlib.sha1(response_body).hexdigest()
+      self.set_header('etag', etag)
+      if self.etag_matches(etag):
+        self.set_status(304)
+        self.headers_only = True
+    if options.hmac_enabled and self.session:
+      self.add_header('x-toto-hmac', self._response_hmac(self.session, response_body))
+    self.respond_raw(response_body, self.response_type)
+
+  @coroutine
+  def respond_stream(self, items):
+    '''Respond with each item produced by the iterable ``items``, serializing and sending them as they are produced
+    instead of building the whole result in memory. ``process_request()`` calls this automatically when ``invoke()``
+    returns a generator, so a method can stream its result with ``yield``::
+
+      def invoke(handler, parameters):
+        for row in handler.db.query('SELECT * FROM events'):
+          yield row
+
+    Items may also be ``Futures``, which will be resolved before they are written. JSON responses are sent as a normal
+    response with a "result" list. Other streaming codecs, e.g. "application/x-ndjson", send each item as a separate
+    record. Data is written in chunks of ``stream_chunk_size`` bytes, and the handler waits for each chunk to be sent to
+    the client before reading more items. If an exception is raised while producing items, the response is ended with
+    an "error". Codecs that don't support streaming, and HMAC signed responses, are collected and sent with ``respond()``.
+    Streamed responses to batch requests are always collected.
+    '''
+    codec = get_codec(self.response_type)
+    if not codec.streaming or (options.hmac_enabled and self.session):
+      results = yield self._collect_stream(items)
+      self.respond(results, allow_async=False)
+      return
+    close = getattr(items, 'close', None)
+    if self.headers_only:
+      if close:
+        close()
+      self.respond_raw('', self.response_type)
+      return
+    json_array = codec.mime_type == 'application/json'
+    if json_array:
+      head = self.encode_response()
+      chunks = [head[:-1] + (len(head) > 2 and ', "result": [' or '"result": [')]
+      separator = ', '
+    else:
+      chunks = []
+      separator = ''
+    size = len(chunks) and len(chunks[0])
+    error = None
+    try:
+      first = True
+      for item in items:
+        if isinstance(item, Future):
+          item = yield item
+        data = codec.encode(item)
+        if not first:
+          chunks.append(separator)
+        first = False
+        chunks.append(data)
+        size += len(data)
+        if size >= options.stream_chunk_size:
+          self.respond_raw(''.join(chunks), self.response_type, False)
+          chunks, size = [], 0
+          yield self.flush()
+    except StreamClosedError:
+      if close:
+        close()
+      self._response_complete = True
+      self._request_callback()
+      return
+    except Exception as e:
+      error = self.error_info(e)
+    if json_array:
+      chunks.append(error and '], "error": %s}' % codec.encode(error) or ']}')
+    elif error:
+      chunks.append(codec.encode({'error': error}))
+    self.respond_raw(''.join(chunks), self.response_type)
+
+  @coroutine
+  def respond_file(self, file, content_type=None, filename=None):
+    '''Respond with the contents of ``file``, which may be a path, a file descriptor or a file object. The file is
+    read and sent to the client ``file_chunk_size`` bytes at a time, waiting for each chunk to be written before
+    reading the next, so large files are never held in memory. The file will be closed when the response is complete.
+
+    ``content_type`` is guessed from the path if it isn't given, falling back to "application/octet-stream". Pass
+    ``filename`` to send a "content-disposition" header so browsers download the file with that name.
+
+    "etag" and "last-modified" headers are set from the file's modification time and size, and conditional requests
+    ("if-none-match" and "if-modified-since") are answered with "304 Not Modified". Single byte ranges requested with
+    the "range" header (and "if-range") are sent as "206 Partial Content".
+    '''
+    if isinstance(file, basestring):
+      content_type = content_type or mimetypes.guess_type(file)[0]
+      file = open(file, 'rb')
+    elif isinstance(file, (int, long)):
+      file = os.fdopen(file, 'rb')
+    try:
+      content_type = content_type or 'application/octet-stream'
+      stat = os.fstat(file.fileno())
+      size = stat.st_size
+      modified = int(stat.st_mtime)
+      etag = '"%x-%x"' % (modified, size)
+      headers = self.request.headers
+      self.set_header('etag', etag)
+      self.set_header('last-modified', datetime.utcfromtimestamp(modified))
+      self.set_header('accept-ranges', 'bytes')
+      if filename:
+        self.set_header('content-disposition', 'attachment; filename="%s"' % filename.replace('"', ''))
+      if self._not_modified(etag, modified):
+        self.set_status(304)
+        self.headers_only = True
+        self.respond_raw('', content_type)
+        return
+      start, end = 0, size
+      byte_range = headers.get('range')
+      if byte_range and headers.get('if-range', etag) == etag:
+        byte_range = _parse_byte_range(byte_range, size)
+        if byte_range is None:
+          self.set_status(416)
+          self.set_header('content-range', 'bytes */%d' % size)
+          self.headers_only = True
+          self.respond_raw('', content_type)
+          return
+        if byte_range:
+          start, end = byte_range
+          self.set_status(206)
+          self.set_header('content-range', 'bytes %d-%d/%d' % (start, end - 1, size))
+      self.set_header('content-length', end - start)
+      #file bodies are sent in parts and are never compressed
+      self._partial_body = True
+      if not self.headers_only:
+        file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+          data = file.read(min(options.file_chunk_size, remaining))
+          if not data:
+            break
+          remaining -= len(data)
+          self.respond_raw(data, content_type, False)
+          try:
+            yield self.flush()
+          except StreamClosedError:
+            self._response_complete = True
+            self._request_callback()
+            return
+      self.respond_raw('', content_type)
+    finally:
+      file.close()
+
+  def etag_matches(self, etag):
+    '''Returns ``True`` if ``etag`` matches the request's "if-none-match" header.'''
+    if_none_match = self.request.headers.get('if-none-match')
+    if not if_none_match:
+      return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or ('W/' + etag) in tags
+
+  def _not_modified(self, etag, modified):
+    headers = self.request.headers
+    if 'if-none-match' in headers:
+      return self.etag_matches(etag)
+    if 'if-modified-since' in headers:
+      since = parsedate_tz(headers['if-modified-since'])
+      return since is not None and mktime_tz(since) >= modified
+    return False
+
+  @coroutine
+  def _collect_stream(self, items):
+    results = []
+    for item in items:
+      if isinstance(item, Future):
+        item = yield item
+      results.append(item)
+    raise Return(results)
+
+  def encode_response(self, result=None, error=None, batch_results=None):
+    '''Returns the response body that ``respond()`` would send for the given arguments, serialized according to
+    ``response_type``. Useful for caching responses that will be sent with ``respond_raw()``.
+    '''
     response = {}
     if result is not None:
       response['result'] = result
@@ -348,28 +852,68 @@ class TotoHandler(RequestHandler):
       response['batch'] = batch_results
     if self.session:
       response['session'] = {'session_id': self.session.session_id, 'expires': self.session.expires, 'user_id': str(self.session.user_id)}
-    if self.response_type == 'application/bson':
-      response_body = str(self.bson.encode(response))
-    elif self.response_type == 'application/msgpack':
-      response_body = self.msgpack.dumps(response)
-    else:
-      response_body = json.dumps(response)
-    if options.hmac_enabled and self.session:
-      self.add_header('x-toto-hmac', self._response_hmac(self.session, response_body))
-    self.respond_raw(response_body, self.response_type)
+    return get_codec(self.response_type).encode(response)
 
   def respond_raw(self, body, content_type, finish=True):
     '''Respond raw is used by respond to send the response to the client. You can pass a string as the body parameter
     and it will be written directly to the response stream. The response "content-type" header will be set to ``content_type``.
     Use finish to specify whether or not the response stream should be closed after body is written. Use ``finish=False``
     to send the response in multiple calls to ``respond_raw``.
+
+    If the ``compress_responses`` option is set, a body sent in a single call will be compressed with gzip or deflate
+    (as accepted by the client) once it reaches ``compression_threshold`` bytes. If ``compression_cache_size`` is set,
+    the compressed bytes are kept so that sending an identical body again, e.g. a cached or pre-serialized response,
+    doesn't compress it a second time.
     '''
-    self.add_header('content-type', content_type)
+    if self._metrics_pending:
+      self._record_pending_metrics(False)
+    if self.span:
+      self.span.finish()
+    start = time.time()
+    self.set_header('content-type', content_type)
     if not self.headers_only:
-      self.write(body)
+      if finish and not self._partial_body:
+        self._write_body(body)
+      else:
+        self._partial_body = True
+        self.write(body)
+    self._record_phase('write', start)
     if finish:
+      self._response_complete = True
       self._request_callback()
 
+  def _record_pending_metrics(self, error):
+    method_path, start = self._metrics_pending
+    self._metrics_pending = None
+    self._record_method(method_path, start, error)
+
+  def _record_method(self, method_path, start, error):
+    if self._metrics:
+      self._metrics.record(method_path, time.time() - start, error)
+    if self.phases is not None:
+      self.phases.record('method', start, method_path)
+
+  def _record_phase(self, name, start, detail=None):
+    if self.phases is not None:
+      self.phases.record(name, start, detail)
+
+  def _write_body(self, body):
+    '''Called by ``respond_raw`` to write a complete response body. When the ``compress_responses`` option is set, ``configure()``
+    replaces this method with one that compresses bodies larger than ``compression_threshold``.
+    '''
+    self.write(body)
+
+  def _compress_body(self, body, encoding):
+    cache = self._compression_cache
+    if cache is None:
+      return compress(body, encoding, options.compression_level)
+    key = (encoding, body)
+    compressed = cache.get(key)
+    if compressed is None:
+      compressed = compress(body, encoding, options.compression_level)
+      cache.set(key, compressed)
+    return compressed
+
   def on_connection_close(self):
     '''You should not call this method directly, but if you implement an ``on_connection_close()`` function in a
     method module (where you defined invoke) it will be called when the connection closes if that method was
@@ -382,8 +926,8 @@ class TotoHandler(RequestHandler):
         #clean up
     '''
     for method in self.__active_methods:
-      if hasattr(method, 'on_connection_close'):
-        method.on_connection_close(self);
+      if hasattr(method.module, 'on_connection_close'):
+        method.module.on_connection_close(self);
     self.on_finish()
 
   def register_event_handler(self, event_name, handler, run_on_main_loop=True, deregister_on_finish=False):
@@ -416,8 +960,21 @@ class TotoHandler(RequestHandler):
     self.session = self.db_connection.create_session(user_id, password, verify_password, key=options.hmac_enabled and TotoSession.generate_id())
     return self.session
 
+  @coroutine
+  def create_session_async(self, user_id=None, password=None, verify_password=True):
+    '''Like ``create_session`` but uses ``db_connection.create_session_async()`` to avoid blocking the ``IOLoop``. Returns
+    a ``Future`` that will resolve to the new session.
+    '''
+    self.session = yield self.db_connection.create_session_async(user_id, password, verify_password, key=options.hmac_enabled and TotoSession.generate_id())
+    raise Return(self.session)
+
   def _verify_hmac(self, session, request, headers):
-    self.session.verify('x-toto-hmac' in headers and headers['x-toto-hmac'], request.method + request.uri + (request.body or ''))
+    start = time.time()
+    stream = not request.body and self._body_stream
+    try:
+      self.session.verify('x-toto-hmac' in headers and headers['x-toto-hmac'], request.method + request.uri + (request.body or ''), stream and stream.chunks() or ())
+    finally:
+      self._record_phase('hmac', start)
 
   def _response_hmac(self, session, response_body):
     return self.session.hmac(session.session_id + response_body)
@@ -436,12 +993,52 @@ class TotoHandler(RequestHandler):
       if not session_id and 'x-toto-session-id' in headers:
         session_id = headers['x-toto-session-id']
       if session_id:
+        start = time.time()
         self.session = self.db_connection.retrieve_session(session_id)
+        self._record_phase('session', start)
       if options.hmac_enabled and self.session:
         self._verify_hmac(self.session, self.request, headers)
     return self.session
 
+  @coroutine
+  def retrieve_session_async(self, session_id=None):
+    '''Like ``retrieve_session`` but uses ``db_connection.retrieve_session_async()`` to avoid blocking the ``IOLoop``. Returns
+    a ``Future`` that will resolve to the session (or ``None``). The session decorators in ``toto.invocation`` use this method
+    automatically when applied to coroutines.
+    '''
+    if not self.session or (session_id and self.session.session_id != session_id):
+      headers = self.request.headers
+      if not session_id and 'x-toto-session-id' in headers:
+        session_id = headers['x-toto-session-id']
+      if session_id:
+        start = time.time()
+        self.session = yield self.db_connection.retrieve_session_async(session_id)
+        self._record_phase('session', start)
+      if options.hmac_enabled and self.session:
+        self._verify_hmac(self.session, self.request, headers)
+    raise Return(self.session)
+
+  def add_finish_callback(self, callback):
+    '''Calls ``callback()`` once this request has finished, either because a response was sent or because the client
+    closed the connection. If the request has already finished, ``callback()`` is called immediately. Decorators use
+    this to clean up after ``@asynchronous`` methods that don't call ``respond()``.
+    '''
+    if self._finish_callbacks is None:
+      callback()
+    else:
+      self._finish_callbacks.append(callback)
+
   def on_finish(self):
+    callbacks, self._finish_callbacks = self._finish_callbacks, None
+    for callback in callbacks or ():
+      try:
+        callback()
+      except Exception:
+        logging.error(format_exc())
+    if self.phases is not None:
+      self._slow_log.log(self.request, self.get_status(), self.phases)
+    if self._body_stream:
+      self._body_stream.close()
     while self.registered_event_handlers:
       self.deregister_event_handler(self.registered_event_handlers[0])
 
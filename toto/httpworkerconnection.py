@@ -4,6 +4,7 @@ import zlib
 import logging
 from toto.exceptions import *
 from toto.workerconnection import WorkerConnection
+from toto.slowlog import phase_recorder
 from threading import Thread, Lock
 from tornado.options import options
 from tornado.gen import coroutine, Return
@@ -108,11 +109,14 @@ class HTTPWorkerConnection(WorkerConnection):
     if request.retry_count and request.timeout:
       IOLoop.current().add_timeout(time() + request.timeout, self.handle_timeout, request)
 
-  def invoke(self, method, parameters={}, timeout=None, auto_retry_count=None, **kwargs):
+  def invoke(self, method, parameters={}, timeout=None, auto_retry_count=None, deadline=None, **kwargs):
     '''Invoke a ``method`` to be run on a remote worker process with the given ``parameters``. If specified, ``callback`` will be
        invoked with any response from the remote worker. By default the worker will timeout or retry based on the settings of the
        current ``WorkerConnection`` but ``timeout`` and ``auto_retry_count`` can be used for invocation specific behavior.
 
+       The ``deadline`` (a ``time.time()`` value) is sent with the message so the worker can drop the task if it has already
+       expired. It defaults to the deadline of the current request, see ``toto.deadline``.
+
        ``invoke()`` returns a future that may be used to yield the result.
 
        Alternatively, you can invoke methods with ``WorkerConnection.<module>.<method>(*args, **kwargs)``
@@ -120,13 +124,19 @@ class HTTPWorkerConnection(WorkerConnection):
     '''
 
     headers = {'Content-Type': self.mime}
-    body = self.compress(self.dumps({'method': method, 'parameters': parameters}))
+    span = self._start_span(method)
+    body = self.compress(self.dumps(self._message(method, parameters, deadline, span)))
     timeout = timeout if timeout is not None else self.timeout
     auto_retry_count = auto_retry_count if auto_retry_count is not None else self.auto_retry_count
     future = Future()
     request = _Request(headers, body, timeout, auto_retry_count, future, self.handle_response)
 
     self.__active_requests[request.request_id] = request
+    record_phase = phase_recorder('worker', method)
+    if record_phase:
+      future.add_done_callback(record_phase)
+    if span:
+      future.add_done_callback(lambda f: span.finish(f.exception()))
     request.run_request(self.__next_endpoint())
     if auto_retry_count and timeout:
       IOLoop.current().add_timeout(time() + timeout, self.handle_timeout, request)
@@ -6,15 +6,21 @@ from exceptions import *
 from tornado.options import options
 from traceback import format_exc
 from tornado.gen import coroutine, Return, engine
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from collections import deque
 from toto.tasks import TaskQueue
+from toto.cache import LRUCache
 import logging
 import json
+import hashlib
+from math import ceil
 
 """
 This is a list of all attributes that may be added by a decorator,
 it is used to allow decorators to be order agnostic.
 """
-invocation_attributes = ['asynchronous', '__doc__', '__module__', '__name__', '__repr__']
+invocation_attributes = ['asynchronous', '__tornado_coroutine__', 'invalidate', 'admission_queue', 'timeout', 'max_body_size', '__doc__', '__module__', '__name__', '__repr__']
 
 def _add_doc(fn, wrapper, doc):
   '''A convenience method for appending to a decorated method's docstring.'''
@@ -33,6 +39,50 @@ def _copy_attributes(fn, wrapper, doc=None, attributes=invocation_attributes):
   if doc:
     _add_doc(fn, wrapper, doc)
 
+def _is_coroutine(fn):
+  '''Returns ``True`` if ``fn`` is a Tornado coroutine or a decorated function that wraps one.'''
+  return getattr(fn, '__tornado_coroutine__', False)
+
+def _scope_value(handler, scope):
+  '''Returns the value that identifies ``scope`` ("global", "session" or "user") for the current request.'''
+  if scope == 'session':
+    return handler.session and handler.session.session_id
+  if scope == 'user':
+    return handler.session and handler.session.user_id
+  return None
+
+def _cache_key(handler, scope, key, parameters):
+  '''Returns the key for ``parameters`` in ``scope``, or ``None`` if the scope is not available for the current request
+  (e.g. "user" scope on an anonymous request, or before the session has been loaded).
+  '''
+  scope_value = _scope_value(handler, scope)
+  if scope_value is None and scope != 'global':
+    return None
+  return (scope_value, key(parameters))
+
+def _parameters_key(parameters):
+  '''The default cache key for a request's parameters.'''
+  return json.dumps(parameters, sort_keys=True, default=repr)
+
+class _RespondProxy(object):
+  '''Wraps a handler (or ``BatchHandlerProxy``) so that ``callback(result, error)`` is called when an
+  ``@asynchronous`` method calls ``handler.respond()``. All other attributes are passed through to the handler.
+  '''
+
+  def __init__(self, handler, callback):
+    self.__dict__['_handler'] = handler
+    self.__dict__['_callback'] = callback
+
+  def __getattr__(self, attr):
+    return getattr(self._handler, attr)
+
+  def __setattr__(self, attr, value):
+    setattr(self._handler, attr, value)
+
+  def respond(self, result=None, error=None, *args, **kwargs):
+    self._callback(result, error)
+    return self._handler.respond(result, error, *args, **kwargs)
+
 def asynchronous(fn):
   '''Invoke functions with the ``@asynchronous`` decorator will not cause the request
   handler to finish when they return. Use this decorator to support long running
@@ -48,12 +98,22 @@ def anonymous_session(fn):
 
   Note: If the user was previously authenticated, the authenticated session
   will be loaded.
+
+  If the decorated function is a coroutine, the session will be loaded (or created) asynchronously.
   '''
-  def wrapper(handler, parameters):
-    handler.retrieve_session()
-    if not handler.session:
-      handler.create_session()
-    return fn(handler, parameters)
+  if _is_coroutine(fn):
+    @coroutine
+    def wrapper(handler, parameters):
+      yield handler.retrieve_session_async()
+      if not handler.session:
+        yield handler.create_session_async()
+      raise Return((yield fn(handler, parameters)))
+  else:
+    def wrapper(handler, parameters):
+      handler.retrieve_session()
+      if not handler.session:
+        handler.create_session()
+      return fn(handler, parameters)
   _copy_attributes(fn, wrapper, '*If not authenticated, this request will use an anonymous session for state persistence*.')
   return wrapper
 
@@ -62,12 +122,22 @@ def authenticated(fn):
   load the current session (either referenced by the x-toto-session-id request header or cookie).
   If no session is found, or if the current session is anonymous, a "Not authorized"
   error will be returned to the client.
+
+  If the decorated function is a coroutine, the session will be loaded asynchronously.
   '''
-  def wrapper(handler, parameters):
-    handler.retrieve_session()
-    if not handler.session or not handler.session.user_id:
-      raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
-    return fn(handler, parameters)
+  if _is_coroutine(fn):
+    @coroutine
+    def wrapper(handler, parameters):
+      yield handler.retrieve_session_async()
+      if not handler.session or not handler.session.user_id:
+        raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
+      raise Return((yield fn(handler, parameters)))
+  else:
+    def wrapper(handler, parameters):
+      handler.retrieve_session()
+      if not handler.session or not handler.session.user_id:
+        raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
+      return fn(handler, parameters)
   _copy_attributes(fn, wrapper, '*Requires authentication*.')
   return wrapper
 
@@ -75,10 +145,18 @@ def optionally_authenticated(fn):
   '''Invoke functions marked with the ``@optionally_authenticated`` decorator will
   attempt to load the current session (either referenced by the x-toto-session-id request header or cookie).
   If no session is found, the request proceeds as usual.
+
+  If the decorated function is a coroutine, the session will be loaded asynchronously.
   '''
-  def wrapper(handler, parameters):
-    handler.retrieve_session()
-    return fn(handler, parameters)
+  if _is_coroutine(fn):
+    @coroutine
+    def wrapper(handler, parameters):
+      yield handler.retrieve_session_async()
+      raise Return((yield fn(handler, parameters)))
+  else:
+    def wrapper(handler, parameters):
+      handler.retrieve_session()
+      return fn(handler, parameters)
   _copy_attributes(fn, wrapper)
   return wrapper
 
@@ -87,16 +165,59 @@ def authenticated_with_parameter(fn):
   behave like functions decorated with ``@authenticated`` but will use the session_id
   parameter to find the current session instead of the x-toto-session-id header or cookie.
   '''
-  def wrapper(handler, parameters):
-    if 'session_id' in parameters:
-      handler.retrieve_session(parameters['session_id'])
-      del parameters['session_id']
-    if not handler.session:
-      raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
-    return fn(handler, parameters)
+  if _is_coroutine(fn):
+    @coroutine
+    def wrapper(handler, parameters):
+      if 'session_id' in parameters:
+        yield handler.retrieve_session_async(parameters['session_id'])
+        del parameters['session_id']
+      if not handler.session:
+        raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
+      raise Return((yield fn(handler, parameters)))
+  else:
+    def wrapper(handler, parameters):
+      if 'session_id' in parameters:
+        handler.retrieve_session(parameters['session_id'])
+        del parameters['session_id']
+      if not handler.session:
+        raise TotoException(ERROR_NOT_AUTHORIZED, "Not authorized")
+      return fn(handler, parameters)
   _copy_attributes(fn, wrapper, '*Authenticated session. Requires the session to be passed as* ``session_id``.')
   return wrapper
 
+def preload_account(*keys, **kwargs):
+  '''Invoke functions marked with the ``@preload_account`` decorator will load the account properties in ``keys`` with
+  a single database query before they are called, instead of one query for each property as it is first read. Pass
+  ``ttl`` to reuse properties loaded for the same user by earlier requests in the current process for up to ``ttl``
+  seconds (see ``TotoAccount.preload()``). Place ``@preload_account`` below the session decorator so the session is
+  loaded first::
+
+    @authenticated
+    @preload_account('display_name', 'email', 'avatar', ttl=30)
+    def invoke(handler, parameters):
+      account = handler.session.get_account()
+      return {'display_name': account['display_name'], 'email': account['email'], 'avatar': account['avatar']}
+
+  Nothing is loaded for requests without an authenticated session. If the decorated function is a coroutine, the
+  properties will be loaded asynchronously.
+  '''
+  ttl = kwargs.get('ttl', 0)
+  def decorator(fn):
+    if _is_coroutine(fn):
+      @coroutine
+      def wrapper(handler, parameters):
+        if handler.session and handler.session.user_id:
+          yield handler.db_connection._run_session_task(handler.session.get_account().preload, keys, ttl)
+        raise Return((yield fn(handler, parameters)))
+    else:
+      def wrapper(handler, parameters):
+        if handler.session and handler.session.user_id:
+          handler.session.get_account().preload(keys, ttl)
+        return fn(handler, parameters)
+    _copy_attributes(fn, wrapper, '*Preloads account properties:* %s.' % ', '.join('``%s``' % k for k in keys))
+    return wrapper
+  return decorator
+
 def requires(*args):
   '''Invoke functions marked with the ``@requires`` decorator will error if any of the parameters
   passed to the decorator are missing. The following example will error if either "param1" or "param2"
@@ -130,6 +251,94 @@ def raw_response(fn):
   _copy_attributes(fn, wrapper)
   return wrapper
 
+def file_response(fn):
+  '''Invoke functions marked with the ``@file_response`` decorator should return a path, file descriptor or file object
+  which will be sent to the client with ``handler.respond_file()``, streaming it from disk and supporting range and
+  conditional requests. Set ``handler.response_type`` to override the "Content-Type" header, which is otherwise guessed
+  from the path. Methods may be coroutines, e.g. to check permissions before returning the file::
+
+    @file_response
+    @authenticated
+    @coroutine
+    def invoke(handler, parameters):
+      attachment = yield load_attachment(handler.session.user_id, parameters['attachment_id'])
+      raise Return(attachment.path)
+  '''
+  @coroutine
+  def wrapper(handler, parameters):
+    response_type = handler.response_type
+    handler.response_type = None
+    try:
+      result = fn(handler, parameters)
+      if isinstance(result, Future):
+        result = yield result
+      yield handler.respond_file(result, handler.response_type)
+    except Exception:
+      #errors are sent with the negotiated codec
+      handler.response_type = response_type
+      raise
+  _copy_attributes(fn, wrapper)
+  return wrapper
+
+def etag(version=None):
+  '''Invoke functions marked with the ``@etag`` decorator will send an "etag" header with GET and HEAD responses and
+  answer requests with a matching "if-none-match" header with "304 Not Modified" and no body.
+
+  If ``version`` is set, ``version(handler, parameters)`` is called before the method and its result, which should
+  change whenever the response would (e.g. a row's ``updated_at``), is combined with the request parameters, the
+  response type and the session's ``user_id`` to make the etag. For coroutine methods ``version`` may return a
+  ``Future``. When the client already has that version, the method is not invoked at all::
+
+    @authenticated
+    @etag(lambda handler, parameters: handler.db.get_updated_at('documents', parameters['document_id']))
+    def invoke(handler, parameters):
+      return load_document(parameters['document_id'])
+
+  Otherwise, the etag is a hash of the serialized response, saving the response transfer but not the work to create
+  it. Responses that include session information change when the session is renewed, so use ``version`` for
+  methods that require a session. Place ``@etag`` below session decorators and above ``@tornado.gen.coroutine``.
+  Batch requests and other HTTP methods are not affected.
+  '''
+  def decorator(fn):
+    def check(handler, parameters, key):
+      tag = '"%s"' % hashlib.sha1(repr((key, _parameters_key(parameters), handler.response_type, handler.session and handler.session.user_id))).hexdigest()
+      handler.set_header('etag', tag)
+      if handler.etag_matches(tag):
+        handler.set_status(304)
+        handler.headers_only = True
+        handler.respond_raw('', handler.response_type)
+        return True
+      return False
+
+    def conditional(handler):
+      from toto.handler import BatchHandlerProxy
+      return handler.request.method in ('GET', 'HEAD') and not isinstance(handler, BatchHandlerProxy)
+
+    if version is None:
+      def wrapper(handler, parameters):
+        if conditional(handler):
+          handler._etag_response = True
+        return fn(handler, parameters)
+    elif _is_coroutine(fn):
+      @coroutine
+      def wrapper(handler, parameters):
+        if conditional(handler):
+          key = version(handler, parameters)
+          if isinstance(key, Future):
+            key = yield key
+          if check(handler, parameters, key):
+            return
+        result = yield fn(handler, parameters)
+        raise Return(result)
+    else:
+      def wrapper(handler, parameters):
+        if conditional(handler) and check(handler, parameters, version(handler, parameters)):
+          return None
+        return fn(handler, parameters)
+    _copy_attributes(fn, wrapper, '*Supports conditional GET requests with "if-none-match".*')
+    return wrapper
+  return decorator
+
 def jsonp(callback_name='jsonp'):
   '''Invoke functions marked with the ``@jsonp`` decorator will return a wrapper response that will
   call a client-side javascript function. This decorator requires a "jsonp" parameter set to the name of the javascript
@@ -213,3 +422,401 @@ def default_parameters(defaults):
     _copy_attributes(fn, wrapper, '*Automatically adds default parameters:* %s.' % ', '.join(('``%s: %s``' % (k, v) for k, v in defaults.iteritems())))
     return wrapper
   return decorator
+
+def deadline(timeout):
+  '''Invoke functions marked with the ``@deadline`` decorator will use a default deadline of ``timeout`` seconds
+  from the start of the request instead of the ``request_timeout`` option. A shorter deadline sent by the client
+  in the "x-toto-timeout" header takes precedence. See ``toto.deadline`` for details.
+  '''
+  def decorator(fn):
+    fn.timeout = timeout
+    _add_doc(fn, fn, '*Requests time out after %s seconds.*' % timeout)
+    return fn
+  return decorator
+
+def max_body_size(size):
+  '''Invoke functions marked with the ``@max_body_size`` decorator will reject request bodies larger than ``size``
+  bytes with HTTP status 413, replacing the ``max_body_size`` option. When the ``stream_uploads`` option is set, the
+  limit is checked before the body is read. The limit only applies to methods named in the request URL
+  (e.g. "/upload/image") since the body must be read to find any other method.
+  '''
+  def decorator(fn):
+    fn.max_body_size = size
+    _add_doc(fn, fn, '*Accepts request bodies of up to %s bytes.*' % size)
+    return fn
+  return decorator
+
+def cached(ttl=60, key=None, scope='global', max_size=1000, serialize=False, invalidation_event=None):
+  '''Invoke functions marked with the ``@cached`` decorator will have their results stored in an in-process LRU cache of
+  up to ``max_size`` entries for ``ttl`` seconds. Results are cached by request parameters, or by the return value of
+  ``key(parameters)`` if ``key`` is set, and by ``scope``:
+
+  * "global" - one result is shared by all clients.
+  * "session" - results are cached separately for each session.
+  * "user" - results are cached separately for each ``user_id``.
+
+  When using "session" or "user" scope, place ``@cached`` below the session decorator so the session is loaded first.
+  Requests without a session (or, for "user" scope, without an authenticated session) are never cached::
+
+    @authenticated
+    @cached(ttl=30, scope='user')
+    def invoke(handler, parameters):
+      return load_leaderboard(handler.session.user_id)
+
+  Cached results are shared between requests and must not be modified. Sync, ``@asynchronous`` and coroutine methods
+  are supported, though ``@asynchronous`` methods are only cached when they call ``handler.respond()``. Place ``@cached``
+  above ``@asynchronous`` and ``@tornado.gen.coroutine``.
+
+  If ``serialize`` is ``True``, the serialized response body will also be cached and sent directly for requests without
+  a session, skipping serialization entirely.
+
+  The decorated function gains an ``invalidate(parameters=None, scope=None)`` function that can be called from other
+  methods, e.g. ``catalog.get.invoke.invalidate({'category': 'books'})``. ``scope`` is the session ID or user ID to
+  invalidate. Passing neither argument clears the whole cache. If ``invalidation_event`` is set, invalidations will also be
+  sent to every server registered with ``toto.events.EventManager`` so caches in other processes are kept consistent.
+  '''
+  cache = LRUCache(max_size, ttl)
+  key = key or _parameters_key
+  registration = []
+
+  def store(cache_key, result):
+    if invalidation_event and not registration:
+      from toto.events import EventManager
+      registration.append(EventManager.instance().register_handler(invalidation_event, lambda args: invalidate_local(*args), persist=True))
+    entry = [result, {}]
+    cache.set(cache_key, entry)
+    return entry
+
+  def respond(handler, entry):
+    if serialize and not handler.session:
+      from toto.handler import BatchHandlerProxy
+      if not isinstance(handler, BatchHandlerProxy):
+        response_type = handler.response_type
+        body = entry[1].get(response_type)
+        if body is None:
+          body = entry[1][response_type] = handler.encode_response(entry[0])
+        handler.respond_raw(body, response_type)
+        return None
+    return entry[0]
+
+  def invalidate_local(parameters=None, scope=None):
+    if parameters is None:
+      if scope is None:
+        cache.clear()
+      else:
+        cache.remove_where(lambda k, v: k[0] == scope)
+    else:
+      cache.remove((scope, key(parameters)))
+
+  def invalidate(parameters=None, scope=None):
+    invalidate_local(parameters, scope)
+    if invalidation_event:
+      from toto.events import EventManager
+      EventManager.instance().send(invalidation_event, (parameters, scope))
+
+  def decorator(fn):
+    if _is_coroutine(fn):
+      @coroutine
+      def wrapper(handler, parameters):
+        cache_key = _cache_key(handler, scope, key, parameters)
+        if cache_key is None:
+          raise Return((yield fn(handler, parameters)))
+        entry = cache.get(cache_key)
+        if entry is None:
+          entry = store(cache_key, (yield fn(handler, parameters)))
+        raise Return(respond(handler, entry))
+    elif hasattr(fn, 'asynchronous'):
+      def wrapper(handler, parameters):
+        cache_key = _cache_key(handler, scope, key, parameters)
+        if cache_key is None:
+          return fn(handler, parameters)
+        entry = cache.get(cache_key)
+        if entry is not None:
+          return entry[0]
+        def on_respond(result, error):
+          if error is None:
+            store(cache_key, result)
+        result = fn(_RespondProxy(handler, on_respond), parameters)
+        if result is not None:
+          store(cache_key, result)
+        return result
+    else:
+      def wrapper(handler, parameters):
+        cache_key = _cache_key(handler, scope, key, parameters)
+        if cache_key is None:
+          return fn(handler, parameters)
+        entry = cache.get(cache_key)
+        if entry is None:
+          result = fn(handler, parameters)
+          if isinstance(result, Future):
+            result.add_done_callback(lambda f: f.exception() or store(cache_key, f.result()))
+            return result
+          entry = store(cache_key, result)
+        return respond(handler, entry)
+    _copy_attributes(fn, wrapper, '*Results are cached for %s seconds (scope: %s).*' % (ttl, scope))
+    wrapper.invalidate = invalidate
+    return wrapper
+  return decorator
+
+def coalesce(key=None, scope='global', timeout=60):
+  '''Concurrent invocations of functions marked with the ``@coalesce`` decorator that share the same parameters (or
+  return value of ``key(parameters)`` if ``key`` is set) and ``scope`` will be combined into a single call. The first
+  request runs the function and every identical request that arrives before it completes receives the same result or
+  error. ``scope`` works as it does for ``@cached``.
+
+  Coalescing only applies within a single process and only to calls that are in flight at the same time, so it is
+  most useful for coroutine and ``@asynchronous`` methods (or functions returning a ``Future``) that wait on a database
+  or worker. Combine it with ``@cached`` to prevent a stampede of identical requests when a cache entry expires::
+
+    @cached(ttl=60)
+    @coalesce()
+    @coroutine
+    def invoke(handler, parameters):
+      result = yield load_catalog(parameters['category'])
+      raise Return(result)
+
+  Results are shared between requests and must not be modified. Place ``@coalesce`` above ``@asynchronous`` and
+  ``@tornado.gen.coroutine``.
+
+  ``@asynchronous`` methods share the result passed to ``handler.respond()``. If the first request finishes without
+  calling ``respond()`` (e.g. it uses ``respond_raw()`` or the client disconnects), or hasn't responded after
+  ``timeout`` seconds, the waiting requests fail with ``ERROR_SERVICE_UNAVAILABLE`` and the next identical request
+  runs the method again. Pass ``timeout=None`` to wait indefinitely.
+  '''
+  key = key or _parameters_key
+  in_flight = {}
+
+  def track(cache_key, future):
+    in_flight[cache_key] = future
+    def complete(f):
+      if in_flight.get(cache_key) is f:
+        del in_flight[cache_key]
+    future.add_done_callback(complete)
+    return future
+
+  def decorator(fn):
+    if hasattr(fn, 'asynchronous'):
+      def wrapper(handler, parameters):
+        cache_key = _cache_key(handler, scope, key, parameters)
+        if cache_key is None:
+          return fn(handler, parameters)
+        future = in_flight.get(cache_key)
+        if future is not None:
+          future.add_done_callback(lambda f: handler.respond(*f.result()))
+          return None
+        future = track(cache_key, Future())
+        def on_respond(result, error):
+          if not future.done():
+            future.set_result((result, error))
+        def abandon():
+          on_respond(None, TotoException(ERROR_SERVICE_UNAVAILABLE, 'Coalesced request did not respond.'))
+        handler.add_finish_callback(abandon)
+        if timeout is not None:
+          loop = IOLoop.instance()
+          timer = loop.call_later(timeout, abandon)
+          future.add_done_callback(lambda f: loop.add_callback(loop.remove_timeout, timer))
+        try:
+          result = fn(_RespondProxy(handler, on_respond), parameters)
+        except Exception as e:
+          on_respond(None, e)
+          raise
+        if result is not None:
+          on_respond(result, None)
+        return result
+    else:
+      def wrapper(handler, parameters):
+        cache_key = _cache_key(handler, scope, key, parameters)
+        if cache_key is None:
+          return fn(handler, parameters)
+        future = in_flight.get(cache_key)
+        if future is not None:
+          return future
+        result = fn(handler, parameters)
+        if isinstance(result, Future) and not result.done():
+          track(cache_key, result)
+        return result
+    _copy_attributes(fn, wrapper, '*Identical concurrent requests are coalesced (scope: %s).*' % scope)
+    return wrapper
+  return decorator
+
+class AdmissionQueue(object):
+  '''Limits the number of concurrent calls to a method decorated with ``@limit``. Calls beyond ``concurrency`` wait in a
+  FIFO queue of up to ``queue`` calls for at most ``timeout`` seconds. The following attributes may be read to monitor
+  the queue:
+
+  * ``active`` - the number of calls currently running.
+  * ``queued`` - the number of calls waiting to run.
+  * ``rejected`` - the number of calls rejected because the queue was full.
+  * ``timeouts`` - the number of calls rejected because they waited longer than ``timeout``.
+  '''
+
+  def __init__(self, concurrency, queue=0, timeout=None):
+    self.concurrency = concurrency
+    self.max_queued = queue
+    self.timeout = timeout
+    self.active = 0
+    self.rejected = 0
+    self.timeouts = 0
+    self._waiting = deque()
+
+  @property
+  def queued(self):
+    return len(self._waiting)
+
+  def stats(self):
+    return {'active': self.active, 'queued': self.queued, 'rejected': self.rejected, 'timeouts': self.timeouts}
+
+  def acquire(self):
+    '''Returns a ``Future`` that resolves when the caller may run. The ``Future`` fails with a ``TotoException``
+    (``ERROR_SERVICE_UNAVAILABLE``) if the queue is full or the timeout expires. Every successful ``acquire()``
+    must be followed by a call to ``release()``.
+    '''
+    future = Future()
+    if self.active < self.concurrency:
+      self.active += 1
+      future.set_result(None)
+    elif len(self._waiting) >= self.max_queued:
+      self.rejected += 1
+      future.set_exception(TotoException(ERROR_SERVICE_UNAVAILABLE, 'Server busy.'))
+    else:
+      self._waiting.append(future)
+      if self.timeout:
+        IOLoop.current().call_later(self.timeout, self._expire, future)
+    return future
+
+  def release(self):
+    self.active -= 1
+    if self._waiting:
+      self.active += 1
+      self._waiting.popleft().set_result(None)
+
+  def _expire(self, future):
+    if future.done():
+      return
+    self._waiting.remove(future)
+    self.timeouts += 1
+    future.set_exception(TotoException(ERROR_SERVICE_UNAVAILABLE, 'Server busy.'))
+
+_admission_queues = {}
+
+def admission_stats():
+  '''Returns a ``dict`` mapping the module name of each method decorated with ``@limit`` to the result of
+  ``AdmissionQueue.stats()`` for that method.
+  '''
+  return dict((module, queue.stats()) for module, queue in _admission_queues.iteritems())
+
+def limit(concurrency, queue=0, timeout=None):
+  '''Invoke functions marked with the ``@limit`` decorator will run at most ``concurrency`` calls at once in each
+  server process. Up to ``queue`` additional calls will wait, first in first out, for up to ``timeout`` seconds (or
+  indefinitely if ``timeout`` is ``None``). Calls that can't be queued or that time out fail immediately with
+  ``ERROR_SERVICE_UNAVAILABLE`` so clients can back off or retry elsewhere instead of waiting on an overloaded server.
+  Limits are tracked separately for each method, so slow methods can't starve other methods in the same process::
+
+    @limit(concurrency=4, queue=20, timeout=2)
+    @coroutine
+    def invoke(handler, parameters):
+      report = yield generate_report(parameters['report_id'])
+      raise Return(report)
+
+  Limits only apply to calls that wait on the ``IOLoop``: coroutines, ``@asynchronous`` methods and methods returning a
+  ``Future``. Place ``@limit`` above ``@asynchronous``, ``@tornado.gen.coroutine`` and any session decorators so
+  requests are shed before any work is done. The decorated function's ``AdmissionQueue`` is available as
+  ``invoke.admission_queue`` and is included in the metrics served at ``metrics_path``.
+
+  ``@asynchronous`` methods hold their slot until they call ``handler.respond()`` or the request finishes.
+  '''
+  def decorator(fn):
+    admission_queue = AdmissionQueue(concurrency, queue, timeout)
+    _admission_queues[fn.__module__] = admission_queue
+    if hasattr(fn, 'asynchronous'):
+      def wrapper(handler, parameters):
+        released = []
+        def release(result=None, error=None):
+          if not released:
+            released.append(True)
+            admission_queue.release()
+        def run():
+          proxy = _RespondProxy(handler, release)
+          handler.add_finish_callback(release)
+          try:
+            result = fn(proxy, parameters)
+          except Exception:
+            release()
+            raise
+          if result is not None:
+            release()
+          return result
+        admission = admission_queue.acquire()
+        if admission.done():
+          admission.result()
+          return run()
+        def admitted(f):
+          try:
+            f.result()
+            result = run()
+          except Exception as e:
+            handler.respond(error=e)
+            return
+          if result is not None:
+            handler.respond(result)
+        admission.add_done_callback(admitted)
+    else:
+      @coroutine
+      def wrapper(handler, parameters):
+        yield admission_queue.acquire()
+        try:
+          result = fn(handler, parameters)
+          if isinstance(result, Future):
+            result = yield result
+        finally:
+          admission_queue.release()
+        raise Return(result)
+    _copy_attributes(fn, wrapper, '*Limited to %s concurrent calls with %s queued.*' % (concurrency, queue))
+    wrapper.admission_queue = admission_queue
+    return wrapper
+  return decorator
+
+def _rate_limit_key(handler, parameters, key):
+  if callable(key):
+    return key(handler, parameters)
+  if key == 'user' and handler.session and handler.session.user_id:
+    return 'user:%s' % handler.session.user_id
+  return 'ip:%s' % handler.request.remote_ip
+
+def rate_limit(rate, burst=None, key='user'):
+  '''Invoke functions marked with the ``@rate_limit`` decorator will accept ``rate`` calls per second from each client
+  with bursts of up to ``burst`` calls (``rate`` rounded up if ``burst`` is not set). Calls beyond the limit fail
+  with ``ERROR_RATE_LIMITED`` and a "retry-after" header with the number of seconds until the next call will be
+  accepted. ``key`` identifies the client:
+
+  * "user" - the session's ``user_id``, or the client's IP address for requests without an authenticated session.
+  * "ip" - the client's IP address.
+  * A function - ``key(handler, parameters)`` is called and its result used, e.g. to limit by API key.
+
+  Limits are tracked separately for each method and are shared by every server process, or by every server when the
+  ``rate_limit_backend`` option is "redis". See ``toto.ratelimit`` for details. When using "user", place
+  ``@rate_limit`` below the session decorator so the session is loaded first::
+
+    @authenticated
+    @rate_limit(rate=5, burst=20)
+    def invoke(handler, parameters):
+      return send_message(handler.session.user_id, parameters['message'])
+
+  Place ``@rate_limit`` above ``@asynchronous`` and ``@tornado.gen.coroutine``.
+  '''
+  burst = burst or int(ceil(rate))
+
+  def decorator(fn):
+    prefix = '%s:' % fn.__module__
+    def wrapper(handler, parameters):
+      from toto.ratelimit import get_backend
+      allowed, retry_after = get_backend().consume(prefix + str(_rate_limit_key(handler, parameters, key)), rate, burst)
+      if not allowed:
+        from toto.handler import BatchHandlerProxy
+        if not isinstance(handler, BatchHandlerProxy):
+          handler.set_header('retry-after', int(ceil(retry_after)))
+        raise TotoException(ERROR_RATE_LIMITED, 'Rate limit exceeded.')
+      return fn(handler, parameters)
+    _copy_attributes(fn, wrapper, '*Limited to %s calls per second per %s.*' % (rate, callable(key) and 'key' or key))
+    return wrapper
+  return decorator
@@ -4,6 +4,7 @@ from time import time, mktime
 from datetime import datetime
 from dbconnection import DBConnection
 import json
+from base64 import b64encode, b64decode
 
 class JSONSession(TotoSession):
   _account = None
@@ -24,6 +25,9 @@ class JSONSession(TotoSession):
         super(JSONSession.JSONAccount, self).__setitem__(key, value)
 
   def __init__(self, db, session_data, session_cache=None):
+    # base64 encoded state starts with "/" (the codec's 0xff header), older files hold plain pickles
+    if isinstance(session_data.get('state'), basestring) and session_data['state'].startswith('/'):
+      session_data = dict(session_data, state=b64decode(session_data['state']))
     super(JSONSession, self).__init__(db, session_data, session_cache)
 
   def get_account(self):
@@ -31,16 +35,25 @@ class JSONSession(TotoSession):
       self._account = JSONSession.JSONAccount(self)
     return self._account
 
-  def session_data(self):
-   return {'user_id': self.user_id, 'expires': self.expires, 'session_id': self.session_id, 'state': TotoSession.dumps(self.state)}
+  def session_data(self, encode_state=True):
+    data = super(JSONSession, self).session_data(encode_state)
+    if encode_state:
+      data['state'] = b64encode(data['state'])
+    return data
 
   def refresh(self):
     session_data = self._refresh_cache() or self._db.get("session", self.session_id)
     self.__init__(self._db, session_data, self._session_cache)
 
   def save(self):
-    if not self._save_cache():
-      self._db.set('session', self.session_id, self.session_data())
+    state = self._dumps_modified_state()
+    if state is None:
+      return
+    if not self._save_cache(state):
+      session_data = self.session_data(False)
+      session_data['state'] = state
+      self._db.set('session', self.session_id, session_data)
+    self._mark_saved(state)
 
 class JSONConnection(DBConnection):
   '''A JSON based implementation of DBConnection. Used for debugging. and not
@@ -113,7 +126,11 @@ class JSONConnection(DBConnection):
   def _instantiate_session(self, session_data, session_cache):
     return JSONSession(self, session_data, session_cache)
 
-  def remove_session(self, session_id):
+  def _update_expiry(self, session_id, session_data):
+    if self.get('session', session_id):
+      self.set('session', session_id, expires=session_data['expires'])
+
+  def _remove_session(self, session_id):
     self.set('session', session_id, None)
 
   def _load_uncached_data(self, session_id):
@@ -125,7 +142,7 @@ class JSONConnection(DBConnection):
       return None
     return {'password': account['password']}
 
-  def _update_password(self, user_id, hashed_password):
+  def _update_password(self, user_id, account, hashed_password):
     self.set('account', user_id, 'password', hashed_password)
 
   def clear(self):
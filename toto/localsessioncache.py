@@ -0,0 +1,78 @@
+from toto.session import *
+from toto.cache import LRUCache
+from uuid import uuid4
+from time import time
+
+class LocalSessionCache(TotoSessionCache):
+  '''A ``TotoSessionCache`` that keeps recently used sessions in the memory of the current process.
+  ``LocalSessionCache`` is not meant to be used with ``DBConnection.set_session_cache()``. Instead, pass it to
+  ``DBConnection.set_local_session_cache()`` and it will be checked before the database or any other
+  ``TotoSessionCache`` (e.g. ``RedisSessionCache``) when a session is loaded.
+
+  Up to ``max_size`` sessions will be stored, with the least recently used sessions evicted first. Each
+  session will be kept for at most ``ttl`` seconds, which bounds how long a change made by another process
+  can go unnoticed. Sessions removed through ``DBConnection.remove_session()`` or ``DBConnection.clear_sessions()``
+  are invalidated immediately.
+
+  If ``invalidation_event`` is set, session removals and saves will also be broadcast to every server registered
+  with ``toto.events.EventManager`` under that event name, allowing caches in other processes to drop their copies.
+  '''
+
+  def __init__(self, max_size=10000, ttl=30, invalidation_event=None):
+    self._cache = LRUCache(max_size, ttl)
+    self._source_id = uuid4().hex
+    self._invalidation_event = invalidation_event
+    if invalidation_event:
+      from toto.events import EventManager
+      self._event_manager = EventManager.instance()
+      self._event_manager.register_handler(invalidation_event, self._receive_invalidation, persist=True)
+
+  def store_session(self, session_data, notify=False):
+    '''Store a copy of ``session_data`` in the local cache. If ``notify`` is ``True`` and an ``invalidation_event``
+    was set, other processes will be told to drop their copy of the session.
+    '''
+    self._cache.set(session_data['session_id'], dict(session_data))
+    if notify:
+      self._send_invalidation({'session_ids': [session_data['session_id']]})
+
+  def load_session(self, session_id):
+    '''Return a copy of the cached ``session_data`` for ``session_id`` or ``None`` if the session is not cached
+    or has expired.
+    '''
+    session_data = self._cache.get(session_id)
+    if not session_data or session_data['expires'] < time():
+      return None
+    return dict(session_data)
+
+  def remove_session(self, session_id):
+    '''Drop the session with the given ``session_id`` from this and, if configured, every other ``LocalSessionCache``.
+    '''
+    self._cache.remove(session_id)
+    self._send_invalidation({'session_ids': [session_id]})
+
+  def clear_sessions(self, user_id):
+    '''Drop all sessions belonging to ``user_id`` from this and, if configured, every other ``LocalSessionCache``.
+    '''
+    self._remove_user_sessions(user_id)
+    self._send_invalidation({'user_id': user_id})
+
+  def clear(self):
+    '''Drop all sessions from this cache.
+    '''
+    self._cache.clear()
+
+  def _remove_user_sessions(self, user_id):
+    self._cache.remove_where(lambda k, v: v['user_id'] == user_id)
+
+  def _send_invalidation(self, args):
+    if self._invalidation_event:
+      args['source'] = self._source_id
+      self._event_manager.send(self._invalidation_event, args)
+
+  def _receive_invalidation(self, args):
+    if args.get('source') == self._source_id:
+      return
+    for session_id in args.get('session_ids', ()):
+      self._cache.remove(session_id)
+    if 'user_id' in args:
+      self._remove_user_sessions(args['user_id'])
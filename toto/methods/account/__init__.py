@@ -1,5 +1,9 @@
 '''The ``methods.account`` module provides simple implementations of
 common methods around account creation and management.
+
+``create``, ``login`` and ``update`` are coroutines so passwords are hashed without blocking the
+``IOLoop``. Code that calls them directly from a synchronous method should call their ``invoke_sync``
+functions instead of ``invoke``.
 '''
 import create
 import login
@@ -1,7 +1,9 @@
 import login
 from toto.invocation import *
+from tornado.gen import coroutine, Return
 
 @requires('user_id', 'password')
+@coroutine
 def invoke(handler, params):
   '''Create an account with the given ``user_id`` and ``password`` if no account
   matching the ``user_id`` exists. Any other parameters will be added as
@@ -9,7 +11,16 @@ def invoke(handler, params):
   schema, make sure they match existing columns, otherwise an error will be
   returned.
 
+  Returns a ``Future``, use ``invoke_sync`` to create an account from a synchronous method.
+
   Requires: ``user_id``, ``password``
   '''
+  yield handler.db_connection.create_account_async(params['user_id'], params['password'], {k: params[k] for k in params})
+  raise Return((yield login.invoke(handler, params)))
+
+@requires('user_id', 'password')
+def invoke_sync(handler, params):
+  '''Like ``invoke`` but blocks while the password is hashed and returns the response directly.
+  '''
   handler.db_connection.create_account(params['user_id'], params['password'], {k: params[k] for k in params})
-  return login.invoke(handler, params)
+  return login.invoke_sync(handler, params)
@@ -1,13 +1,27 @@
 from toto.invocation import *
+from tornado.gen import coroutine, Return
 
 @requires('user_id', 'password')
+@coroutine
 def invoke(handler, params):
   '''Creates a new session for the account matching ``user_id`` and ``password``. If no
   matching account is found, a "User not found" error will be returned.
 
+  Returns a ``Future``, use ``invoke_sync`` to log in from a synchronous method.
+
   Requires: ``user_id``, ``password``
   '''
+  yield handler.create_session_async(params['user_id'], params['password'])
+  raise Return(_session_response(handler))
+
+@requires('user_id', 'password')
+def invoke_sync(handler, params):
+  '''Like ``invoke`` but blocks while the password is verified and returns the response directly.
+  '''
   handler.create_session(params['user_id'], params['password'])
+  return _session_response(handler)
+
+def _session_response(handler):
   response = {'session_id': handler.session.session_id, 'expires': handler.session.expires, 'user_id': handler.session.user_id}
   if handler.session.key:
     response['key'] = handler.session.key
@@ -1,19 +1,34 @@
-import toto.methods.account.login
+import login
 from toto.invocation import *
+from tornado.gen import coroutine, Return
 
 @authenticated
+@coroutine
 def invoke(handler, params):
+  result = {'updated_fields': []}
+  if 'new_password' in params:
+    yield handler.db_connection.change_password_async(params['user_id'], params['password'], params['new_password'])
+    result['updated_fields'].append('password')
+    result.update((yield login.invoke(handler, {'user_id': params['user_id'], 'password': params['new_password']})))
+    del params['new_password']
+  raise Return(_update_account(handler, params, result))
+
+@authenticated
+def invoke_sync(handler, params):
   result = {'updated_fields': []}
   if 'new_password' in params:
     handler.db_connection.change_password(params['user_id'], params['password'], params['new_password'])
     result['updated_fields'].append('password')
-    result.update(login.invoke(handler, {'user_id': params['user_id'], 'password': params['new_password']}))
+    result.update(login.invoke_sync(handler, {'user_id': params['user_id'], 'password': params['new_password']}))
     del params['new_password']
+  return _update_account(handler, params, result)
+
+def _update_account(handler, params, result):
   del params['password']
   account = handler.session.get_account()
   for k in params:
     account[k] = params[k]
     result['updated_fields'].append(k)
-    account.save()
+  account.save()
   return result
   
@@ -0,0 +1,217 @@
+'''Per-method call counts, error counts and latency histograms. Metrics are enabled by setting the ``metrics_path``
+option, e.g. ``--metrics_path=/metrics``. Each server process records the methods it invokes and periodically writes a
+snapshot to ``metrics_dir``. Requests to ``metrics_path`` combine the snapshots from every process into a single
+report in the Prometheus text format::
+
+  toto_method_calls_total{method="account.login"} 1024
+  toto_method_errors_total{method="account.login"} 3
+  toto_method_duration_seconds{method="account.login",quantile="0.99"} 0.0412
+  toto_method_duration_seconds_sum{method="account.login"} 12.84
+  toto_method_duration_seconds_count{method="account.login"} 1024
+
+Latencies are recorded in log-linear histograms similar to HdrHistogram, so percentiles are accurate to within about 6%
+and can be combined across processes.
+'''
+
+import os
+import json
+import logging
+from glob import glob
+from tornado.web import RequestHandler
+from tornado.ioloop import PeriodicCallback
+from tornado.options import define, options
+from toto.tasks import TaskQueue
+from toto.invocation import admission_stats
+
+define("metrics_path", default=None, type=str, help="If set, per-method metrics will be collected and served at this path in the Prometheus text format (e.g. /metrics).")
+define("metrics_dir", default=None, type=str, help="The directory used to share metrics between server processes. Defaults to a directory in the system temp directory named for the server's port.")
+define("metrics_interval", default=5.0, help="The number of seconds between metrics snapshots written by each server process.")
+
+_SUB_BUCKET_BITS = 4
+_SUB_BUCKETS = 1 << _SUB_BUCKET_BITS
+QUANTILES = (0.5, 0.95, 0.99)
+
+def _bucket_index(value):
+  if value < _SUB_BUCKETS:
+    return value
+  shift = value.bit_length() - _SUB_BUCKET_BITS - 1
+  return shift * _SUB_BUCKETS + (value >> shift)
+
+def _bucket_value(index):
+  if index < _SUB_BUCKETS * 2:
+    return index
+  shift = index / _SUB_BUCKETS - 1
+  return (((index - shift * _SUB_BUCKETS) + 1) << shift) - 1
+
+class Histogram(object):
+  '''A log-linear histogram of integer values (microseconds for method latencies). Values are stored in buckets with
+  a relative width of 1/16 so memory use only grows with the range of recorded values, not their count.
+  '''
+
+  def __init__(self, counts=None, total=0, count=0):
+    self.counts = counts or {}
+    self.total = total
+    self.count = count
+
+  def record(self, value):
+    index = _bucket_index(int(value))
+    self.counts[index] = self.counts.get(index, 0) + 1
+    self.total += value
+    self.count += 1
+
+  def merge(self, other):
+    '''Add the values recorded in ``other`` to this histogram.'''
+    for index, count in other.counts.iteritems():
+      self.counts[index] = self.counts.get(index, 0) + count
+    self.total += other.total
+    self.count += other.count
+
+  def percentile(self, quantile):
+    '''Returns the upper bound of the bucket containing ``quantile`` (0-1) of the recorded values, or 0 if the
+    histogram is empty.
+    '''
+    if not self.count:
+      return 0
+    target = max(quantile * self.count, 1)
+    seen = 0
+    for index in sorted(self.counts):
+      seen += self.counts[index]
+      if seen >= target:
+        return _bucket_value(index)
+    return _bucket_value(max(self.counts))
+
+  def to_dict(self):
+    '''Returns a copy of the histogram that can be serialized with ``json`` while more values are recorded.'''
+    return {'counts': dict(self.counts), 'total': self.total, 'count': self.count}
+
+  @classmethod
+  def from_dict(cls, data):
+    return cls(dict((int(k), v) for k, v in data['counts'].iteritems()), data['total'], data['count'])
+
+class MethodMetrics(object):
+  '''Collects metrics for the methods invoked in the current process. ``record()`` is only called from the ``IOLoop``
+  thread, so no locking is needed. Use ``MethodMetrics.instance()`` to get the process wide instance.
+  '''
+
+  def __init__(self):
+    self.methods = {}
+
+  def record(self, method, duration, error=False):
+    '''Record a call to ``method`` that took ``duration`` seconds.'''
+    try:
+      metrics = self.methods[method]
+    except KeyError:
+      metrics = self.methods[method] = {'calls': 0, 'errors': 0, 'latency': Histogram()}
+    metrics['calls'] += 1
+    if error:
+      metrics['errors'] += 1
+    metrics['latency'].record(duration * 1000000)
+
+  def snapshot(self):
+    '''Returns a JSON serializable copy of the current metrics. Methods decorated with ``@limit`` also include the
+    state of their ``AdmissionQueue``.
+    '''
+    snapshot = dict((method, {'calls': m['calls'], 'errors': m['errors'], 'latency': m['latency'].to_dict()}) for method, m in self.methods.iteritems())
+    prefix = '%s.' % getattr(options, 'method_module', '')
+    for module, stats in admission_stats().iteritems():
+      method = module.startswith(prefix) and module[len(prefix):] or module
+      snapshot.setdefault(method, {'calls': 0, 'errors': 0, 'latency': Histogram().to_dict()})['admission'] = stats
+    return snapshot
+
+  def start_reporting(self, directory, service_id, interval):
+    '''Write a snapshot to ``directory`` every ``interval`` seconds so it can be combined with the other server
+    processes' metrics. Snapshots are written outside of the ``IOLoop``.
+    '''
+    path = os.path.join(directory, '%s.json' % service_id)
+    def report():
+      TaskQueue.instance('toto.metrics').add_task(_write_snapshot, path, self.snapshot())
+    self._reporter = PeriodicCallback(report, interval * 1000)
+    self._reporter.start()
+
+  @classmethod
+  def instance(cls):
+    '''Returns the ``MethodMetrics`` instance for the current process.'''
+    if not hasattr(cls, '_instance'):
+      cls._instance = cls()
+    return cls._instance
+
+def _write_snapshot(path, snapshot):
+  temp_path = '%s.tmp' % path
+  with open(temp_path, 'w') as f:
+    json.dump(snapshot, f)
+  os.rename(temp_path, path)
+
+def merge_snapshots(snapshots):
+  '''Combine a list of snapshots returned by ``MethodMetrics.snapshot()`` into a ``dict`` mapping method names to
+  ``{'calls': int, 'errors': int, 'latency': Histogram}``, plus the combined ``admission`` stats of ``@limit`` methods.
+  '''
+  merged = {}
+  for snapshot in snapshots:
+    for method, m in snapshot.iteritems():
+      if method not in merged:
+        merged[method] = {'calls': 0, 'errors': 0, 'latency': Histogram()}
+      merged[method]['calls'] += m['calls']
+      merged[method]['errors'] += m['errors']
+      merged[method]['latency'].merge(Histogram.from_dict(m['latency']))
+      if 'admission' in m:
+        admission = merged[method].setdefault('admission', {})
+        for k, v in m['admission'].iteritems():
+          admission[k] = admission.get(k, 0) + v
+  return merged
+
+def prometheus_text(metrics):
+  '''Format metrics returned by ``merge_snapshots()`` in the Prometheus text exposition format.'''
+  lines = ['# TYPE toto_method_calls_total counter']
+  methods = sorted(metrics)
+  labels = dict((method, 'method="%s"' % method.replace('\\', '\\\\').replace('"', '\\"')) for method in methods)
+  lines.extend('toto_method_calls_total{%s} %d' % (labels[method], metrics[method]['calls']) for method in methods)
+  lines.append('# TYPE toto_method_errors_total counter')
+  lines.extend('toto_method_errors_total{%s} %d' % (labels[method], metrics[method]['errors']) for method in methods)
+  lines.append('# TYPE toto_method_duration_seconds summary')
+  for method in methods:
+    latency = metrics[method]['latency']
+    for quantile in QUANTILES:
+      lines.append('toto_method_duration_seconds{%s,quantile="%s"} %.6f' % (labels[method], quantile, latency.percentile(quantile) / 1000000.0))
+    lines.append('toto_method_duration_seconds_sum{%s} %.6f' % (labels[method], latency.total / 1000000.0))
+    lines.append('toto_method_duration_seconds_count{%s} %d' % (labels[method], latency.count))
+  limited = [method for method in methods if 'admission' in metrics[method]]
+  if limited:
+    for name, key, metric_type in (('active', 'active', 'gauge'), ('queued', 'queued', 'gauge'), ('rejected_total', 'rejected', 'counter'), ('timeouts_total', 'timeouts', 'counter')):
+      lines.append('# TYPE toto_method_%s %s' % (name, metric_type))
+      lines.extend('toto_method_%s{%s} %d' % (name, labels[method], metrics[method]['admission'][key]) for method in limited)
+  return '\n'.join(lines) + '\n'
+
+def metrics_directory():
+  '''Returns the directory used to share metrics between server processes.'''
+  if options.metrics_dir:
+    return options.metrics_dir
+  import tempfile
+  return os.path.join(tempfile.gettempdir(), 'toto-metrics-%s' % options.port)
+
+def reset_metrics_directory(directory):
+  '''Create ``directory`` if needed and remove any snapshots left by previous servers.'''
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  for path in glob(os.path.join(directory, '*.json')):
+    os.remove(path)
+
+class MetricsHandler(RequestHandler):
+  '''Serves the combined metrics of every server process at the ``metrics_path``.'''
+
+  def initialize(self, directory, service_id):
+    self.directory = directory
+    self.service_id = service_id
+
+  def get(self):
+    own_path = os.path.join(self.directory, '%s.json' % self.service_id)
+    snapshots = [MethodMetrics.instance().snapshot()]
+    for path in glob(os.path.join(self.directory, '*.json')):
+      if path == own_path:
+        continue
+      try:
+        with open(path) as f:
+          snapshots.append(json.load(f))
+      except (IOError, ValueError) as e:
+        logging.warning('Unable to read metrics from %s: %s' % (path, e))
+    self.set_header('content-type', 'text/plain; version=0.0.4')
+    self.write(prometheus_text(merge_snapshots(snapshots)))
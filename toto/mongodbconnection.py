@@ -1,4 +1,5 @@
 import pymongo
+from bson.binary import Binary
 from toto.exceptions import *
 from toto.session import *
 from time import time
@@ -10,6 +11,12 @@ import hashlib
 import toto.secret as secret
 from dbconnection import DBConnection
 
+def _decode_state(session_data):
+  state = session_data and session_data.get('state')
+  if isinstance(state, dict):
+    session_data['state'] = {k: TotoSession.loads(v) for k, v in state.iteritems()}
+  return session_data
+
 class MongoDBSession(TotoSession):
   _account = None
 
@@ -26,12 +33,47 @@ class MongoDBSession(TotoSession):
     return self._account
 
   def refresh(self):
-    session_data = self._refresh_cache() or self._db.sessions.find_one({'session_id': self.session_id})
+    session_data = self._refresh_cache() or _decode_state(self._db.sessions.find_one({'session_id': self.session_id}))
     self.__init__(self._db, session_data, self._session_cache)
 
   def save(self):
+    state = self._dumps_modified_state()
+    if state is None:
+      return
+    if not self._save_cache(state):
+      self._db.sessions.update({'session_id': self.session_id}, {'$set': {'state': Binary(state)}})
+    self._mark_saved(state)
+
+class MongoDBKeySession(MongoDBSession):
+  '''Stores each state key in its own field of the session's ``state`` document, so saves only ``$set`` and ``$unset``
+  the keys that were modified. State keys must be valid MongoDB field names.
+  '''
+
+  def __init__(self, db, session_data, session_cache=None):
+    self._state_document = not isinstance(session_data.get('state'), basestring)
+    super(MongoDBKeySession, self).__init__(db, session_data, session_cache)
+
+  def save(self):
+    modified = self.modified_keys()
+    if not modified:
+      return
     if not self._save_cache():
-      self._db.sessions.update({'session_id': self.session_id}, {'$set': {'state': TotoSession.dumps(self.state)}})
+      self._save_state(modified)
+    self._mark_saved()
+
+  def _save_state(self, modified):
+    if not self._state_document:
+      self._db.sessions.update({'session_id': self.session_id}, {'$set': {'state': {k: Binary(TotoSession.dumps(v)) for k, v in self.state.iteritems()}}})
+      self._state_document = True
+      return
+    update = {}
+    updated = {'state.%s' % k: Binary(TotoSession.dumps(self.state[k])) for k in modified if k in self.state}
+    if updated:
+      update['$set'] = updated
+    removed = {'state.%s' % k: '' for k in modified if k not in self.state}
+    if removed:
+      update['$unset'] = removed
+    self._db.sessions.update({'session_id': self.session_id}, update)
 
 class MongoDBConnection(DBConnection):
 
@@ -47,74 +89,41 @@ class MongoDBConnection(DBConnection):
     if not 'user_id' in account_indexes:
       self.db.accounts.ensure_index('user_id', name='user_id')
 
-  def __init__(self, host, port, database, session_ttl=24*60*60*365, anon_session_ttl=24*60*60, session_renew=0, anon_session_renew=0):
+  def __init__(self, host, port, database, state_layout='blob', *args, **kwargs):
+    super(MongoDBConnection, self).__init__(*args, **kwargs)
+    self._session_class = state_layout == 'keys' and MongoDBKeySession or MongoDBSession
     self.db = pymongo.Connection(host, port)[database]
     self._ensure_indexes()
-    self.session_ttl = session_ttl
-    self.anon_session_ttl = anon_session_ttl or self.session_ttl
-    self.session_renew = session_renew or self.session_ttl
-    self.anon_session_renew = anon_session_renew or self.anon_session_ttl
-
-  def create_account(self, user_id, password, additional_values={}, **values):
-    if not user_id:
-      raise TotoException(ERROR_INVALID_USER_ID, "Invalid user ID.")
-    if self.db.accounts.find_one({'user_id': user_id}):
-      raise TotoException(ERROR_USER_ID_EXISTS, "User ID already in use.")
-    values.update(additional_values)
-    values['user_id'] = user_id
-    values['password'] = secret.password_hash(password)
+
+  def _normalize_user_id(self, user_id):
+    # MongoDB user IDs have always been case sensitive, keep them that way so existing accounts still match.
+    return user_id
+
+  def _store_account(self, user_id, values):
     self.db.accounts.insert(values)
 
+  def _get_account(self, user_id):
+    return self.db.accounts.find_one({'user_id': user_id}, {'password': 1})
+
   def _load_uncached_data(self, session_id):
-    return self.db.sessions.find_one({'session_id': session_id, 'expires': {'$gt': time()}})
-
-  def create_session(self, user_id=None, password=None, verify_password=True):
-    if not user_id:
-      user_id = ''
-    account = user_id and self.db.accounts.find_one({'user_id': user_id})
-    if user_id and (not account or (verify_password and not secret.verify_password(password, account['password']))):
-      raise TotoException(ERROR_USER_NOT_FOUND, "Invalid user ID or password")
-    session_id = MongoDBSession.generate_id()
-    expires = time() + (user_id and self.session_ttl or self.anon_session_ttl)
-    session_data = {'user_id': user_id, 'expires': expires, 'session_id': session_id}
-    if not self._cache_session_data(session_data):
-      self.db.sessions.remove({'user_id': user_id, 'expires': {'$lt': time()}})
-      self.db.sessions.insert(session_data)
-    session = MongoDBSession(self.db, session_data, self._session_cache)
-    return session
-
-  def retrieve_session(self, session_id):
-    session_data = self._load_session_data(session_id)
-    if not session_data:
-      return None
-    user_id = session_data['user_id']
-    expires = time() + (user_id and self.session_renew or self.anon_session_renew)
-    if session_data['expires'] < expires:
-      session_data['expires'] = expires
-      if not self._cache_session_data(session_data):
-        self.db.sesions.update({'session_id': session_id}, {'$set': {'expires': session_data['expires']}})
-    session = MongoDBSession(self.db, session_data, self._session_cache)
-    return session
+    return _decode_state(self.db.sessions.find_one({'session_id': session_id, 'expires': {'$gt': time()}}))
+
+  def _store_session(self, session_id, session_data):
+    self.db.sessions.remove({'user_id': session_data['user_id'], 'expires': {'$lt': time()}})
+    self.db.sessions.insert(session_data)
+
+  def _instantiate_session(self, session_data, session_cache):
+    return self._session_class(self.db, session_data, self._session_cache)
+
+  def _update_expiry(self, session_id, session_data):
+    self.db.sessions.update({'session_id': session_id}, {'$set': {'expires': session_data['expires']}})
 
   def _remove_session(self, session_id):
     self.db.sessions.remove({'session_id': session_id})
 
-  def clear_sessions(self, user_id):
+  def _clear_sessions(self, user_id):
     self.db.sessions.remove({'user_id': user_id})
 
-  def change_password(self, user_id, password, new_password):
-    account = self.db.accounts.find_one({'user_id': user_id})
-    if not account or not secret.verify_password(password, account['password']):
-      raise TotoException(ERROR_USER_NOT_FOUND, "Invalid user ID or password")
-    self.db.accounts.update({'user_id': user_id}, {'$set': {'password': secret.password_hash(new_password)}})
-    self.clear_sessions(user_id)
-
-  def generate_password(self, user_id):
-    account = self.db.accounts.find_one({'user_id': user_id})
-    if not account:
-      raise TotoException(ERROR_USER_NOT_FOUND, "Invalid user ID or password")
-    pass_chars = string.ascii_letters + string.digits
-    new_password = ''.join([random.choice(pass_chars) for x in xrange(10)])
-    self.db.accounts.update({'user_id': user_id}, {'$set': {'password': secret.password_hash(new_password)}})
+  def _update_password(self, user_id, account, hashed_password):
+    self.db.accounts.update({'user_id': user_id}, {'$set': {'password': hashed_password}})
     self.clear_sessions(user_id)
-    return new_password
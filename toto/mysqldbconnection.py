@@ -9,6 +9,7 @@ import toto.secret as secret
 import uuid
 import random
 import string
+from threading import local, current_thread
 
 class MySQLdbSession(TotoSession):
   _account = None
@@ -38,16 +39,22 @@ class MySQLdbSession(TotoSession):
       self._account = MySQLdbSession.MySQLdbAccount(self)
     return self._account
 
-  def session_data(self):
-   return {'user_id': self.user_id, 'expires': self.expires, 'session_id': self.session_id, 'state': TotoSession.dumps(self.state), 'account_id': self.account_id}
+  def session_data(self, encode_state=True):
+    data = super(MySQLdbSession, self).session_data(encode_state)
+    data['account_id'] = self.account_id
+    return data
 
   def refresh(self):
     session_data = self._refresh_cache() or self._db.get("select session.session_id, session.expires, session.state, account.user_id, account.account_id from session join account on account.account_id = session.account_id where session.session_id = %s", session_id)
     self.__init__(self._db, session_data, self._session_cache)
 
   def save(self):
-    if not self._save_cache():
-      self._db.execute("update session set state = %s where session_id = %s", TotoSession.dumps(self.state), self.session_id)
+    state = self._dumps_modified_state()
+    if state is None:
+      return
+    if not self._save_cache(state):
+      self._db.execute("update session set state = %s where session_id = %s", state, self.session_id)
+    self._mark_saved(state)
 
 class MySQLdbConnection(DBConnection):
 
@@ -74,10 +81,25 @@ class MySQLdbConnection(DBConnection):
 
   def __init__(self, host, database, username, password, uuid_account_id=False, pool_size=1, *args, **kwargs):
     super(MySQLdbConnection, self).__init__(*args, **kwargs)
-    self.db = Connection(host, database, username, password)
+    self._connection_args = (host, database, username, password)
+    self._connection_thread = current_thread()
+    self._thread_connections = local()
+    self._db = Connection(*self._connection_args)
     self.uuid_account_id = uuid_account_id
     self.create_tables(database)
 
+  @property
+  def db(self):
+    '''The ``torndb.Connection`` for the current thread. torndb connections are not thread safe, so threads other than
+    the one that created this ``MySQLdbConnection`` (e.g. the session ``TaskQueue``) will each open their own connection.
+    '''
+    if current_thread() is self._connection_thread:
+      return self._db
+    connection = getattr(self._thread_connections, 'connection', None)
+    if not connection:
+      connection = self._thread_connections.connection = Connection(*self._connection_args)
+    return connection
+
   def _store_account(self, user_id, values):
     if self.uuid_account_id:
       values['account_id'] = uuid4().bytes
@@ -99,17 +121,20 @@ class MySQLdbConnection(DBConnection):
     session_data['account_id'] = account['account_id']
 
   def _instantiate_session(self, session_data, session_cache):
-    return MySQLdbSession(self.db, session_data, self._session_cache)
+    return MySQLdbSession(self._db, session_data, self._session_cache)
 
   def _update_expiry(self, session_id, session_data):
     self.db.execute("update session set expires = %s where session_id = %s", session_data['expires'], session_id)
 
+  def _update_expiries(self, sessions):
+    self.db.execute("update session set expires = case session_id " + ' '.join(['when %s then %s' for s in sessions]) + " end where session_id in (" + ', '.join(['%s' for s in sessions]) + ")", *([v for s in sessions for v in (s['session_id'], s['expires'])] + [s['session_id'] for s in sessions]))
+
   def _update_password(self, user_id, account, hashed_password):
     self.db.execute("update account set password = %s where account_id = %s", hashed_password, account['account_id'])
 
   def _remove_session(self, session_id):
     self.db.execute("delete from session where session_id = %s", session_id)
 
-  def clear_sessions(self, user_id):
+  def _clear_sessions(self, user_id):
     user_id = user_id.lower()
     self.db.execute("delete from session using session join account on account.account_id = session.account_id where account.user_id = %s", user_id)
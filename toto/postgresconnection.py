@@ -2,6 +2,7 @@ from toto.exceptions import *
 from toto.session import *
 from time import time, mktime
 from datetime import datetime
+from psycopg2 import Binary
 from psycopg2.pool import ThreadedConnectionPool
 from itertools import izip
 import toto.secret as secret
@@ -65,16 +66,22 @@ class PostgresSession(TotoSession):
       self._account = PostgresSession.PostgresAccount(self)
     return self._account
 
-  def session_data(self):
-    return {'user_id': self.user_id, 'expires': self.expires, 'session_id': self.session_id, 'state': TotoSession.dumps(self.state), 'account_id': self.account_id}
+  def session_data(self, encode_state=True):
+    data = super(PostgresSession, self).session_data(encode_state)
+    data['account_id'] = self.account_id
+    return data
 
   def refresh(self):
     session_data = self._refresh_cache() or self._db.get("select session.session_id, session.expires, session.state, account.user_id, account.account_id from session join account on account.account_id = session.account_id where session.session_id = %s", (session_id,))
     self.__init__(session_data, self._session_cache)
 
   def save(self):
-    if not self._save_cache():
-      self._db.execute("update session set state = %s where session_id = %s", (TotoSession.dumps(self.state), self.session_id))
+    state = self._dumps_modified_state()
+    if state is None:
+      return
+    if not self._save_cache(state):
+      self._db.execute("update session set state = %s where session_id = %s", (Binary(state), self.session_id))
+    self._mark_saved(state)
 
 class PostgresConnection(DBConnection):
 
@@ -95,7 +102,7 @@ class PostgresConnection(DBConnection):
       );''')
       self.db.execute('create index session_expires on session using btree (expires);')
 
-  def __init__(self, host, port, database, username, password, min_connections=1, max_connections=10):
+  def __init__(self, host, port, database, username, password, min_connections=1, max_connections=10, *args, **kwargs):
     super(PostgresConnection, self).__init__(*args, **kwargs)
     self.db = ThreadedConnectionPool(min_connections, max_connections, database=database, user=username, password=password, host=host, port=port)
     self.create_tables()
@@ -109,6 +116,9 @@ class PostgresConnection(DBConnection):
   def _update_expiry(self, session_id, session_data):
     self.db.execute("update session set expires = %s where session_id = %s", (session_data['expires'], session_id))
 
+  def _update_expiries(self, sessions):
+    self.db.execute("update session set expires = expiry.expires from (values " + ', '.join(['(%s, %s)' for s in sessions]) + ") as expiry (session_id, expires) where session.session_id = expiry.session_id", [v for s in sessions for v in (s['session_id'], s['expires'])])
+
   def _update_password(self, user_id, account, hashed_password):
     self.db.execute("update account set password = %s where account_id = %s", (hashed_password, account['account_id']))
 
@@ -127,6 +137,6 @@ class PostgresConnection(DBConnection):
   def _remove_session(self, session_id):
     self.db.execute("delete from session where session_id = %s", (session_id,))
 
-  def clear_sessions(self, user_id):
+  def _clear_sessions(self, user_id):
     user_id = user_id.lower()
     self.db.execute("delete from session using session join account on account.account_id = session.account_id where account.user_id = %s", (user_id,))
@@ -0,0 +1,204 @@
+'''A sampling profiler for selected requests. Set ``profile_rate`` to profile a fraction of requests, or
+``profile_secret`` to profile requests carrying a valid "x-toto-profile" header (see ``profile_header()``).
+
+While enabled, each server process samples its call stack every ``profile_interval`` seconds of CPU time. Samples taken
+while a profiled request's code is running, including callbacks and coroutines resumed on its behalf, are attributed to
+the request's method. Other samples are discarded, so requests that aren't profiled only pay for the timer signal.
+
+Stacks are aggregated per method in the collapsed format used by flamegraph tools, one stack per line with the method
+name as the root frame::
+
+  account.login;toto.handler.invoke_method;web_methods.account.login.invoke;... 42
+
+Each process writes its stacks to ``<profile_dir>/<service_id>.txt`` every ``profile_dump_interval`` seconds. If both
+``profile_path`` and ``profile_secret`` are set, the combined stacks from every process are also served at
+``profile_path`` to requests with a valid "x-toto-profile" header, e.g.
+``curl -H "x-toto-profile: $HEADER" http://host/profile | flamegraph.pl > profile.svg``.
+'''
+
+import os
+import hmac
+import signal
+import logging
+import threading
+from glob import glob
+from hashlib import sha256
+from random import random
+from time import time
+from tornado.web import RequestHandler, HTTPError
+from tornado.ioloop import PeriodicCallback
+from tornado.options import define, options
+from tornado.stack_context import StackContext
+from toto.tasks import TaskQueue
+
+define("profile_rate", default=0.0, help="The fraction of requests (0-1) to profile with the sampling profiler.")
+define("profile_secret", default=None, type=str, help="If set, requests with an 'x-toto-profile' header signed with this secret will be profiled. Also required to serve profile_path.")
+define("profile_interval", default=0.005, help="The number of seconds of CPU time between stack samples while the profiler is enabled.")
+define("profile_path", default=None, type=str, help="If set along with profile_secret, combined profiles will be served at this path in the collapsed stack format (e.g. /profile).")
+define("profile_dir", default=None, type=str, help="The directory that each server process writes its collapsed stacks to. Defaults to a directory in the system temp directory named for the server's port.")
+define("profile_dump_interval", default=10.0, help="The number of seconds between profile dumps written by each server process.")
+
+_MAX_STACKS = 10000
+
+_state = threading.local()
+
+def profile_signature(secret, expires):
+  return hmac.new(secret, str(expires), sha256).hexdigest()
+
+def profile_header(secret, ttl=300):
+  '''Returns a value for the "x-toto-profile" header that is valid for ``ttl`` seconds.'''
+  expires = int(time() + ttl)
+  return '%s:%s' % (expires, profile_signature(secret, expires))
+
+def verify_profile_header(secret, value):
+  '''Returns ``True`` if ``value`` is an unexpired "x-toto-profile" header signed with ``secret``.'''
+  if not secret or not value:
+    return False
+  expires, _, signature = value.partition(':')
+  try:
+    if int(expires) < time():
+      return False
+  except ValueError:
+    return False
+  return hmac.compare_digest(profile_signature(secret, expires), signature)
+
+class _ProfileContext(object):
+
+  def __init__(self, method):
+    self.method = method
+
+  def __enter__(self):
+    self.previous = getattr(_state, 'method', None)
+    _state.method = self.method
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    _state.method = self.previous
+
+def _frame_name(frame):
+  return '%s.%s' % (frame.f_globals.get('__name__', '?'), frame.f_code.co_name)
+
+class SamplingProfiler(object):
+  '''Samples the stacks of profiled requests in the current process. Use ``SamplingProfiler.instance()`` to get the
+  process wide instance.
+  '''
+
+  def __init__(self):
+    self.stacks = {}
+
+  def should_profile(self, request):
+    '''Returns ``True`` if ``request`` should be profiled, either because it has a valid "x-toto-profile" header or
+    because it was selected at random according to ``profile_rate``.
+    '''
+    if options.profile_secret and 'x-toto-profile' in request.headers:
+      return verify_profile_header(options.profile_secret, request.headers['x-toto-profile'])
+    return options.profile_rate > 0 and random() < options.profile_rate
+
+  def context(self, method):
+    '''Returns a ``StackContext`` that attributes samples taken while it is active, including in callbacks scheduled
+    on the ``IOLoop``, to ``method``.
+    '''
+    return StackContext(lambda: _ProfileContext(method))
+
+  def start(self, interval):
+    '''Sample the stack every ``interval`` seconds of CPU time. Must be called from the main thread.'''
+    signal.signal(signal.SIGPROF, self._sample)
+    signal.siginterrupt(signal.SIGPROF, False)
+    signal.setitimer(signal.ITIMER_PROF, interval, interval)
+
+  def stop(self):
+    signal.setitimer(signal.ITIMER_PROF, 0, 0)
+
+  def _sample(self, signum, frame):
+    method = getattr(_state, 'method', None)
+    if method is None:
+      return
+    names = []
+    while frame is not None:
+      names.append(_frame_name(frame))
+      frame = frame.f_back
+    names.append(method)
+    names.reverse()
+    stack = ';'.join(names)
+    if stack in self.stacks:
+      self.stacks[stack] += 1
+    elif len(self.stacks) < _MAX_STACKS:
+      self.stacks[stack] = 1
+
+  def collapsed(self):
+    '''Returns the sampled stacks in the collapsed stack format.'''
+    return collapsed_text(self.stacks)
+
+  def start_reporting(self, directory, service_id, interval):
+    '''Write the sampled stacks to ``directory`` every ``interval`` seconds so they can be combined with the other
+    server processes' profiles. Files are written outside of the ``IOLoop``.
+    '''
+    path = os.path.join(directory, '%s.txt' % service_id)
+    def report():
+      TaskQueue.instance('toto.profiler').add_task(_write_profile, path, self.collapsed())
+    self._reporter = PeriodicCallback(report, interval * 1000)
+    self._reporter.start()
+
+  @classmethod
+  def instance(cls):
+    '''Returns the ``SamplingProfiler`` instance for the current process.'''
+    if not hasattr(cls, '_instance'):
+      cls._instance = cls()
+    return cls._instance
+
+def _write_profile(path, text):
+  temp_path = '%s.tmp' % path
+  with open(temp_path, 'w') as f:
+    f.write(text)
+  os.rename(temp_path, path)
+
+def collapsed_text(stacks):
+  return ''.join('%s %d\n' % (stack, count) for stack, count in sorted(stacks.iteritems()))
+
+def merge_collapsed(texts):
+  '''Combine a list of profiles in the collapsed stack format into a ``dict`` mapping stacks to sample counts.'''
+  merged = {}
+  for text in texts:
+    for line in text.splitlines():
+      stack, _, count = line.rpartition(' ')
+      if stack:
+        merged[stack] = merged.get(stack, 0) + int(count)
+  return merged
+
+def profile_directory():
+  '''Returns the directory used to share profiles between server processes.'''
+  if options.profile_dir:
+    return options.profile_dir
+  import tempfile
+  return os.path.join(tempfile.gettempdir(), 'toto-profile-%s' % options.port)
+
+def reset_profile_directory(directory):
+  '''Create ``directory`` if needed and remove any profiles left by previous servers.'''
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  for path in glob(os.path.join(directory, '*.txt')):
+    os.remove(path)
+
+class ProfileHandler(RequestHandler):
+  '''Serves the combined profiles of every server process at the ``profile_path`` to requests with a valid
+  "x-toto-profile" header.
+  '''
+
+  def initialize(self, directory, service_id):
+    self.directory = directory
+    self.service_id = service_id
+
+  def get(self):
+    if not verify_profile_header(options.profile_secret, self.request.headers.get('x-toto-profile')):
+      raise HTTPError(403)
+    own_path = os.path.join(self.directory, '%s.txt' % self.service_id)
+    texts = [SamplingProfiler.instance().collapsed()]
+    for path in glob(os.path.join(self.directory, '*.txt')):
+      if path == own_path:
+        continue
+      try:
+        with open(path) as f:
+          texts.append(f.read())
+      except IOError as e:
+        logging.warning('Unable to read profile from %s: %s' % (path, e))
+    self.set_header('content-type', 'text/plain')
+    self.write(collapsed_text(merge_collapsed(texts)))
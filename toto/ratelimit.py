@@ -0,0 +1,115 @@
+'''Token bucket rate limits used by the ``@toto.invocation.rate_limit`` decorator. By default, buckets are kept in a
+shared memory table created by ``TotoServer`` before it starts its processes, so limits apply to the server as a whole
+rather than to each process. Updates are not locked, so concurrent requests for the same key in different processes
+may occasionally both take the last token; limits are otherwise exact. If the table is full, the least recently used
+bucket among the candidates for a key is replaced.
+
+Set ``rate_limit_backend`` to "redis" to share limits between multiple hosts. Redis buckets are updated atomically by
+a Lua script.
+'''
+
+import mmap
+import struct
+from hashlib import md5
+from time import time
+from tornado.options import define, options
+
+define("rate_limit_backend", default='shared', metavar='shared|redis', help="Where @rate_limit token buckets are stored. 'shared' uses a shared memory table for all server processes on this host, 'redis' shares limits between hosts.")
+define("rate_limit_slots", default=65536, help="The number of token buckets in the shared memory rate limit table.")
+define("rate_limit_redis_host", default='localhost', help="The Redis host used when rate_limit_backend is 'redis'.")
+define("rate_limit_redis_port", default=6379, help="The Redis port used when rate_limit_backend is 'redis'.")
+define("rate_limit_redis_database", default=0, help="The Redis database used when rate_limit_backend is 'redis'.")
+
+_SLOT = struct.Struct('<Qdd')
+_PROBES = 8
+
+def _hash(key):
+  return struct.unpack('<Q', md5(key).digest()[:8])[0] or 1
+
+class SharedTokenBuckets(object):
+  '''A fixed size table of token buckets in anonymous shared memory. Create it before forking so every child process
+  uses the same table. Each slot stores a key hash, the current number of tokens and the time they were counted.
+  '''
+
+  def __init__(self, slots=65536):
+    self.slots = slots
+    self._memory = mmap.mmap(-1, slots * _SLOT.size)
+
+  def consume(self, key, rate, burst):
+    '''Take a token from the bucket for ``key``, which refills at ``rate`` tokens per second up to ``burst`` tokens.
+    Returns ``(True, 0)`` if a token was available, otherwise ``(False, seconds)`` with the time until the next token.
+    '''
+    key_hash = _hash(key)
+    now = time()
+    memory = self._memory
+    start = key_hash % self.slots
+    offset = None
+    tokens = burst
+    oldest = None
+    for i in xrange(_PROBES):
+      slot_offset = ((start + i) % self.slots) * _SLOT.size
+      slot_hash, slot_tokens, updated = _SLOT.unpack_from(memory, slot_offset)
+      if slot_hash == key_hash:
+        offset = slot_offset
+        tokens = min(burst, slot_tokens + (now - updated) * rate)
+        break
+      if not slot_hash:
+        offset = slot_offset
+        break
+      if oldest is None or updated < oldest:
+        oldest = updated
+        offset = slot_offset
+    allowed = tokens >= 1
+    if allowed:
+      tokens -= 1
+    _SLOT.pack_into(memory, offset, key_hash, tokens, now)
+    return allowed, not allowed and (1 - tokens) / rate or 0
+
+_REDIS_SCRIPT = '''
+local bucket = redis.call('hmget', KEYS[1], 'tokens', 'updated')
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = burst
+if bucket[1] then
+  tokens = math.min(burst, tonumber(bucket[1]) + (now - tonumber(bucket[2])) * rate)
+end
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('hmset', KEYS[1], 'tokens', tostring(tokens), 'updated', ARGV[3])
+redis.call('expire', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring(tokens)}
+'''
+
+class RedisTokenBuckets(object):
+  '''Token buckets stored in Redis hashes named "ratelimit:<key>", shared by every server using the same database.'''
+
+  def __init__(self, client):
+    self._script = client.register_script(_REDIS_SCRIPT)
+
+  def consume(self, key, rate, burst):
+    '''See ``SharedTokenBuckets.consume()``.'''
+    allowed, tokens = self._script(keys=['ratelimit:%s' % key], args=[rate, burst, repr(time())])
+    return bool(allowed), not allowed and (1 - float(tokens)) / rate or 0
+
+_backend = None
+
+def set_backend(backend):
+  '''Use ``backend`` to store token buckets. ``backend`` must implement ``consume(key, rate, burst)``.'''
+  global _backend
+  _backend = backend
+
+def get_backend():
+  '''Returns the current token bucket backend, creating one according to the ``rate_limit_backend`` option if needed.
+  A shared memory backend created here is only shared with processes forked after it was created.
+  '''
+  if not _backend:
+    if options.rate_limit_backend == 'redis':
+      import redis
+      set_backend(RedisTokenBuckets(redis.StrictRedis(options.rate_limit_redis_host, options.rate_limit_redis_port, options.rate_limit_redis_database)))
+    else:
+      set_backend(SharedTokenBuckets(options.rate_limit_slots))
+  return _backend
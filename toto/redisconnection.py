@@ -1,3 +1,18 @@
+'''Sessions are stored as Redis hashes with the fields:
+
+* "user_id" and "expires" - used to renew sessions as they are loaded.
+* "data" - the rest of the session data, serialized with ``TotoSession.dumps()``.
+* "state" - the serialized session state, or with the "keys" ``session_state_layout``, a "state:<key>" field for each
+  state key.
+
+Loading a session and renewing its expiry happens in a single round trip using a Lua script, which requires Redis 2.6
+or later. The IDs of each user's sessions are kept in a set so ``DBConnection.clear_sessions()`` can remove them. Each
+time a new session is stored for a user, up to ``RedisSessionStore.prune_batch_size`` randomly chosen IDs are checked
+and dropped from the set if their sessions have expired or been removed. Scripts only access keys passed in ``KEYS``,
+but a session and its user's set hash to different slots, so Redis Cluster is not supported.
+Sessions stored by earlier versions of Toto are read and rewritten in the current format the first time they're loaded.
+'''
+
 import redis
 from toto.exceptions import *
 from toto.session import *
@@ -7,11 +22,198 @@ from dbconnection import DBConnection
 import base64
 import uuid
 
+_SESSION_PREFIX = 'session:'
+_STATE_PREFIX = 'state:'
+
 def _account_key(user_id):
   return 'account:%s' % user_id
 
 def _session_key(session_id):
-  return 'session:%s' % session_id
+  return _SESSION_PREFIX + session_id
+
+def _user_sessions_key(user_id):
+  return 'user_sessions:%s' % user_id
+
+# KEYS[1] session; ARGV[1] now; ARGV[2], ARGV[3] renewal for authenticated and anonymous sessions (0 to skip)
+_LOAD_SESSION = '''
+local kind = redis.call('TYPE', KEYS[1])['ok']
+if kind == 'string' then
+  return {'string', redis.call('GET', KEYS[1])}
+elseif kind ~= 'hash' then
+  return false
+end
+local session = redis.call('HMGET', KEYS[1], 'user_id', 'expires')
+local renew = tonumber(session[1] == '' and ARGV[3] or ARGV[2])
+local expires = tonumber(ARGV[1]) + renew
+if renew > 0 and tonumber(session[2]) < expires then
+  redis.call('HSET', KEYS[1], 'expires', string.format('%.6f', expires))
+  redis.call('EXPIREAT', KEYS[1], math.floor(expires))
+end
+return {'hash', redis.call('HGETALL', KEYS[1])}
+'''
+
+# KEYS[1] session, KEYS[2] user's sessions (authenticated only); ARGV[1] session ID; ARGV[2] expiry; ARGV[3:] fields
+# Returns 1 if the session ID was added to the user's sessions.
+_STORE_SESSION = '''
+redis.call('DEL', KEYS[1])
+redis.call('HMSET', KEYS[1], unpack(ARGV, 3))
+redis.call('EXPIREAT', KEYS[1], ARGV[2])
+if KEYS[2] then
+  return redis.call('SADD', KEYS[2], ARGV[1])
+end
+return 0
+'''
+
+# KEYS[1] user's sessions, KEYS[2:] sessions to check; ARGV[1] session prefix
+_PRUNE_SESSIONS = '''
+for i = 2, #KEYS do
+  if redis.call('EXISTS', KEYS[i]) == 0 then
+    redis.call('SREM', KEYS[1], string.sub(KEYS[i], #ARGV[1] + 1))
+  end
+end
+'''
+
+# KEYS[1] session; ARGV[1] layout; ARGV[2] number of fields to set; ARGV[3:] fields to set, then fields to delete.
+# Returns 0 if the session is stored in a different format and must be rewritten.
+_SAVE_STATE = '''
+local kind = redis.call('TYPE', KEYS[1])['ok']
+if kind == 'none' then
+  return 1
+elseif kind ~= 'hash' then
+  return 0
+end
+local has_state = redis.call('HEXISTS', KEYS[1], 'state')
+if ARGV[1] == 'keys' then
+  if has_state == 1 then
+    return 0
+  end
+elseif redis.call('HLEN', KEYS[1]) > 3 + has_state then
+  return 0
+end
+local last = 2 + 2 * tonumber(ARGV[2])
+if last > 2 then
+  redis.call('HMSET', KEYS[1], unpack(ARGV, 3, last))
+end
+if #ARGV > last then
+  redis.call('HDEL', KEYS[1], unpack(ARGV, last + 1))
+end
+return 1
+'''
+
+# KEYS sessions; ARGV their expiries. Sessions that have been removed are skipped.
+_EXPIRE_SESSIONS = '''
+for i, key in ipairs(KEYS) do
+  if redis.call('TYPE', key)['ok'] == 'hash' then
+    redis.call('HSET', key, 'expires', ARGV[i])
+    redis.call('EXPIREAT', key, math.floor(tonumber(ARGV[i])))
+  end
+end
+'''
+
+class RedisSessionStore(object):
+  '''Reads and writes sessions in the format described above. Used by ``RedisConnection`` and ``RedisSessionCache``.
+  ``state_layout`` may be "blob" to store the session state in a single field, or "keys" to store each key in its own
+  field so saves only write the modified keys.
+  '''
+
+  prune_batch_size = 10
+
+  def __init__(self, db, state_layout='blob'):
+    self.db = db
+    self.state_layout = state_layout
+    self._load = db.register_script(_LOAD_SESSION)
+    self._store = db.register_script(_STORE_SESSION)
+    self._prune = db.register_script(_PRUNE_SESSIONS)
+    self._save_state = db.register_script(_SAVE_STATE)
+    self._expire = db.register_script(_EXPIRE_SESSIONS)
+
+  def store(self, session_data):
+    '''Write ``session_data``, replacing any existing session with the same ID.'''
+    session_id = session_data['session_id']
+    user_id = session_data['user_id'] or ''
+    expires = float(session_data['expires'])
+    fields = ['user_id', user_id, 'expires', '%.6f' % expires, 'data', TotoSession.dumps({k: v for k, v in session_data.iteritems() if k not in ('state', 'expires')})]
+    state = session_data.get('state')
+    if self.state_layout == 'keys':
+      if state and not isinstance(state, dict):
+        state = TotoSession.loads(state)
+      for k, v in (state or {}).iteritems():
+        fields.extend((_STATE_PREFIX + k, TotoSession.dumps(v)))
+    elif state:
+      fields.extend(('state', isinstance(state, dict) and TotoSession.dumps(state) or state))
+    keys = [_session_key(session_id)]
+    if user_id:
+      keys.append(_user_sessions_key(user_id))
+    if self._store(keys=keys, args=[session_id, int(expires)] + fields):
+      self.prune(user_id)
+
+  def prune(self, user_id):
+    '''Check up to ``prune_batch_size`` randomly chosen session IDs in the index of ``user_id``'s sessions and remove
+    those whose sessions have expired or been removed. Called each time a new session is stored for the user.
+    '''
+    user_sessions_key = _user_sessions_key(user_id)
+    session_ids = self.db.srandmember(user_sessions_key, self.prune_batch_size)
+    if session_ids:
+      self._prune(keys=[user_sessions_key] + [_session_key(s) for s in session_ids], args=[_SESSION_PREFIX])
+
+  def load(self, session_id, session_renew=0, anon_session_renew=0, now=None):
+    '''Return the ``session_data`` for ``session_id`` or ``None``. If ``session_renew`` or ``anon_session_renew`` is set,
+    sessions expiring within that many seconds of ``now`` are renewed in the same round trip.
+    '''
+    result = self._load(keys=[_session_key(session_id)], args=[repr(now or time()), session_renew or 0, anon_session_renew or 0])
+    if not result:
+      return None
+    if result[0] == 'string':
+      session_data = TotoSession.loads(result[1])
+      self.store(session_data)
+      return session_data
+    fields = dict(zip(result[1][::2], result[1][1::2]))
+    session_data = TotoSession.loads(fields['data'])
+    session_data['expires'] = float(fields['expires'])
+    if 'state' in fields:
+      session_data['state'] = fields['state']
+    else:
+      prefix_length = len(_STATE_PREFIX)
+      session_data['state'] = {k[prefix_length:]: TotoSession.loads(v) for k, v in fields.iteritems() if k.startswith(_STATE_PREFIX)}
+    return session_data
+
+  def save_state(self, session, modified, state=None):
+    '''Write the state of ``session``. Only the ``modified`` keys are written with the "keys" layout. ``state`` is the
+    serialized state, if the caller already has it.
+    '''
+    if self.state_layout == 'keys':
+      updated = [(_STATE_PREFIX + k, TotoSession.dumps(session.state[k])) for k in modified if k in session.state]
+      removed = [_STATE_PREFIX + k for k in modified if k not in session.state]
+    else:
+      updated = [('state', state or TotoSession.dumps(session.state))]
+      removed = []
+    args = [self.state_layout, len(updated)]
+    for field in updated:
+      args.extend(field)
+    args.extend(removed)
+    if not self._save_state(keys=[_session_key(session.session_id)], args=args):
+      self.store(session.session_data(False))
+
+  def update_expiries(self, sessions):
+    '''Update the expiry of each session in ``sessions`` with a single round trip.'''
+    self._expire(keys=[_session_key(s['session_id']) for s in sessions], args=['%.6f' % s['expires'] for s in sessions])
+
+  def remove(self, session_id):
+    '''Remove the session with ``session_id``. Its ID is removed from the user's index by ``prune()``.
+    '''
+    self.db.delete(_session_key(session_id))
+
+  def clear(self, user_id):
+    '''Remove every session belonging to ``user_id``.'''
+    user_sessions_key = _user_sessions_key(user_id)
+    session_ids = self.db.smembers(user_sessions_key)
+    if not session_ids:
+      return
+    #sessions stored after smembers() stay in the index
+    pipeline = self.db.pipeline()
+    pipeline.srem(user_sessions_key, *session_ids)
+    pipeline.delete(*[_session_key(s) for s in session_ids])
+    pipeline.execute()
 
 class RedisSession(TotoSession):
   _account = None
@@ -23,75 +225,110 @@ class RedisSession(TotoSession):
     def _save_property(self, *args):
       self._session._db.hmset(_account_key(self._session.user_id), {k: self[k] for k in args})
 
+  def __init__(self, db, session_data, session_cache=None, store=None):
+    super(RedisSession, self).__init__(db, session_data, session_cache)
+    self._store = store or RedisSessionStore(db)
+
   def get_account(self):
     if not self._account:
       self._account = RedisSession.RedisAccount(self)
     return self._account
 
   def refresh(self):
-    session_data = self._refresh_cache() or TotoSession.loads(self._db.get(_session_key(self.session_id)))
-    self.__init__(self._db, session_data, self._session_cache)
+    session_data = self._refresh_cache() or self._store.load(self.session_id)
+    self.__init__(self._db, session_data, self._session_cache, self._store)
 
   def save(self):
-    if not self._save_cache():
-      self._db.setex(_session_key(self.session_id), int(self.expires - time()), TotoSession.dumps(self.session_data()))
+    if self._store.state_layout == 'keys':
+      modified, state = self.modified_keys(), None
+      if not modified:
+        return
+    else:
+      modified, state = None, self._dumps_modified_state()
+      if state is None:
+        return
+    if not self._save_cache(state):
+      self._store.save_state(self, modified, state)
+    self._mark_saved(state)
 
 class RedisConnection(DBConnection):
+  '''Stores accounts and sessions in Redis. ``state_layout`` is passed to ``RedisSessionStore``.
+  '''
 
-  def __init__(self, host='localhost', port=6379, database=0):
+  def __init__(self, host='localhost', port=6379, database=0, state_layout='blob', *args, **kwargs):
     super(RedisConnection, self).__init__(*args, **kwargs)
     self.db = redis.StrictRedis(host=host, port=port, db=database)
+    self.store = RedisSessionStore(self.db, state_layout)
 
   def _store_session(self, session_id, session_data):
-    session_key = _session_key(session_id)
-    self.db.setex(session_key, int(float(session_data['expires']) - time()), TotoSession.dumps(session_data))
+    self.store.store(session_data)
+
+  def _update_expiry(self, session_id, session_data):
+    self.store.update_expiries([session_data])
+
+  def _update_expiries(self, sessions):
+    self.store.update_expiries(sessions)
 
   def _update_password(self, user_id, account, hashed_password):
     account_key = _account_key(user_id)
     self.db.hset(account_key, 'password', hashed_password)
 
   def _instantiate_session(self, session_data, session_cache):
-    return RedisSession(self.db, session_data, self._session_cache)
+    return RedisSession(self.db, session_data, self._session_cache, self.store)
 
   def _get_account(self, user_id):
-    return self.db.hmget(account_key, 'user_id', 'password')
+    user_id, password = self.db.hmget(_account_key(user_id), 'user_id', 'password')
+    return user_id and {'user_id': user_id, 'password': password} or None
 
   def _store_account(self, user_id, values):
     account_key = _account_key(user_id)
     self.db.hmset(account_key, values)
 
   def _load_uncached_data(self, session_id):
-    data = self.db.get(_session_key(session_id))
-    if data:
-      return TotoSession.loads(data)
-    return None
+    return self.store.load(session_id, self.session_renew, self.anon_session_renew)
 
   def _remove_session(self, session_id):
-    session_key = _session_key(session_id)
-    self.db.delete(session_key)
+    self.store.remove(session_id)
+
+  def _clear_sessions(self, user_id):
+    self.store.clear(user_id)
 
 class RedisSessionCache(TotoSessionCache):
   '''A ``TotoSessionCache`` implementation that uses Redis for session storage. Useful for improving the speed
   of authenticated requests while still allowing account data to live in e.g. MySQL.
 
-  ``db`` must be an instance of ``redis.StrictRedis`` initialized to the target database.
+  ``db`` must be an instance of ``redis.StrictRedis`` initialized to the target database. Sessions are stored by a
+  ``RedisSessionStore`` and are renewed as they are loaded, in the same round trip.
   '''
 
-  def __init__(self, db):
+  encode_state = False
+
+  def __init__(self, db, state_layout='blob'):
     self.db = db
+    self.store = RedisSessionStore(db, state_layout)
+    self._renewal = (0, 0)
+
+  def set_renewal(self, session_renew, anon_session_renew):
+    '''Called by ``DBConnection.set_session_cache()`` with the number of seconds before expiry that authenticated and
+    anonymous sessions should be renewed.
+    '''
+    self._renewal = (session_renew, anon_session_renew)
 
   def store_session(self, session_data):
-    session_key = _session_key(session_data['session_id'])
-    self.db.setex(session_key, int(session_data['expires'] - time()), TotoSession.dumps(session_data))
+    self.store.store(session_data)
 
   def load_session(self, session_id):
-    session_key = _session_key(session_id)
-    session_data = self.db.get(session_key)
-    if not session_data:
-      return None
-    else:
-      return TotoSession.loads(session_data)
+    return self.store.load(session_id, *self._renewal)
+
+  def update_expiries(self, sessions):
+    '''Update the expiry of each cached session in ``sessions`` with a single round trip. Used by ``DBConnection`` to flush batched
+    expiry renewals.
+    '''
+    self.store.update_expiries(sessions)
 
   def remove_session(self, session_id):
-    session_key = _session_key(session_id)
-    self.db.delete(session_key)
+    self.store.remove(session_id)
+
+  def clear_sessions(self, user_id):
+    '''Remove every cached session belonging to ``user_id``. Called by ``DBConnection.clear_sessions()``.'''
+    self.store.clear(user_id)
@@ -1,7 +1,56 @@
+'''Password hashing and verification. Hashes are generated with pbkdf2 which is intentionally slow, so
+``password_hash_async()`` and ``verify_password_async()`` are provided to move that work off of the
+``IOLoop``. Hashing is done in the "toto.secret" ``TaskQueue`` with ``password_threads`` threads. ``pbkdf2`` is
+pure Python and holds the GIL while it runs, so extra threads only help if other work releases it; run more server
+processes to hash more passwords in parallel.
+'''
+
 from pbkdf2 import crypt
+from threading import Lock
+from tornado.options import define, options
+from toto.tasks import TaskQueue
+
+define("password_threads", default=1, help="The number of threads each server process will use to hash and verify passwords asynchronously.")
+
+_stats_lock = Lock()
+_stats = {'pending': 0, 'peak_pending': 0, 'completed': 0}
 
 def password_hash(secret):
   return crypt(secret)
 
 def verify_password(secret, pwhash):
   return pwhash == crypt(secret, pwhash)
+
+def password_hash_async(secret):
+  '''Like ``password_hash`` but the hash is generated outside of the ``IOLoop``. Returns a ``Future`` that will
+  resolve to the hashed password. Must be called from a Tornado ``IOLoop``.
+  '''
+  return _run_async(password_hash, secret)
+
+def verify_password_async(secret, pwhash):
+  '''Like ``verify_password`` but the hash is checked outside of the ``IOLoop``. Returns a ``Future`` that will
+  resolve to ``True`` if ``secret`` matches ``pwhash``. Must be called from a Tornado ``IOLoop``.
+  '''
+  return _run_async(verify_password, secret, pwhash)
+
+def password_queue_stats():
+  '''Returns a ``dict`` describing the asynchronous password queue for the current process: ``threads``
+  (the number of hashing threads), ``pending`` (operations waiting for or currently being hashed),
+  ``peak_pending`` (the highest value of ``pending`` seen so far) and ``completed``.
+  '''
+  stats = dict(_stats)
+  stats['threads'] = options.password_threads
+  return stats
+
+def _run_async(fn, *args):
+  with _stats_lock:
+    _stats['pending'] += 1
+    _stats['peak_pending'] = max(_stats['peak_pending'], _stats['pending'])
+  future = TaskQueue.instance('toto.secret', options.password_threads).yield_task(fn, *args)
+  future.add_done_callback(lambda f: _complete())
+  return future
+
+def _complete():
+  with _stats_lock:
+    _stats['pending'] -= 1
+    _stats['completed'] += 1
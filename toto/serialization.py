@@ -0,0 +1,87 @@
+'''Toto serializes requests and responses with codecs registered by mime type. JSON is always available and
+``TotoHandler`` will register BSON and MessagePack codecs if the ``bson_enabled`` or ``msgpack_enabled`` options
+are set. Additional codecs can be added with ``register_codec()``.
+
+Requests are decoded with the codec matching their "content-type" header. Responses are encoded with the
+registered codec that best matches the request's "accept" header, falling back to the codec used for the request,
+then JSON. Newline delimited JSON ("application/x-ndjson") is also registered for clients that want streamed results
+one record per line.
+'''
+
+import json
+from toto.cache import LRUCache
+
+class Codec(object):
+  '''A codec for the given ``mime_type``. ``encode(obj)`` must return a ``str`` and ``decode(data)`` must accept one.
+  Set ``streaming`` to ``True`` if multiple encoded values may be written one after another to a single response and
+  still be read by clients.
+  '''
+
+  def __init__(self, mime_type, encode, decode, streaming=False):
+    self.mime_type = mime_type
+    self.encode = encode
+    self.decode = decode
+    self.streaming = streaming
+
+  def __repr__(self):
+    return 'Codec(%s)' % self.mime_type
+
+_codecs = {}
+_negotiated = LRUCache(256)
+
+def register_codec(mime_type, encode, decode, streaming=False):
+  '''Register a codec for ``mime_type``, replacing any existing codec for the same type. Returns the new ``Codec``.
+  '''
+  codec = Codec(mime_type.lower(), encode, decode, streaming)
+  _codecs[codec.mime_type] = codec
+  _negotiated.clear()
+  return codec
+
+def get_codec(content_type):
+  '''Returns the codec registered for ``content_type`` or ``None``. Any parameters (e.g. "; charset=utf-8") are ignored.
+  '''
+  try:
+    return _codecs[content_type]
+  except KeyError:
+    return _codecs.get(content_type.split(';', 1)[0].strip().lower())
+
+def negotiate_codec(accept, default=None):
+  '''Returns the registered codec that best matches the given "accept" header value according to its quality values.
+  ``default`` is returned if no registered codec is acceptable, and is preferred over other codecs with the same quality.
+  '''
+  if not accept:
+    return default
+  key = (accept, default and default.mime_type)
+  codec = _negotiated.get(key)
+  if codec:
+    return codec
+  best_q = 0
+  codec = None
+  for accepted in accept.split(','):
+    params = accepted.split(';')
+    candidate = _codecs.get(params[0].strip().lower())
+    if not candidate:
+      continue
+    q = 1.0
+    for param in params[1:]:
+      name, _, value = param.partition('=')
+      if name.strip() == 'q':
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0
+    if q > best_q or (q and q == best_q and candidate is default):
+      best_q = q
+      codec = candidate
+  codec = codec or default
+  _negotiated.set(key, codec)
+  return codec
+
+def set_json_module(module):
+  '''Use ``module`` to encode and decode JSON. The module must implement ``dumps`` and ``loads`` compatible with the
+  standard ``json`` module, e.g. ``ujson`` or ``simplejson``.
+  '''
+  register_codec('application/x-ndjson', lambda obj: module.dumps(obj) + '\n', module.loads, True)
+  return register_codec('application/json', module.dumps, module.loads, True)
+
+set_json_module(json)
@@ -25,6 +25,7 @@ from handler import TotoHandler
 from toto.service import TotoService, process_count
 from dbconnection import configured_connection
 from toto.options import safe_define
+from toto.ratelimit import SharedTokenBuckets, set_backend
 
 safe_define("port", default=8888, help="The port this server will bind to.")
 safe_define("root", default='/', help="The path to run the server on. This can be helpful when hosting multiple services on the same domain")
@@ -93,6 +94,14 @@ class TotoServer(TotoService):
 
   def prepare(self):
     self.__pending_sockets = bind_sockets(options.port)
+    if options.metrics_path:
+      from toto.metrics import metrics_directory, reset_metrics_directory
+      reset_metrics_directory(metrics_directory())
+    if options.profile_rate or options.profile_secret:
+      from toto.profiler import profile_directory, reset_profile_directory
+      reset_profile_directory(profile_directory())
+    if options.rate_limit_backend == 'shared':
+      set_backend(SharedTokenBuckets(options.rate_limit_slots))
 
   def main_loop(self):
     db_connection = configured_connection()
@@ -121,6 +130,28 @@ class TotoServer(TotoService):
       init_module = self.__event_init
       if init_module:
         init_module.invoke(event_manager)
+    if options.local_session_cache_size:
+      from toto.localsessioncache import LocalSessionCache
+      invalidation_event = options.event_mode != 'off' and options.local_session_cache_event or None
+      db_connection.set_local_session_cache(LocalSessionCache(options.local_session_cache_size, options.local_session_cache_ttl, invalidation_event))
+    if options.metrics_path:
+      from toto.metrics import MethodMetrics, MetricsHandler, metrics_directory
+      MethodMetrics.instance().start_reporting(metrics_directory(), self.service_id, options.metrics_interval)
+      handlers.append((os.path.join(options.root, options.metrics_path.lstrip('/')), MetricsHandler, {'directory': metrics_directory(), 'service_id': self.service_id}))
+    if options.tracing:
+      from toto.tracing import Tracer, configure_tracing
+      configure_tracing(self.service_id)
+      Tracer.instance().start_exporting()
+    if options.slow_request_threshold:
+      from toto.slowlog import SlowRequestLog
+      SlowRequestLog.instance().open(self.service_id)
+    if options.profile_rate or options.profile_secret:
+      from toto.profiler import SamplingProfiler, ProfileHandler, profile_directory
+      profiler = SamplingProfiler.instance()
+      profiler.start(options.profile_interval)
+      profiler.start_reporting(profile_directory(), self.service_id, options.profile_dump_interval)
+      if options.profile_path and options.profile_secret:
+        handlers.append((os.path.join(options.root, options.profile_path.lstrip('/')), ProfileHandler, {'directory': profile_directory(), 'service_id': self.service_id}))
     if not options.event_mode == 'only':
       handlers.append(('%s/?([^/]?[\w\./]*)' % options.root.rstrip('/'), TotoHandler, {'db_connection': db_connection}))
     
@@ -130,7 +161,16 @@ class TotoServer(TotoService):
       startup_path = options.startup_function.rsplit('.')
       __import__(startup_path[0]).__dict__[startup_path[1]](db_connection=db_connection, application=application)
   
-    server = HTTPServer(application)
+    if options.method_warmup and not options.event_mode == 'only':
+      TotoHandler.warmup(db_connection)
+    server = HTTPServer(application, max_body_size=options.max_body_size or None)
     server.add_sockets(self.__pending_sockets)
     print "Starting server %d on port %s" % (self.service_id, options.port)
+    if options.session_flush_interval or options.tracing:
+      import signal
+      signal.signal(signal.SIGTERM, lambda signum, frame: IOLoop.instance().add_callback_from_signal(IOLoop.instance().stop))
     IOLoop.instance().start()
+    if options.session_flush_interval:
+      db_connection.flush_session_expiries()
+    if options.tracing:
+      Tracer.instance().close()
@@ -91,7 +91,7 @@ class TotoService(object):
     def start_server_process(pidfile, service_id=0):
       self.service_id = service_id
       self.main_loop()
-      if pidfile:
+      if pidfile and os.path.exists(pidfile):
         os.remove(pidfile)
     count = process_count()
     processes = []
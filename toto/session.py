@@ -1,19 +1,29 @@
-import cPickle as pickle
 import hmac
 from hashlib import sha1
 from uuid import uuid4
 from base64 import b64encode
+from time import time
 from toto.exceptions import *
+from toto.cache import LRUCache
+from toto.sessioncodec import SessionCodec
 
 SESSION_ID_LENGTH = 22
 
+_IMMUTABLE_TYPES = (basestring, int, long, float, bool, tuple, frozenset, type(None))
+_MISSING = object()
+
 class TotoAccount(object):
   '''Instances of TotoAccount provide dictionary-like access to user account properties. Unlike
   sessions, account properties are loaded directly from distinct fields in the database so if
   you're not using a schemaless database you'll need to make sure the fields (columns) exist
   in advance.
+
+  Properties loaded with ``preload()`` may be shared between requests for the same user through a cache in the
+  current process (see ``preload()``).
   '''
 
+  _property_cache = LRUCache(10000)
+
   def __init__(self, session):
     self._session = session
     self._modified_properties = set()
@@ -40,7 +50,13 @@ class TotoAccount(object):
   def save(self):
     '''Save any modified keys to the user account stored in the database.
     '''
+    if not self._modified_properties:
+      return
     self._save_property(*self._modified_properties)
+    cached = TotoAccount._property_cache.get(self._session.user_id)
+    if cached is not None:
+      now = time()
+      cached.update((k, (self._properties[k], now)) for k in self._modified_properties)
     self._modified_properties.clear()
 
   def load_property(self, *args):
@@ -53,6 +69,37 @@ class TotoAccount(object):
       self._properties[k] = loaded[k]
     return self
 
+  def preload(self, keys, ttl=0):
+    '''Load any of ``keys`` that haven't been loaded yet with a single call to ``_load_property()``. Keys missing from
+    the account are loaded as ``None`` so they aren't requested again. If ``ttl`` is set, values loaded for the same
+    user by earlier requests in the current process are reused for up to ``ttl`` seconds. Values saved with ``save()``
+    in the current process update the cache, but changes made by other processes may go unnoticed for ``ttl`` seconds.
+    Used by ``toto.invocation.preload_account``.
+    '''
+    missing = [k for k in keys if k not in self._properties]
+    if not missing:
+      return self
+    cached = ttl and TotoAccount._property_cache.get(self._session.user_id)
+    if cached:
+      oldest = time() - ttl
+      for k in missing:
+        if k in cached and cached[k][1] >= oldest:
+          self._properties[k] = cached[k][0]
+      missing = [k for k in missing if k not in self._properties]
+      if not missing:
+        return self
+    loaded = self._load_property(*missing) or {}
+    values = {k: loaded.get(k) for k in missing}
+    self._properties.update(loaded)
+    self._properties.update(values)
+    if ttl:
+      if not cached:
+        cached = {}
+        TotoAccount._property_cache.set(self._session.user_id, cached)
+      now = time()
+      cached.update((k, (v, now)) for k, v in values.iteritems())
+    return self
+
   def __str__(self):
     return str({'properties': self._properties, 'modified': self._modified_properties})
 
@@ -65,9 +112,20 @@ class TotoAccount(object):
 class TotoSession(object):
   '''Instances of ``TotoSession`` provide dictionary-like access to current session variables, and the current
   account (if authenticated).
+
+  Sessions that store their state as a single value skip the write in ``save()`` if the serialized state is identical
+  to the state that was loaded or last saved, so any change to ``TotoSession.state``, including values changed in place,
+  is saved.
+
+  Backends that store each state key separately (the "keys" ``session_state_layout``) instead keep track of the keys
+  that change and only write those. Keys that are set, deleted or replaced (including directly through
+  ``TotoSession.state``) are detected automatically. Mutable values (e.g. lists or dicts) read through
+  ``session[key]`` are assumed to be modified; if you change a value in place after reading it from
+  ``TotoSession.state``, call ``mark_modified(key)`` before saving.
   '''
 
-  __serializer = pickle
+  __serializer = SessionCodec()
+  _local_session_cache = None
 
   def __init__(self, db, session_data, session_cache=None, key=None):
     self._db = db
@@ -75,9 +133,11 @@ class TotoSession(object):
     self.user_id = session_data['user_id']
     self.expires = session_data['expires']
     self.session_id = session_data['session_id']
-    self.state = session_data.get('state') and TotoSession.loads(session_data['state']) or {}
+    state = session_data.get('state')
+    self.state = isinstance(state, dict) and state or state and TotoSession.loads(state) or {}
     key = key or session_data.get('key')
     self.key = key or None
+    self._mark_saved(state and not isinstance(state, dict) and str(state) or None)
 
   def get_account(self, *args):
     '''Load the account associated with this session (if authenticated). Session properties are
@@ -86,23 +146,67 @@ class TotoSession(object):
     '''
     raise Exception("Unimplemented operation: get_account")
 
-  def session_data(self):
-    '''Return a session data ``dict`` that could be used to instantiate a session identical to the current one.
+  def session_data(self, encode_state=True):
+    '''Return a session data ``dict`` that could be used to instantiate a session identical to the current one. If
+    ``encode_state`` is ``False`` the ``state`` ``dict`` is included as is rather than serialized, which avoids
+    serializing it twice when the whole ``dict`` will be serialized.
     '''
-    data = {'user_id': self.user_id, 'expires': self.expires, 'session_id': self.session_id, 'state': TotoSession.dumps(self.state)}
+    data = {'user_id': self.user_id, 'expires': self.expires, 'session_id': self.session_id, 'state': encode_state and TotoSession.dumps(self.state) or self.state}
     if self.key:
       data['key'] = self.key
     return data
 
   def __getitem__(self, key):
-    return key in self.state and self.state[key] or None
+    value = self.state.get(key)
+    if not isinstance(value, _IMMUTABLE_TYPES):
+      self._modified_keys.add(key)
+    return value or None
 
   def __setitem__(self, key, value):
     self.state[key] = value
+    self._modified_keys.add(key)
 
   def __delitem__(self, key):
     if key in self.state:
       del self.state[key]
+      self._modified_keys.add(key)
+
+  def mark_modified(self, *keys):
+    '''Mark ``keys`` as modified so they will be written by the next call to ``save()``. Only needed for values that
+    were changed in place after being read directly from ``TotoSession.state``.
+    '''
+    self._modified_keys.update(keys)
+
+  def modified_keys(self):
+    '''Return the ``set`` of state keys that have been set, deleted or possibly changed since the session was loaded or
+    last saved. Keys that are no longer in ``TotoSession.state`` have been deleted.
+    '''
+    modified = set(self._modified_keys)
+    saved = self._saved_state
+    for key, value in self.state.iteritems():
+      if saved.get(key, _MISSING) is not value:
+        modified.add(key)
+    modified.update(key for key in saved if key not in self.state)
+    return modified
+
+  def _mark_saved(self, state=None):
+    '''Called after the session has been loaded or saved to reset ``modified_keys()``. Pass the serialized ``state``
+    that was loaded or saved, if there is one, so ``_dumps_modified_state()`` can compare against it.
+    '''
+    self._saved_state = dict(self.state)
+    self._modified_keys = set()
+    if state is None and not self.state:
+      state = TotoSession.dumps(self.state)
+    self._saved_digest = state and sha1(state).digest()
+
+  def _dumps_modified_state(self):
+    '''Return the serialized state, or ``None`` if it is identical to the serialized state passed to the last call to
+    ``_mark_saved()``. Used by backends that store the whole state as a single value.
+    '''
+    state = TotoSession.dumps(self.state)
+    if self._saved_digest and sha1(state).digest() == self._saved_digest:
+      return None
+    return state
 
   def __iter__(self):
     return self.state.__iter__()
@@ -126,38 +230,56 @@ class TotoSession(object):
     '''
     raise Exception("Unimplemented operation: refresh")
 
-  def _save_cache(self):
+  def _save_cache(self, state=None):
+    '''Store the session in the session caches, if any. ``state`` is the serialized state if the caller already has it.
+    Returns ``True`` if the session was written to a ``TotoSessionCache``.
+    '''
+    cached = False
     if self._session_cache:
-      updated_session_id = self._session_cache.store_session(self.session_data())
+      session_data = self.session_data(False)
+      if getattr(self._session_cache, 'encode_state', True):
+        session_data['state'] = state = state or TotoSession.dumps(self.state)
+      updated_session_id = self._session_cache.store_session(session_data)
       if updated_session_id:
         self.session_id = updated_session_id
-      return True
-    return False
+      cached = True
+    if self._local_session_cache:
+      session_data = self.session_data(False)
+      session_data['state'] = state or TotoSession.dumps(self.state)
+      self._local_session_cache.store_session(session_data, True)
+    return cached
 
   def save(self):
-    '''Save the session to the database.
+    '''Save the session to the database. Implementations should return without writing anything if
+    ``_dumps_modified_state()`` returns ``None`` (or, if each key is stored separately, ``modified_keys()`` is empty),
+    and call ``_mark_saved()`` once the session has been saved.
     '''
     raise Exception("Unimplemented operation: save")
 
-  def verify(self, mac, signature):
-    '''Verify the mac and signature with this session's authenticated key.
+  def verify(self, mac, signature, chunks=()):
+    '''Verify the mac and signature with this session's authenticated key. Any ``chunks`` are appended to ``signature``
+    as they are read.
     '''
     if not self.key or not mac or not signature:
       raise TotoException(ERROR_INVALID_HMAC, "Invalid HMAC")
-    if self.hmac(signature) != mac:
+    if self.hmac(signature, chunks) != mac:
       raise TotoException(ERROR_INVALID_HMAC, "Invalid HMAC")
     return self
 
-  def hmac(self, signature):
-    '''Return the hmac of the signature signed with the authenticated key.
+  def hmac(self, signature, chunks=()):
+    '''Return the hmac of the signature signed with the authenticated key. Any ``chunks`` are appended to ``signature``
+    as they are read.
     '''
-    return b64encode(hmac.new(self.key, signature, sha1).digest())
+    mac = hmac.new(self.key, signature, sha1)
+    for chunk in chunks:
+      mac.update(chunk)
+    return b64encode(mac.digest())
 
   @classmethod
   def set_serializer(cls, serializer):
     '''Set the module that instances of ``TotoSession`` and ``TotoSessionCache`` will use to serialize session state. The module must implement ``loads`` and ``dumps``
     and support serialization and deserialization of any data you want to store in the session.
-    By default, ``cPickle`` is used.
+    By default, a ``toto.sessioncodec.SessionCodec`` is used, which can also read state serialized with ``cPickle``.
     '''
     cls.__serializer = serializer
 
@@ -165,6 +287,8 @@ class TotoSession(object):
   def loads(cls, data):
     '''A convenience method to call ``serializer.loads()`` on the active serializer.
     '''
+    if isinstance(cls.__serializer, SessionCodec):
+      return cls.__serializer.loads(data)
     return cls.__serializer.loads(str(data))
 
   @classmethod
@@ -184,8 +308,13 @@ class TotoSessionCache(object):
   for each authenticated request, it can be useful to keep them in a specialized database (redis, memcached) separate from the rest of your data.
 
   Note: cached sessions cannot currently be removed before their expiry.
+
+  Implementations that serialize the whole ``session_data`` ``dict`` should set ``encode_state`` to ``False`` so that
+  ``state`` is passed to ``store_session()`` as a ``dict`` and only serialized once.
   '''
 
+  encode_state = True
+
   def store_session(self, session_data):
     '''Store a ``TotoSession`` with the given ``session_data``. ``session_data`` can be expected to contain, at a minimum, ``session_id`` and ``expires``.
     If an existing session matches the ``session_id`` contained in ``session_data``, it should be overwritten. The session is expected to be removed
@@ -0,0 +1,93 @@
+'''The compact, versioned format used by ``TotoSession`` to serialize session state. Each value starts with a two byte
+header: ``0xff`` followed by a byte holding the format version, the encoding of the payload and whether the payload is
+zlib compressed. Payloads are encoded with ``marshal`` by default, which is fast and keeps Python's types (``tuple``,
+``unicode``, ``long``, etc.) intact. If any part of a value can't be encoded by ``marshal``, e.g. a ``datetime`` or an
+instance of your own class, the whole value is encoded with ``cPickle`` instead. With the "blob" session layout the
+value is the entire session state, so one such item switches the whole state to ``cPickle``.
+
+``0xff`` is never the first byte of a pickle, so data written by older versions of Toto (plain ``cPickle``) is detected
+and loaded transparently, and is rewritten in the new format the next time the session is saved.
+'''
+
+import marshal
+import zlib
+import cPickle as pickle
+
+MAGIC = '\xff'
+VERSION = 1
+
+FORMAT_PICKLE = 0
+FORMAT_MARSHAL = 1
+FORMAT_MSGPACK = 2
+
+_FORMAT_MASK = 0x07
+_COMPRESSED = 0x08
+
+def _msgpack():
+  import msgpack
+  return msgpack
+
+class SessionCodec(object):
+  '''Serializes session state with a small header identifying its format. Payloads of at least ``compress_threshold``
+  bytes are compressed with zlib at ``compress_level``, if that makes them smaller. ``format`` may be "marshal" (the
+  default), "msgpack" (requires the ``msgpack`` module, and will turn tuples into lists) or "pickle".
+
+  Pass an instance to ``TotoSession.set_serializer()`` to change the defaults.
+  '''
+
+  FORMATS = {'pickle': FORMAT_PICKLE, 'marshal': FORMAT_MARSHAL, 'msgpack': FORMAT_MSGPACK}
+
+  def __init__(self, compress_threshold=1024, compress_level=6, format='marshal'):
+    if format not in self.FORMATS:
+      raise ValueError('Unknown session format: %s' % format)
+    self.compress_threshold = compress_threshold
+    self.compress_level = compress_level
+    self.format = self.FORMATS[format]
+    if self.format == FORMAT_MSGPACK:
+      _msgpack()
+
+  def _encode(self, fmt, data):
+    if fmt == FORMAT_MARSHAL:
+      return marshal.dumps(data, 2)
+    if fmt == FORMAT_MSGPACK:
+      return _msgpack().packb(data)
+    return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+  def _decode(self, fmt, payload):
+    if fmt == FORMAT_MARSHAL:
+      return marshal.loads(payload)
+    if fmt == FORMAT_MSGPACK:
+      return _msgpack().unpackb(str(payload))
+    if fmt == FORMAT_PICKLE:
+      return pickle.loads(str(payload))
+    raise ValueError('Unknown session format: %s' % fmt)
+
+  def dumps(self, data):
+    '''Returns ``data`` serialized as a ``str`` with a format header.'''
+    fmt = self.format
+    try:
+      payload = self._encode(fmt, data)
+    except (ValueError, TypeError):
+      fmt = FORMAT_PICKLE
+      payload = self._encode(fmt, data)
+    flags = VERSION << 4 | fmt
+    if self.compress_threshold is not None and len(payload) >= self.compress_threshold:
+      compressed = zlib.compress(payload, self.compress_level)
+      if len(compressed) < len(payload):
+        payload = compressed
+        flags |= _COMPRESSED
+    return MAGIC + chr(flags) + payload
+
+  def loads(self, data):
+    '''Returns the value serialized in ``data``, which may be a ``str`` or any object supporting the buffer protocol
+    (e.g. a ``buffer`` returned by a database driver). Data without a format header is loaded with ``cPickle``.
+    '''
+    if data[:1] != MAGIC:
+      return pickle.loads(str(data))
+    flags = ord(data[1])
+    if flags >> 4 > VERSION:
+      raise ValueError('Unsupported session format version: %s' % (flags >> 4))
+    payload = buffer(data, 2)
+    if flags & _COMPRESSED:
+      payload = zlib.decompress(payload)
+    return self._decode(flags & _FORMAT_MASK, payload)
@@ -0,0 +1,148 @@
+'''A log of slow requests with a breakdown of where their time was spent. Set ``slow_request_threshold`` to a number of
+seconds and every request that takes at least that long to answer is written to ``slow_request_log`` as a line of
+JSON::
+
+  {"time": "2014-06-01T12:00:00.250000", "uri": "/", "method": "account.login", "status": 200, "duration_ms": 512.4,
+   "phases": [{"phase": "parse", "offset_ms": 0.1, "duration_ms": 0.2},
+              {"phase": "session", "offset_ms": 0.4, "duration_ms": 301.7},
+              {"phase": "hmac", "offset_ms": 302.2, "duration_ms": 0.1},
+              {"phase": "worker", "detail": "mail.send", "offset_ms": 303.0, "duration_ms": 205.1},
+              {"phase": "method", "detail": "account.login", "offset_ms": 0.3, "duration_ms": 508.6},
+              {"phase": "serialize", "offset_ms": 509.0, "duration_ms": 1.8},
+              {"phase": "write", "offset_ms": 510.9, "duration_ms": 1.2}]}
+
+Offsets are measured from the time the request was received. Phases may overlap: "method" covers everything the
+method did, including the "session", "hmac", "worker" and "db" phases started on its behalf. "worker" phases are
+recorded for calls made through ``toto.workerconnection.WorkerConnection`` and "db" phases for ``DBConnection``
+operations run off of the ``IOLoop``. Other code can add phases with ``phase_recorder()``.
+
+Each server process writes to its own file, named by adding the process's service ID before the extension of
+``slow_request_log`` (e.g. "slow_requests.0.log"). Files are rotated once they reach ``slow_request_log_size`` bytes,
+and are written from a ``TaskQueue`` so the ``IOLoop`` never waits on the disk.
+'''
+
+import os
+import json
+import logging
+import threading
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from time import time
+from tornado.options import define, options
+from tornado.stack_context import StackContext
+from toto.tasks import TaskQueue
+
+define("slow_request_threshold", default=0.0, help="If set, requests taking at least this many seconds will be written to slow_request_log with a breakdown of where the time was spent.")
+define("slow_request_log", default='slow_requests.log', help="The file that slow requests are logged to. Each server process adds its service ID before the extension.")
+define("slow_request_log_size", default=10 * 1024 * 1024, help="The size in bytes at which slow request logs are rotated.")
+define("slow_request_log_count", default=5, help="The number of rotated slow request logs to keep.")
+
+_state = threading.local()
+
+class RequestPhases(object):
+  '''The phases of a request that started at ``start`` (a ``time.time()`` value). Each phase is stored in ``phases``
+  as a ``(name, start, duration, detail)`` tuple. ``method`` is the name of the invoked method, or "<batch>".
+  '''
+
+  def __init__(self, start):
+    self.start = start
+    self.method = None
+    self.phases = []
+
+  def record(self, name, start, detail=None):
+    '''Record a phase called ``name`` that started at ``start`` and ended now. ``detail`` can identify the phase
+    further, e.g. the name of a worker method.
+    '''
+    self.phases.append((name, start, time() - start, detail))
+
+  def to_list(self):
+    phases = []
+    for name, start, duration, detail in self.phases:
+      phase = {'phase': name, 'offset_ms': round((start - self.start) * 1000.0, 3), 'duration_ms': round(duration * 1000.0, 3)}
+      if detail is not None:
+        phase['detail'] = detail
+      phases.append(phase)
+    return phases
+
+def current_phases():
+  '''Returns the ``RequestPhases`` of the request currently being processed on this thread, or ``None``.'''
+  return getattr(_state, 'phases', None)
+
+class _PhasesContext(object):
+
+  def __init__(self, phases):
+    self.phases = phases
+
+  def __enter__(self):
+    self.previous = current_phases()
+    _state.phases = self.phases
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    _state.phases = self.previous
+
+def phases_context(phases):
+  '''Returns a ``StackContext`` that makes ``phases`` available from ``current_phases()`` to everything run within it,
+  including callbacks scheduled on the ``IOLoop``.
+  '''
+  return StackContext(lambda: _PhasesContext(phases))
+
+def phase_recorder(name, detail=None):
+  '''Start a phase of the current request. Returns a function that records the phase when it is called (with any
+  arguments, so it may be used as a callback), or ``None`` if slow requests aren't being logged.
+  '''
+  phases = current_phases()
+  if phases is None:
+    return None
+  start = time()
+  return lambda *args, **kwargs: phases.record(name, start, detail)
+
+def timed_callback(name, detail, callback):
+  '''Returns ``callback`` wrapped to record a phase of the current request when it is called. Returns ``callback``
+  unchanged if it is ``None`` or slow requests aren't being logged.
+  '''
+  record = callback and phase_recorder(name, detail)
+  if not record:
+    return callback
+  def wrapper(*args, **kwargs):
+    record()
+    return callback(*args, **kwargs)
+  return wrapper
+
+class SlowRequestLog(object):
+  '''Writes slow requests to a rotating log file. Use ``SlowRequestLog.instance()`` to get the process wide instance.'''
+
+  def __init__(self):
+    self._logger = None
+
+  def open(self, service_id=None):
+    '''Open the log file for the server process with ``service_id``. Called by ``TotoServer`` as each process starts.'''
+    path = options.slow_request_log
+    if service_id is not None:
+      base, extension = os.path.splitext(path)
+      path = '%s.%s%s' % (base, service_id, extension)
+    handler = RotatingFileHandler(path, maxBytes=options.slow_request_log_size, backupCount=options.slow_request_log_count)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    self._logger = logging.Logger('toto.slow_requests')
+    self._logger.addHandler(handler)
+
+  def log(self, request, status, phases):
+    '''Log ``request`` if it took at least ``slow_request_threshold`` seconds. The entry is written from the
+    "toto.slowlog" ``TaskQueue``.
+    '''
+    duration = time() - phases.start
+    if duration < options.slow_request_threshold:
+      return
+    if not self._logger:
+      self.open()
+    entry = {'time': datetime.utcfromtimestamp(phases.start).isoformat(), 'uri': request.uri, 'method': phases.method, 'status': status, 'duration_ms': round(duration * 1000.0, 3), 'phases': phases.to_list()}
+    TaskQueue.instance('toto.slowlog').add_task(self._write, entry)
+
+  def _write(self, entry):
+    self._logger.info(json.dumps(entry))
+
+  @classmethod
+  def instance(cls):
+    '''Returns the ``SlowRequestLog`` instance for the current process.'''
+    if not hasattr(cls, '_instance'):
+      cls._instance = cls()
+    return cls._instance
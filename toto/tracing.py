@@ -0,0 +1,223 @@
+'''Request tracing across servers, workers and events. When the ``tracing`` option is set, each method invoked by
+``TotoHandler`` is recorded as a span whose ID is the handler's ``transaction_id``. Spans are also recorded for:
+
+* Calls made through ``ZMQWorkerConnection`` and ``HTTPWorkerConnection``. The trace ID and the call's span ID are sent
+  with the task, and ``TotoWorker`` continues the trace with a span for the task.
+* Events sent with ``EventManager.send()``, which carry the trace ID and span ID of the sender. Event handlers run
+  within a span for the received event.
+
+Requests may continue an existing trace by sending "x-toto-trace-id" and "x-toto-span-id" headers. Responses include
+the trace ID in an "x-toto-trace-id" header.
+
+Finished spans are kept in a ring of the most recent ``trace_buffer_size`` spans, available from
+``Tracer.instance().spans()``, and passed in batches to an exporter, if one is set with ``Tracer.set_exporter()``.
+Set ``trace_file`` to export spans as lines of JSON with ``JSONFileExporter``. ``TotoServer`` exports finished spans
+every ``trace_export_interval`` seconds, and servers and workers export any remaining spans when they shut down.
+'''
+
+import os
+import json
+import threading
+from collections import deque
+from time import time
+from uuid import uuid4
+from tornado.options import define, options
+from tornado.stack_context import StackContext
+from tornado.ioloop import PeriodicCallback
+from toto.tasks import TaskQueue
+
+define("tracing", default=False, help="Record spans for methods, worker calls and events, and propagate trace IDs to workers and event handlers.")
+define("trace_buffer_size", default=1000, help="The number of recent spans to keep in memory when tracing is enabled.")
+define("trace_file", default=None, type=str, help="If set, finished spans will be appended to this file as lines of JSON. Each process adds its service ID before the extension.")
+define("trace_export_interval", default=5.0, help="The number of seconds between span exports.")
+
+_state = threading.local()
+
+class Span(object):
+  '''A timed operation that is part of the trace with ``trace_id``. ``parent_id`` is the ``span_id`` of the span that
+  caused it, or ``None`` for the root of a trace.
+  '''
+
+  def __init__(self, tracer, name, trace_id=None, parent_id=None, span_id=None, tags=None):
+    self.tracer = tracer
+    self.name = name
+    self.trace_id = trace_id or uuid4().hex
+    self.parent_id = parent_id
+    self.span_id = span_id or uuid4().hex
+    self.tags = tags or {}
+    self.start = time()
+    self.duration = None
+    self.error = None
+
+  @property
+  def finished(self):
+    return self.duration is not None
+
+  def finish(self, error=None):
+    '''Finish the span, recording ``error`` if set. Only the first call has any effect.'''
+    if self.finished:
+      return
+    self.duration = time() - self.start
+    if error is not None:
+      self.error = isinstance(error, dict) and error or repr(error)
+    self.tracer.record(self)
+
+  def context(self):
+    '''Returns the ``dict`` sent with messages to continue this trace.'''
+    return {'trace_id': self.trace_id, 'parent_id': self.span_id}
+
+  def to_dict(self):
+    span = {'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id, 'name': self.name, 'start': self.start, 'duration': self.duration, 'pid': os.getpid()}
+    if self.tags:
+      span['tags'] = self.tags
+    if self.error is not None:
+      span['error'] = self.error
+    return span
+
+def current_span():
+  '''Returns the span of the operation currently being processed on this thread, or ``None``.'''
+  return getattr(_state, 'span', None)
+
+def trace_context():
+  '''Returns the ``dict`` to send with a message to continue the current trace, or ``None``.'''
+  span = current_span()
+  return span and span.context()
+
+class _SpanContext(object):
+
+  def __init__(self, span):
+    self.span = span
+
+  def __enter__(self):
+    self.previous = current_span()
+    _state.span = self.span
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    _state.span = self.previous
+
+def span_context(span):
+  '''Returns a ``StackContext`` that makes ``span`` available from ``current_span()`` to everything run within it,
+  including callbacks scheduled on the ``IOLoop``.
+  '''
+  return StackContext(lambda: _SpanContext(span))
+
+def start_child_span(name, **tags):
+  '''Start a span called ``name`` as a child of the current span. Returns ``None`` if there is no current span.'''
+  parent = current_span()
+  return parent and parent.tracer.start_span(name, parent.trace_id, parent.span_id, tags=tags)
+
+def finish_callback(span, callback):
+  '''Returns ``callback`` wrapped to finish ``span`` when it is called. If ``callback`` is ``None``, ``span`` is
+  finished immediately. Returns ``callback`` unchanged if ``span`` is ``None``.
+  '''
+  if not span:
+    return callback
+  if not callback:
+    span.finish()
+    return None
+  def wrapper(*args, **kwargs):
+    span.finish()
+    return callback(*args, **kwargs)
+  return wrapper
+
+class JSONFileExporter(object):
+  '''Appends spans to the file at ``path``, one JSON object per line.'''
+
+  def __init__(self, path):
+    self.path = path
+
+  def export(self, spans):
+    with open(self.path, 'a') as f:
+      for span in spans:
+        f.write(json.dumps(span.to_dict()))
+        f.write('\n')
+
+class Tracer(object):
+  '''Records finished spans for the current process. Use ``Tracer.instance()`` to get the process wide instance.'''
+
+  def __init__(self, buffer_size=1000, export_interval=5.0):
+    self._spans = deque(maxlen=buffer_size)
+    self._pending = []
+    self._lock = threading.Lock()
+    self._export_lock = threading.Lock()
+    self._last_export = time()
+    self._exporter_callback = None
+    self.export_interval = export_interval
+    self.exporter = None
+
+  def set_exporter(self, exporter):
+    '''Pass finished spans to ``exporter.export(spans)``. Exports run in the "toto.tracing" ``TaskQueue`` at most every
+    ``trace_export_interval`` seconds.
+    '''
+    self.exporter = exporter
+
+  def start_span(self, name, trace_id=None, parent_id=None, span_id=None, tags=None):
+    '''Start a span called ``name``. A new trace is started if ``trace_id`` is not set.'''
+    return Span(self, name, trace_id, parent_id, span_id, tags)
+
+  def continue_trace(self, name, context, **tags):
+    '''Start a span called ``name`` continuing the trace described by ``context``, as returned by
+    ``Span.context()``. Starts a new trace if ``context`` is empty.
+    '''
+    context = context or {}
+    return self.start_span(name, context.get('trace_id'), context.get('parent_id'), tags=tags)
+
+  def record(self, span):
+    '''Called by ``Span.finish()``.'''
+    self._spans.append(span)
+    if self.exporter:
+      with self._lock:
+        self._pending.append(span)
+      if time() - self._last_export >= self.export_interval:
+        self.flush()
+
+  def flush(self):
+    '''Export any finished spans that haven't been exported yet in the "toto.tracing" ``TaskQueue``.'''
+    self._last_export = time()
+    if self._pending and self.exporter:
+      TaskQueue.instance('toto.tracing').add_task(self.export)
+
+  def export(self):
+    '''Export any finished spans that haven't been exported yet on the current thread.'''
+    with self._export_lock:
+      with self._lock:
+        spans, self._pending = self._pending, []
+      if spans and self.exporter:
+        self.exporter.export(spans)
+
+  def start_exporting(self):
+    '''Call ``flush()`` every ``export_interval`` seconds on the current ``IOLoop`` so that spans are exported when
+    no new spans are being recorded.
+    '''
+    if self.exporter and self.export_interval > 0 and not self._exporter_callback:
+      self._exporter_callback = PeriodicCallback(self.flush, self.export_interval * 1000)
+      self._exporter_callback.start()
+
+  def close(self):
+    '''Stop exporting periodically and export any remaining spans. Called as servers and workers shut down.'''
+    if self._exporter_callback:
+      self._exporter_callback.stop()
+      self._exporter_callback = None
+    self.export()
+
+  def spans(self, trace_id=None):
+    '''Returns the most recent finished spans, optionally only those belonging to ``trace_id``.'''
+    return [span for span in list(self._spans) if trace_id is None or span.trace_id == trace_id]
+
+  @classmethod
+  def instance(cls):
+    '''Returns the ``Tracer`` instance for the current process, configured by the ``trace_`` options.'''
+    if not hasattr(cls, '_instance'):
+      cls._instance = cls(options.trace_buffer_size, options.trace_export_interval)
+    return cls._instance
+
+def configure_tracing(service_id=None):
+  '''Set the ``JSONFileExporter`` for ``trace_file``, if set, on the process wide ``Tracer``. Called by ``TotoServer``
+  and ``TotoWorkerService`` as each process starts.
+  '''
+  if options.trace_file:
+    path = options.trace_file
+    if service_id is not None:
+      base, extension = os.path.splitext(path)
+      path = '%s.%s%s' % (base, service_id, extension)
+    Tracer.instance().set_exporter(JSONFileExporter(path))
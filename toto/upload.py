@@ -0,0 +1,165 @@
+'''Streaming request bodies. When the ``stream_uploads`` option is set, ``TotoHandler`` receives request bodies as
+they arrive instead of waiting for Tornado to buffer them. Bodies that will be decoded with a codec, and form encoded
+bodies, are still read into memory before the method is invoked. Other bodies are written to temporary files that are
+kept in memory until they reach ``upload_spool_size`` bytes:
+
+* "multipart/form-data" requests are parsed as they arrive. Form fields are passed to methods as
+  ``parameters['arguments']`` and each uploaded file is passed as an ``UploadedFile`` in ``parameters['files']``.
+* Any other body (e.g. "image/jpeg" or "application/octet-stream") is passed as an ``UploadedFile`` in
+  ``parameters['file']`` with any query arguments in ``parameters['arguments']``.
+
+Uploaded files are closed (and any temporary files removed) when the request finishes.
+'''
+
+import cgi
+from cStringIO import StringIO
+from tempfile import SpooledTemporaryFile
+from tornado.httputil import HTTPHeaders
+from tornado.util import ObjectDict
+from tornado.web import HTTPError
+
+_MAX_PART_HEADER_SIZE = 65536
+
+class UploadedFile(ObjectDict):
+  '''An uploaded file with ``filename``, ``content_type``, ``size`` and ``file`` properties. ``file`` is a readable
+  file-like object positioned at the start of the upload. It is kept in memory while it is smaller than
+  ``upload_spool_size`` bytes, otherwise it is backed by a temporary file.
+  '''
+
+def _boundary(content_type):
+  for field in content_type.split(';')[1:]:
+    name, _, value = field.strip().partition('=')
+    if name == 'boundary' and value:
+      if value.startswith('"') and value.endswith('"'):
+        value = value[1:-1]
+      return value
+  raise HTTPError(400, 'Invalid multipart/form-data')
+
+class MultipartParser(object):
+  '''Parses a "multipart/form-data" body with the given ``boundary`` as it is passed to ``write()``. Form fields are
+  collected in ``arguments`` and files in ``files``, both as lists of values keyed by field name, matching
+  ``tornado.httputil.HTTPServerRequest``.
+  '''
+
+  def __init__(self, boundary, spool_size):
+    self.delimiter = '\r\n--' + boundary
+    self.spool_size = spool_size
+    self.arguments = {}
+    self.files = {}
+    self._buffer = '\r\n'
+    self._state = self._read_boundary
+    self._part = None
+
+  def write(self, data):
+    self._buffer += data
+    while self._state and self._state():
+      pass
+
+  def close(self):
+    if self._state:
+      raise HTTPError(400, 'Invalid multipart/form-data')
+
+  def _read_boundary(self):
+    index = self._buffer.find(self.delimiter)
+    if index < 0:
+      self._buffer = self._buffer[-len(self.delimiter):]
+      return False
+    end = index + len(self.delimiter)
+    if len(self._buffer) < end + 2:
+      return False
+    if self._buffer[end:end + 2] == '--':
+      self._buffer = ''
+      self._state = None
+      return False
+    self._buffer = self._buffer[end + 2:]
+    self._state = self._read_headers
+    return True
+
+  def _read_headers(self):
+    index = self._buffer.find('\r\n\r\n')
+    if index < 0:
+      if len(self._buffer) > _MAX_PART_HEADER_SIZE:
+        raise HTTPError(400, 'Invalid multipart/form-data')
+      return False
+    headers = HTTPHeaders.parse(self._buffer[:index])
+    self._buffer = self._buffer[index + 4:]
+    disposition, params = cgi.parse_header(headers.get('Content-Disposition', ''))
+    name = params.get('name')
+    if disposition != 'form-data' or not name:
+      raise HTTPError(400, 'Invalid multipart/form-data')
+    if 'filename' in params:
+      upload = UploadedFile(filename=params['filename'], content_type=headers.get('Content-Type', 'application/octet-stream'), file=SpooledTemporaryFile(self.spool_size), size=0)
+      self.files.setdefault(name, []).append(upload)
+      self._part = (name, upload)
+    else:
+      self._part = (name, StringIO())
+    self._state = self._read_body
+    return True
+
+  def _read_body(self):
+    name, target = self._part
+    destination = isinstance(target, UploadedFile) and target.file or target
+    index = self._buffer.find(self.delimiter)
+    if index < 0:
+      keep = len(self.delimiter)
+      if len(self._buffer) > keep:
+        destination.write(self._buffer[:-keep])
+        self._buffer = self._buffer[-keep:]
+      return False
+    destination.write(self._buffer[:index])
+    self._buffer = self._buffer[index:]
+    if destination is target:
+      self.arguments.setdefault(name, []).append(target.getvalue())
+    else:
+      target.size = destination.tell()
+      destination.seek(0)
+    self._part = None
+    self._state = self._read_boundary
+    return True
+
+class StreamingBody(object):
+  '''Receives a request body with the given ``content_type``. "multipart/form-data" bodies are parsed as they arrive,
+  other bodies are spooled to ``raw``. Set ``keep_raw`` to also spool multipart bodies, e.g. to verify a signature.
+  '''
+
+  def __init__(self, content_type, spool_size, keep_raw=False):
+    self.content_type = content_type
+    self.multipart = content_type.startswith('multipart/form-data') and MultipartParser(_boundary(content_type), spool_size) or None
+    self.raw = (keep_raw or not self.multipart) and SpooledTemporaryFile(spool_size) or None
+    self.size = 0
+
+  def write(self, data):
+    self.size += len(data)
+    if self.raw:
+      self.raw.write(data)
+    if self.multipart:
+      self.multipart.write(data)
+
+  def read(self):
+    '''Returns the whole body as a ``str``.'''
+    self.raw.seek(0)
+    return self.raw.read()
+
+  def chunks(self, size=65536):
+    '''Iterate over the body in chunks of up to ``size`` bytes.'''
+    self.raw.seek(0)
+    return iter(lambda: self.raw.read(size), '')
+
+  def parameters(self, arguments):
+    '''Returns the parameters passed to methods, combining the request's query ``arguments`` with any form fields.'''
+    if self.multipart:
+      self.multipart.close()
+      combined = dict((k, list(v)) for k, v in arguments.iteritems())
+      for k, v in self.multipart.arguments.iteritems():
+        combined.setdefault(k, []).extend(v)
+      return {'arguments': combined, 'files': self.multipart.files}
+    self.raw.seek(0)
+    return {'arguments': arguments, 'file': UploadedFile(filename=None, content_type=self.content_type, file=self.raw, size=self.size)}
+
+  def close(self):
+    if self.raw:
+      self.raw.close()
+    if self.multipart:
+      for uploads in self.multipart.files.itervalues():
+        for upload in uploads:
+          upload.file.close()
@@ -39,6 +39,8 @@ from toto.service import TotoService, process_count, pid_path
 from toto.dbconnection import configured_connection
 from exceptions import *
 from toto.options import safe_define
+from toto.deadline import deadline_exceeded
+from toto.tracing import Tracer, span_context, configure_tracing
 
 safe_define("method_module", default='methods', help="The root module to use for method lookup")
 safe_define("remote_event_receivers", type=str, help="A comma separated list of remote event address that this event manager should connect to. e.g.: 'tcp://192.168.1.2:8889'", multiple=True)
@@ -110,6 +112,8 @@ class TotoWorkerService(TotoService):
 
   def main_loop(self):
     db_connection = configured_connection()
+    if options.tracing:
+      configure_tracing(self.service_id)
 
     if options.remote_event_receivers:
       from toto.events import EventManager
@@ -127,6 +131,8 @@ class TotoWorkerService(TotoService):
       startup_path = options.startup_function.rsplit('.')
       __import__(startup_path[0]).__dict__[startup_path[1]](worker=worker, db_connection=db_connection)
     worker.start()
+    if options.tracing:
+      Tracer.instance().close()
 
   def send_worker_command(self, command):
     if options.control_socket_address:
@@ -172,6 +178,7 @@ class TotoWorker():
     self.decompress = compression and compression.decompress or (lambda x: x)
     self.loads = serialization and serialization.loads or pickle.loads
     self.dumps = serialization and serialization.dumps or pickle.dumps
+    self.tracer = options.tracing and Tracer.instance() or None
     if options.debug:
       from traceback import format_exc
       def error_info(self, e):
@@ -187,6 +194,22 @@ class TotoWorker():
     logging.error(str(e))
     return e.__dict__
 
+  def _invoke(self, method, data):
+    '''Invoke ``method`` with the task's parameters. When tracing is enabled, the task is recorded as a span that
+    continues the caller's trace.
+    '''
+    if not self.tracer:
+      return method.invoke(self, data['parameters'])
+    span = self.tracer.continue_trace('task.%s' % data['method'], data.get('trace'))
+    try:
+      with span_context(span):
+        response = method.invoke(self, data['parameters'])
+    except Exception as e:
+      span.finish(e)
+      raise
+    span.finish()
+    return response
+
   def log_status(self):
     logging.info('Pid: %s status: %s' % (os.getpid(), self.status))
   
@@ -226,6 +249,11 @@ class TotoWorker():
         message_id = message[0]
         data = self.loads(self.decompress(message[1]))
         logging.info('Received Task %s: %s' % (message_id, data['method']))
+        if data.get('deadline') and data['deadline'] <= time.time():
+          logging.info('Dropped expired Task %s: %s' % (message_id, data['method']))
+          socket.send_multipart((message_id, self.compress(self.dumps({'error': deadline_exceeded().__dict__}))))
+          pending_reply = False
+          continue
         method = self.method_module
         for i in data['method'].split('.'):
           method = getattr(method, i)
@@ -233,10 +261,10 @@ class TotoWorker():
           socket.send_multipart((message_id,))
           pending_reply = False
           self.status = 'Working'
-          method.invoke(self, data['parameters'])
+          self._invoke(method, data)
         else:
           self.status = 'Working'
-          response = method.invoke(self, data['parameters'])
+          response = self._invoke(method, data)
           socket.send_multipart((message_id, self.compress(self.dumps(response))))
           pending_reply = False
       except Exception as e:
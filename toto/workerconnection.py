@@ -10,6 +10,8 @@ from time import time
 from uuid import uuid4
 from traceback import format_exc
 from toto.options import safe_define
+from toto.deadline import current_deadline
+from toto.tracing import start_child_span
 
 safe_define("worker_compression_module", type=str, help="The module to use for compressing and decompressing messages to workers. The module must have 'decompress' and 'compress' methods. If not specified, no compression will be used. Only the default instance will be affected")
 safe_define("worker_serialization_module", type=str, help="The module to use for serializing and deserializing messages to workers. The module must have 'dumps' and 'loads' methods. If not specified, cPickle will be used. Only the default instance will be affected")
@@ -47,6 +49,23 @@ class WorkerConnection(object):
   def log_error(self, error):
     logging.error(repr(error))
 
+  def _message(self, method, parameters, deadline=None, span=None):
+    '''Returns the message sent to workers to invoke ``method``. ``deadline`` defaults to the deadline of the request
+    currently being processed, if any, so workers can skip tasks whose caller has stopped waiting. If ``span`` is set,
+    its trace context is sent so the worker can continue the trace.
+    '''
+    message = {'method': method, 'parameters': parameters}
+    deadline = deadline or current_deadline()
+    if deadline:
+      message['deadline'] = deadline
+    if span:
+      message['trace'] = span.context()
+    return message
+
+  def _start_span(self, method):
+    '''Returns a span for a call to ``method`` if the current request is being traced, otherwise ``None``.'''
+    return start_child_span('worker.%s' % method)
+
   def enable_traceback_logging(self):
     from new import instancemethod
     from traceback import format_exc
@@ -5,6 +5,8 @@ import zlib
 import logging
 from toto.exceptions import *
 from toto.workerconnection import WorkerConnection
+from toto.slowlog import timed_callback
+from toto.tracing import finish_callback
 from threading import Thread
 from tornado.options import options
 from tornado.gen import Task
@@ -61,7 +63,7 @@ class ZMQWorkerConnection(WorkerConnection):
     self.compress = compression and compression.compress or (lambda x: x)
     self.decompress = compression and compression.decompress or (lambda x: x)
 
-  def invoke(self, method, parameters={}, callback=None, timeout=0, auto_retry=None, await=False):
+  def invoke(self, method, parameters={}, callback=None, timeout=0, auto_retry=None, await=False, deadline=None):
     '''Invoke a ``method`` to be run on a remote worker process with the given ``parameters``. If specified, ``callback`` will be
        invoked with any response from the remote worker. By default the worker will timeout or retry based on the settings of the
        current ``WorkerConnection`` but ``timeout`` and ``auto_retry`` can be used for invocation specific behavior.
@@ -72,15 +74,20 @@ class ZMQWorkerConnection(WorkerConnection):
        values of ``timeout`` will prevent messages from ever expiring or retrying regardless of ``auto_retry``. The default
        values of ``timeout`` and ``auto_retry`` cause a fallback to the values used to initialize ``WorkerConnection``.
 
+       The ``deadline`` (a ``time.time()`` value) is sent with the message so the worker can drop the task if it expires before
+       the worker receives it. It defaults to the deadline of the current request, see ``toto.deadline``.
+
        Passing ``await=True`` will wrap the call in a ``tornado.gen.Task`` allowing you to ``yield`` the response from the worker.
        The ``Task`` replaces ``callback`` so any user supplied callback will be ignored when ``await=True``.
 
        Alternatively, you can invoke methods with ``WorkerConnection.<module>.<method>(*args, **kwargs)``
        where ``"<module>.<method>"`` will be passed as the ``method`` argument to ``invoke()``.
     '''
+    span = self._start_span(method)
+    message = self.compress(self.dumps(self._message(method, parameters, deadline, span)))
     if await:
-      return Task(lambda callback: self._queue_message(self.compress(self.dumps({'method': method, 'parameters': parameters})), callback, timeout, auto_retry))
-    self._queue_message(self.compress(self.dumps({'method': method, 'parameters': parameters})), callback, timeout, auto_retry)
+      return Task(lambda callback: self._queue_message(message, finish_callback(span, timed_callback('worker', method, callback)), timeout, auto_retry))
+    self._queue_message(message, finish_callback(span, timed_callback('worker', method, callback)), timeout, auto_retry)
 
   def add_connection(self, address):
     '''Connect to the worker at ``address``. Worker invocations will be round robin load balanced between all connected workers.'''